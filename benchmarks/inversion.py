@@ -0,0 +1,70 @@
+#! /usr/bin/env python3
+
+""" benchmark of the T1 inversion methods of the B1 correction (lookup vs triangulation)
+
+Random voxels are drawn with a known T1 and relative B1, their UNI signal is computed with the MP2RAGE forward model
+and quantized on the dicom levels, then both inversion methods are timed and compared to the ground truth.
+
+Usage : python benchmarks/inversion.py [--voxels N] [--output results.json]
+"""
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+
+import hiplay
+from hiplay.lookup_table import read_system_parameters, build_lookup_table, mp2rage_signal
+from hiplay.inversion import build_inverse_table, invert_signal, invert_signal_triangulation, T1_FILL_VALUE, UNI_LEVELS
+
+
+def run_benchmark(n_voxels, seed=0):
+    param_system = read_system_parameters(os.path.join(os.path.dirname(hiplay.__file__), 'MR_system_parameters'))
+    T1, B1, signal = build_lookup_table(param_system)
+
+    rng = np.random.default_rng(seed)
+    T1_true = rng.uniform(400, 4000, n_voxels)
+    B1map_rel = rng.uniform(40, 120, n_voxels)
+    uni = mp2rage_signal(T1_true, B1map_rel / 100, param_system)
+    uni = np.clip(np.round((uni + 0.5) * UNI_LEVELS), 0, UNI_LEVELS - 1) / UNI_LEVELS - 0.5
+
+    results = {'voxels': n_voxels}
+    maps = {}
+
+    start = time.perf_counter()
+    inverse_table = build_inverse_table(T1, B1, signal)
+    T1map = invert_signal(inverse_table, B1, B1map_rel, uni)
+    results['lookup_seconds'] = time.perf_counter() - start
+    maps['lookup'] = T1map
+
+    start = time.perf_counter()
+    T1map = invert_signal_triangulation(T1, B1, signal, B1map_rel, uni)
+    results['triangulation_seconds'] = time.perf_counter() - start
+    maps['triangulation'] = T1map
+
+    for name, T1map in maps.items():
+        T1map[np.isnan(T1map)] = T1_FILL_VALUE
+        error = np.abs(T1map - T1_true)
+        results['{}_median_error_ms'.format(name)] = float(np.median(error))
+        results['{}_p99_error_ms'.format(name)] = float(np.percentile(error, 99))
+
+    difference = np.abs(maps['lookup'] - maps['triangulation'])
+    results['difference_median_ms'] = float(np.median(difference))
+    results['difference_p99_ms'] = float(np.percentile(difference, 99))
+    results['difference_max_ms'] = float(difference.max())
+    results['speedup'] = results['triangulation_seconds'] / results['lookup_seconds']
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='benchmark of the T1 inversion methods of the B1 correction')
+    parser.add_argument('--voxels', type=int, default=1000000, help='number of random voxels')
+    parser.add_argument('--output', help='path of a json file to store the results')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.voxels)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,98 @@
+#! /usr/bin/env python3
+
+""" validation of the native B1 map resampling against flirt (FSL) or numpy
+
+The B1 map is resampled on the grid of the T1 uni image with hiplay.resampling.resample_to_reference and compared to
+"flirt -usesqform -applyxfm" when a FSL folder is given, or otherwise to a trilinear interpolation written with numpy
+from the world coordinates of the voxels (independent of scipy.ndimage.map_coordinates used by hiplay.resampling).
+
+Usage : python benchmarks/resampling.py <b1map.nii.gz> <t1uni.nii.gz> [--fsl FSL_HOME] [--jobs N] [--output results.json]
+"""
+
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import nibabel as nib
+
+from hiplay.resampling import resample_to_reference
+
+
+def reference_flirt(b1_path, uni_path, fsl_home):
+    tmp_directory = tempfile.mkdtemp()
+    out_path = os.path.join(tmp_directory, 'b1_to_mp2r.nii.gz')
+    command = ". {0}/etc/fslconf/fsl.sh; {0}/bin/flirt -in {1} -ref {2} -usesqform -applyxfm -out {3}".format(
+        fsl_home, b1_path, uni_path, out_path)
+    subprocess.check_call(command, shell=True)
+    data = nib.load(out_path).get_fdata()
+    shutil.rmtree(tmp_directory)
+    return data
+
+
+def reference_numpy(b1, b1_affine, shape, uni_affine, slab_size=8):
+    resampled = np.zeros(shape)
+    b1_shape = np.array(b1.shape).reshape(3, 1)
+    for z_start in range(0, shape[2], slab_size):
+        z_stop = min(z_start + slab_size, shape[2])
+        grid = np.indices((shape[0], shape[1], z_stop - z_start)).reshape(3, -1).astype(float)
+        grid[2] += z_start
+        world = uni_affine.dot(np.vstack([grid, np.ones(grid.shape[1])]))
+        points = np.linalg.solve(b1_affine, world)[:3]
+        inside = np.all((points >= 0) & (points <= b1_shape - 1), axis=0)
+        low = np.minimum(np.floor(points).astype(int), b1_shape - 2)
+        weights = points - low
+        values = np.zeros(points.shape[1])
+        for corner in np.ndindex(2, 2, 2):
+            corner = np.array(corner).reshape(3, 1)
+            weight = np.prod(np.where(corner, weights, 1 - weights), axis=0)
+            index = np.clip(low + corner, 0, b1_shape - 1)
+            values += weight * b1[index[0], index[1], index[2]]
+        resampled[:, :, z_start:z_stop] = np.where(inside, values, 0).reshape(shape[0], shape[1], z_stop - z_start)
+    return resampled
+
+
+def run_validation(b1_path, uni_path, fsl_home=None, n_jobs=1):
+    b1_img = nib.load(b1_path)
+    uni_img = nib.load(uni_path)
+    b1 = b1_img.get_fdata()
+
+    results = {'shape': list(uni_img.shape)}
+    start = time.perf_counter()
+    native = resample_to_reference(b1, b1_img.affine, uni_img.shape, uni_img.affine, n_jobs=n_jobs)
+    results['native_seconds'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if fsl_home is not None:
+        results['reference'] = 'flirt'
+        reference = reference_flirt(b1_path, uni_path, fsl_home)
+    else:
+        results['reference'] = 'numpy'
+        reference = reference_numpy(b1, b1_img.affine, uni_img.shape, uni_img.affine)
+    results['reference_seconds'] = time.perf_counter() - start
+
+    difference = np.abs(native - reference)
+    results['difference_max'] = float(difference.max())
+    results['difference_p99'] = float(np.percentile(difference, 99))
+    results['relative_difference_median'] = float(np.median(difference[reference != 0] / np.abs(reference[reference != 0])))
+    results['outside_mismatch_voxels'] = int(((native == 0) != (reference == 0)).sum())
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='validation of the native B1 map resampling')
+    parser.add_argument('b1map', help='B1 map to resample')
+    parser.add_argument('t1uni', help='reference T1 uni image')
+    parser.add_argument('--fsl', help='FSL folder, to compare with flirt')
+    parser.add_argument('--jobs', type=int, default=1, help='number of threads of the native resampling')
+    parser.add_argument('--output', help='path of a json file to store the results')
+    args = parser.parse_args()
+
+    results = run_validation(args.b1map, args.t1uni, args.fsl, args.jobs)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -1 +1,2 @@
 name = "myelin_content"
+__version__ = "1.1.0"
@@ -0,0 +1,173 @@
+# Module
+import os
+import re
+import sqlite3
+
+from hiplay.config import get_cache_directory
+
+# policies to choose between several series folders matching the same acquisition
+#   interactive : ask the user
+#   first : first folder in alphabetical order
+#   latest : most recently modified folder
+#   highest : highest series number (leading digits of the folder name)
+SELECTION_POLICIES = ['interactive', 'first', 'latest', 'highest']
+
+
+class AcquisitionIndex(object):
+    """
+    Persistent index of the folders of an acquisition database (<database>/<date>/<NIP folder>/<series folder>)
+
+    The listing of each folder is stored in a SQLite file with the modification time of the folder. A folder is only
+    listed again when its modification time changed, so that lookups in a large database on a network filesystem
+    do not list the date and subject folders at each run. The series folders found by series are checked at each
+    lookup, since their content changes without changing the listing of their subject folder.
+
+    Parameters
+    ----------
+        database_directory : string
+            path to the acquisition directory where the dicom data are stored in folders date/NIP
+        index_path : string
+            path of the SQLite file. Default is acquisition_index.sqlite in hiplay.config.get_cache_directory
+
+    """
+
+    def __init__(self, database_directory, index_path=None):
+        if index_path is None:
+            index_path = os.path.join(get_cache_directory(), 'acquisition_index.sqlite')
+        self.database_directory = os.path.abspath(database_directory)
+        self.index_path = index_path
+        self.connection = sqlite3.connect(index_path, timeout=60)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS directories '
+                                    '(path TEXT PRIMARY KEY, mtime REAL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS entries '
+                                    '(parent TEXT, name TEXT, mtime REAL, PRIMARY KEY (parent, name))')
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def list_directory(self, path):
+        """
+        Return the sub-folders of path as a list of (name, mtime), listing path only if it changed since the last call
+        """
+        path = os.path.abspath(path)
+        mtime = os.stat(path).st_mtime
+        row = self.connection.execute('SELECT mtime FROM directories WHERE path = ?', (path,)).fetchone()
+        if row is None or row[0] != mtime:
+            entries = []
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        entries.append((path, entry.name, entry.stat().st_mtime))
+            with self.connection:
+                self.connection.execute('DELETE FROM entries WHERE parent = ?', (path,))
+                self.connection.executemany('INSERT INTO entries VALUES (?, ?, ?)', entries)
+                self.connection.execute('INSERT OR REPLACE INTO directories VALUES (?, ?)', (path, mtime))
+        return self.connection.execute('SELECT name, mtime FROM entries WHERE parent = ? ORDER BY name',
+                                       (path,)).fetchall()
+
+    def refresh(self, dates=None):
+        """
+        Update the index of the given dates (list of yyyymmdd strings), or of the whole database
+
+        Returns
+        ---------
+            dates : list of strings
+                dates present in the index after the refresh
+
+        """
+        if dates is None:
+            dates = [name for name, _ in self.list_directory(self.database_directory)]
+        for date in dates:
+            date_directory = os.path.join(self.database_directory, date)
+            for subject_folder, _ in self.list_directory(date_directory):
+                self.list_directory(os.path.join(date_directory, subject_folder))
+        return dates
+
+    def subjects(self, date, NIP):
+        """return the subject folders of the acquisition date matching the NIP"""
+        nip_pattern = re.compile('{}(.*)'.format(NIP))
+        folders = self.list_directory(os.path.join(self.database_directory, date))
+        return [nip_pattern.search(name).group() for name, _ in folders if nip_pattern.search(name) is not None]
+
+    def series(self, date, subject_folder, pattern):
+        """
+        Return the series folders of a subject matching a regular expression
+
+        The modification time of each matching folder is read again and updated in the index : a series folder
+        changes while its dicom images are copied, without changing the subject folder listed in the index.
+
+        Returns
+        ---------
+            series : list of dict
+                one dict per matching folder with keys 'folder', 'number' (series number or None) and 'mtime'
+
+        """
+        acq_pattern = re.compile(pattern)
+        subject_directory = os.path.abspath(os.path.join(self.database_directory, date, subject_folder))
+        folders = self.list_directory(subject_directory)
+        series = []
+        changed = []
+        for name, mtime in folders:
+            match = acq_pattern.search(name)
+            if match is not None:
+                try:
+                    current_mtime = os.stat(os.path.join(subject_directory, name)).st_mtime
+                except OSError:
+                    continue
+                if current_mtime != mtime:
+                    changed.append((current_mtime, subject_directory, name))
+                number = re.match(r'^(\d+)', name)
+                series.append({'folder': match.group(),
+                               'number': int(number.group(1)) if number is not None else None,
+                               'mtime': current_mtime})
+        if changed:
+            with self.connection:
+                self.connection.executemany('UPDATE entries SET mtime = ? WHERE parent = ? AND name = ?', changed)
+        return series
+
+
+def select_series(series, policy='interactive'):
+    """
+    Choose one series folder among several candidates
+
+    Parameters
+    ----------
+        series : list of dict
+            candidates as returned by AcquisitionIndex.series
+        policy : string
+            one of SELECTION_POLICIES
+
+    Returns
+    ---------
+        folder : string
+            name of the chosen series folder
+
+    """
+    if policy not in SELECTION_POLICIES:
+        raise ValueError('Unknown selection policy {}, choose one of {}'.format(policy, SELECTION_POLICIES))
+    if len(series) == 1:
+        return series[0]['folder']
+
+    if policy == 'first':
+        return min(series, key=lambda s: s['folder'])['folder']
+    if policy == 'latest':
+        return max(series, key=lambda s: s['mtime'])['folder']
+    if policy == 'highest':
+        return max(series, key=lambda s: (s['number'] is not None, s['number'] or 0, s['folder']))['folder']
+
+    folders = [s['folder'] for s in series]
+    num = 0
+    try:
+        num = int(input("Please enter the acquisition number you would like (1= first, 2=second, ...) = "))
+    except ValueError:
+        print("Oops!  That was no valid number.  Try again...")
+    if 1 <= num <= len(folders):
+        return folders[num - 1]
+    raise ValueError("Number out of range!")
@@ -4,21 +4,319 @@ import shutil
 import re
 import nibabel as nib
 import numpy as np
-import math
+import tempfile
+import contextlib
+import itertools
 import subprocess as sub
-from scipy import signal as sig
-import matplotlib.tri as tri
 
+from hiplay.instrumentation import stage
+from hiplay.commands import run_tool, fsl_environment, subject_log, TIMEOUTS
+from hiplay.lookup_table import read_system_parameters, load_lookup_table, build_lookup_table, T1_RANGE
+from hiplay.inversion import build_inverse_table, invert_signal, invert_signal_triangulation, T1_FILL_VALUE
+from hiplay.nifti_io import iter_slabs, find_image, integer_scaling, NiftiSlabWriter, IOStats, IO_POLICIES
+from hiplay.filtering import median_filter, foreground_mask
+from hiplay.resampling import resample_to_reference, resample_voxels
 
-def apply_B1correction(path_directory, steps, project_directory, fslHome):
+INTERPOLATION_MODES = ['lookup', 'triangulation']
+RESAMPLING_MODES = ['native', 'flirt']
+
+# nominal flip angle in degrees of the B1 map sequence
+NOMINAL_FLIP_ANGLE = 60
+
+# floating point types of the computation. Against float64, float32 changes T1 by less than 0.001 ms and R1 by less
+# than 1e-6 s-1 (measured with myelin_benchmark on the phantoms of hiplay.benchmark, with and without noise), far
+# below the 10 ms step of the lookup table
+PRECISIONS = ['float32', 'float64']
+
+# on-disk data types of the T1 and R1 maps proposed by the scripts
+OUTPUT_DTYPES = ['float32', 'float64', 'int16', 'uint16']
+
+
+def compute_R1(T1map, multiple=1000):
+    """
+    Compute the R1 map (multiple / T1) from a T1 map in ms, like "fslmaths -recip -mul 1000"
+
+    Voxels where T1 is 0, NaN or infinite get a R1 of 0.
+
+    """
+    R1map = np.zeros(T1map.shape, dtype=np.result_type(T1map.dtype, np.float32))
+    valid = np.isfinite(T1map) & (T1map != 0)
+    np.divide(multiple, T1map, out=R1map, where=valid)
+    return R1map
+
+
+def read_reference_amplitude(file_path):
+    """
+    Read the reference amplitude of the transmitter (flReferenceAmplitude) in the text dump of a dicom header
+
+    Returns
+    ---------
+        reference : int
+            last flReferenceAmplitude value of the file, 0 if there is none
+
+    """
+    reference = 0
+    with open(file_path, encoding='latin-1') as f:  # return reference value from dicom data
+        for line in f:
+            line = line.strip()
+            if re.match(r'(.*)flReferenceAmplitude(.*)', line):
+                line_split = re.split(r'=', line)
+                reference = int(line_split[1])
+    return reference
+
+
+def get_precision(precision):
+    """return the numpy dtype of a precision of PRECISIONS"""
+    if str(np.dtype(precision)) not in PRECISIONS:
+        raise ValueError('Unknown precision {}, choose one of {}'.format(precision, PRECISIONS))
+    return np.dtype(precision)
+
+
+def output_scalings(output_dtype):
+    """
+    Return the (slope, inter) of the T1 and R1 maps written in output_dtype (see hiplay.nifti_io.integer_scaling)
+
+    With an integer type the T1 map covers [0, T1_FILL_VALUE] or the table range, the R1 map [0, 1000 / min T1]. In
+    int16 the quantization error is below 0.08 ms for T1 and 8e-5 s-1 for R1.
+    """
+    t1_max = max(T1_RANGE[1], T1_FILL_VALUE)
+    return {'t1': integer_scaling(output_dtype, t1_max), 'r1': integer_scaling(output_dtype, 1000. / T1_RANGE[0])}
+
+
+def correction_tables(lookup_table, interpolation='lookup', dtype=np.float32):
+    """
+    Return the tables used by iter_b1_correction : the lookup table (T1, B1, signal) and, for the 'lookup'
+    interpolation, its inverse (see hiplay.inversion.build_inverse_table) in the floating point type dtype
+    """
+    if interpolation not in INTERPOLATION_MODES:
+        raise ValueError('Unknown interpolation {}, choose one of {}'.format(interpolation, INTERPOLATION_MODES))
+    T1, B1, signal = lookup_table
+    inverse_table = None
+    if interpolation == 'lookup':
+        with stage('inverse table'):
+            inverse_table = build_inverse_table(T1, B1, signal).astype(dtype, copy=False)
+    return T1, B1, signal, inverse_table
+
+
+def slab_bounds(nz, slab_size=None):
+    """return the (z_start, z_stop) of the slabs of slab_size slices covering nz slices (one slab if None)"""
+    slab_size = slab_size or nz
+    return [(z_start, min(z_start + slab_size, nz)) for z_start in range(0, nz, slab_size)]
+
+
+def iter_array_slabs(volume, slab_size=None):
+    """yield (z_start, z_stop, slab) over the z axis of an array, the slabs are views of the array (no copy)"""
+    for z_start, z_stop in slab_bounds(volume.shape[2], slab_size):
+        yield z_start, z_stop, volume[:, :, z_start:z_stop]
+
+
+def iter_resampled_slabs(b1, b1_affine, shape, affine, slab_size=None, n_jobs=1, dtype=np.float32, mask=None):
+    """
+    yield the slabs along z of the B1 map b1 resampled on the grid (shape, affine) of the T1 uni image. With a mask
+    of this grid, only the voxels of the mask are resampled and each slab is the 1D array of their values
+    """
+    for z_start, z_stop in slab_bounds(shape[2], slab_size):
+        with stage('resampling', z_start=z_start, z_stop=z_stop):
+            if mask is None:
+                resampled = resample_to_reference(b1, b1_affine, shape, affine, z_range=(z_start, z_stop),
+                                                  n_jobs=n_jobs, dtype=dtype)
+            else:
+                i, j, k = np.nonzero(mask[:, :, z_start:z_stop])
+                resampled = resample_voxels(b1, b1_affine, affine, (i, j, k + z_start), dtype=dtype)
+        yield resampled
+
+
+def compute_foreground(uni, slab_size=None):
+    """
+    Compute the mask of the voxels corrected with the foreground option (see hiplay.filtering.foreground_mask)
+
+    uni can be the dataobj of the T1 uni image : it is read by slabs of slab_size slices, only the boolean mask of
+    the volume is held in memory
+
+    Returns
+    ---------
+        mask : array of bool
+            True in the head. All the voxels if no head is found
+
+    """
+    with stage('foreground mask'):
+        mask = foreground_mask(uni, slab_size=slab_size)
+    if not mask.any():
+        print('WARNING : No foreground found in the T1 uni image, all the voxels are corrected')
+        mask[...] = True
+    else:
+        print('INFO : Foreground mask : {:.1f}% of the voxels are corrected'.format(100 * mask.mean()))
+    return mask
+
+
+def iter_b1_correction(uni_slabs, b1_slabs, tables, coef_ref, interpolation='lookup', dtype=np.float32,
+                       mask_slabs=None):
+    """
+    Compute the T1 and R1 maps corrected from B1+ slab by slab, from slabs of the T1 uni image and of the B1 map on
+    the same grid. The input slabs are not modified.
+
+    With mask_slabs, the voxels of the mask are gathered in 1D arrays before the inversion and scattered back in the
+    slabs : the background gets a T1 of T1_FILL_VALUE (R1 1000 / T1_FILL_VALUE) and a B1 of 0.
+
+    Parameters
+    ----------
+        uni_slabs : iterable
+            (z_start, z_stop, slab) of the T1 uni image in dicom levels [0, 4095] (see iter_array_slabs)
+        b1_slabs : iterable
+            matching slabs of the filtered B1 map, in 0.1 degree of flip angle (0 outside of the B1 map)
+        tables : tuple
+            output of correction_tables
+        coef_ref : float
+            reference amplitude of the MP2RAGE divided by the one of the B1 map
+        interpolation : string
+            method used to compute T1 from the lookup table (see apply_B1correction)
+        dtype : numpy dtype
+            floating point type of the computation (see PRECISIONS)
+        mask_slabs : iterable
+            matching boolean slabs of the foreground (see compute_foreground). The B1 slabs are either full slabs or
+            the 1D arrays of the foreground voxels (see iter_resampled_slabs). Default corrects all the voxels
+
+    Returns
+    ---------
+        generator of (z_start, z_stop, b1, T1map, R1map) with b1 the B1 map corrected for the reference amplitudes,
+        all in dtype
+
+    """
+    T1, B1, signal, inverse_table = tables
+    flipAngleNom = NOMINAL_FLIP_ANGLE * 10 * coef_ref
+    if mask_slabs is None:
+        mask_slabs = itertools.repeat(None)
+    for (z_start, z_stop, uni), b1, mask in zip(uni_slabs, b1_slabs, mask_slabs):
+        # Gather the foreground voxels
+        if mask is not None:
+            shape = uni.shape
+            uni = uni[mask]
+            if b1.ndim != 1:
+                b1 = b1[mask]
+
+        # Apply offset FAnom outside B1+ FOV and correct for the reference value
+        b1 = np.where(b1 == 0, NOMINAL_FLIP_ANGLE * 10, b1).astype(dtype, copy=False) * coef_ref
+
+        # Normalise T1 uni and create a relative B1 map
+        uni = np.divide(uni, 4096, dtype=dtype) - 0.5
+        B1map_rel = 100 / flipAngleNom * b1
+        np.clip(B1map_rel, 20, 120, out=B1map_rel)  # limit B1 from 20% to 120% nominal value for corection
+
+        # Invert the lookup table : T1 as a function of the relative B1 and of the MP2RAGE signal
+        with stage('interpolation', z_start=z_start, z_stop=z_stop):
+            if interpolation == 'lookup':
+                T1map = invert_signal(inverse_table, B1, B1map_rel, uni)
+            else:
+                T1map = invert_signal_triangulation(T1, B1, signal, B1map_rel, uni).astype(dtype, copy=False)
+        del uni, B1map_rel
+
+        # Calculate corrected T1 data on the measured B1/signal grid and the R1 map
+        T1map[np.isnan(T1map)] = T1_FILL_VALUE
+        R1map = compute_R1(T1map)
+
+        # Scatter the foreground voxels in the slabs
+        if mask is not None:
+            slabs = []
+            for values, fill_value in [(b1, 0), (T1map, T1_FILL_VALUE), (R1map, 1000. / T1_FILL_VALUE)]:
+                slab = np.full(shape, fill_value, dtype=values.dtype)
+                slab[mask] = values
+                slabs.append(slab)
+            b1, T1map, R1map = slabs
+        yield z_start, z_stop, b1, T1map, R1map
+
+
+def correct_b1(uni, b1, uni_affine, b1_affine, param_system, ref_b1, ref_mp2r, lookup_table=None,
+               interpolation='lookup', slab_size=None, filter_mode='2d', filter_size=3, n_jobs=1,
+               precision='float32', output_dtype=np.float32, foreground=False):
+    """
+    Compute the T1 and R1 maps corrected from B1+ inhomogeneities [1] from images in memory
+
+    This is the computation of apply_B1correction without the folder layout : nothing is read from or written to
+    disk. The inputs can have any numeric data type and memory order and are not copied (the T1 uni image is
+    processed by views of slab_size slices) nor modified.
+
+    Parameters
+    ----------
+        uni : array (nx, ny, nz)
+            T1 uniform image of the MP2RAGE in dicom levels [0, 4095]
+        b1 : array
+            B1 map in 0.1 degree of flip angle for a nominal angle of 60 degrees, on its own grid
+        uni_affine, b1_affine : arrays (4, 4)
+            voxel to world affines of the T1 uni image and of the B1 map
+        param_system : dict
+            MP2RAGE protocol parameters (see hiplay.lookup_table.read_system_parameters)
+        ref_b1, ref_mp2r : float
+            reference amplitudes (flReferenceAmplitude) of the B1 map and of the MP2RAGE acquisitions
+        lookup_table : tuple
+            (T1, B1, signal) of hiplay.lookup_table.load_lookup_table, to reuse a table between calls. Default
+            computes the table of param_system in memory
+        interpolation, slab_size, filter_mode, filter_size, n_jobs, precision :
+            see apply_B1correction
+        output_dtype : numpy dtype
+            floating point type of the T1 and R1 maps
+        foreground : bool or array
+            only correct the voxels of the head (see apply_B1correction), or of a boolean mask of the shape of uni
+
+    Returns
+    ---------
+        T1map : array (nx, ny, nz)
+            T1 map corrected from the B1+ in ms
+        R1map : array (nx, ny, nz)
+            R1 map corrected from the B1+ in s-1 (1000 / T1)
+
+    References
+    ----------
+    [1] A.Massire et al, High-resolution multi-parametric quantitative magnetic resonance imaging of the human cervical spinal cord at 7T, NeuroImage, 2016
+
+    """
+    shape = uni.shape
+    if len(shape) != 3 or b1.ndim != 3:
+        raise ValueError('The T1 uni {} and the B1 map {} should be 3D volumes'.format(shape, b1.shape))
+    dtype = get_precision(precision)
+    if lookup_table is None:
+        with stage('lookup table'):
+            lookup_table = build_lookup_table(param_system)
+    tables = correction_tables(lookup_table, interpolation, dtype)
+
+    with stage('median filter', mode=filter_mode, size=filter_size):
+        b1_filtered = median_filter(b1, kernel_size=filter_size, mode=filter_mode, n_jobs=n_jobs, dtype=dtype)
+
+    mask = None
+    if isinstance(foreground, np.ndarray):
+        if foreground.shape != shape:
+            raise ValueError('The foreground mask {} should have the shape of the T1 uni {}'
+                             .format(foreground.shape, shape))
+        mask = foreground.astype(bool, copy=False)
+    elif foreground:
+        mask = compute_foreground(uni, slab_size)
+
+    T1map = np.empty(shape, dtype=output_dtype)
+    R1map = np.empty(shape, dtype=output_dtype)
+    slabs = iter_b1_correction(iter_array_slabs(uni, slab_size),
+                               iter_resampled_slabs(b1_filtered, b1_affine, shape, uni_affine, slab_size, n_jobs,
+                                                    dtype, mask),
+                               tables, ref_mp2r / ref_b1, interpolation, dtype,
+                               None if mask is None else (slab for _, _, slab in iter_array_slabs(mask, slab_size)))
+    for z_start, z_stop, _, T1_slab, R1_slab in slabs:
+        T1map[:, :, z_start:z_stop] = T1_slab
+        R1map[:, :, z_start:z_stop] = R1_slab
+    return T1map, R1map
+
+
+def apply_B1correction(path_directory, steps, project_directory, fslHome, cache_directory=None,
+                       interpolation='lookup', slab_size=None, filter_mode='2d', filter_size=3, n_jobs=1,
+                       resampling='native', output_dtype=np.float32, io_policy='compressed', scratch_directory=None,
+                       compresslevel=None, precision='float32', foreground=False):
     """
     compute T1 & R1 quantitative map corrected from B1+ inhomogeneities using an algorithm [1] (Part 1 & 2)
+    The T1 and R1 maps are computed in one pass over the volume
     (optional) reconstruct T1 uniform corrected from B1+ inhomogeneities (uncomment Part 3)
 
     Notes
         -----
         - (OPTIONAL) compute the T1 uniform corrected from the B1+ inhomogeneity. Need to uncomment the part 4
-        - this script calls some functions from the package FSL [2]
+        - this script calls some functions from the package FSL [2] (flirt resampling is optional)
+        - the correction itself is done by iter_b1_correction, use correct_b1 to correct images held in memory
 
 
     Parameters
@@ -33,12 +331,57 @@ def apply_B1correction(path_directory, steps, project_directory, fslHome):
             list containing the name of the steps performed on the pipeline
         project_directory : string
             path to the directory of the project to copy MR_system_parameters.txt from
+        fslHome : string
+            path of the fsl installation folder
+        cache_directory : string
+            directory where the MP2RAGE lookup tables are stored (see hiplay.lookup_table.load_lookup_table)
+        interpolation : string
+            method used to compute T1 from the lookup table :
+                'lookup' : bilinear lookup in the inverted table (see hiplay.inversion.invert_signal)
+                'triangulation' : linear interpolation on a triangulation of the table (requires matplotlib)
+        slab_size : int
+            number of slices (along z) processed at a time. The memory used by the correction is bounded by the size
+            of a slab instead of the size of the volume. None processes the whole volume at once
+        filter_mode : string
+            median filter applied on the B1 map, '2d' (slice by slice) or '3d' (see hiplay.filtering.median_filter)
+        filter_size : int
+            size of the median filter kernel
+        n_jobs : int
+            number of workers used to filter and resample the B1 map. None uses all the cores
+        resampling : string
+            method used to resample the B1 map at the T1 uni resolution :
+                'native' : trilinear interpolation in memory (see hiplay.resampling.resample_to_reference)
+                'flirt' : flirt -usesqform -applyxfm of FSL
+        output_dtype : numpy dtype
+            on-disk data type of the T1 and R1 maps. Integer types (e.g. int16) are stored with a scaling (scl_slope)
+            covering the range of the maps (see output_scalings)
+        io_policy : string
+            storage of the intermediate images (b1_to_mp2r and the flirt input) :
+                'compressed' : .nii.gz files in the folder "2.B1correction"
+                'uncompressed' : .nii files in a temporary folder of scratch_directory, removed at the end. Without
+                                 scratch_directory they are kept in the folder "2.B1correction"
+                'memory' : kept in memory, only written in a temporary folder of scratch_directory for flirt
+            The final T1 and R1 maps are always compressed.
+        scratch_directory : string
+            folder of the uncompressed intermediate images, e.g. a tmpfs. Each call writes them in its own temporary
+            folder, so the scratch folder can be shared by the subjects of a batch. Default is the folder
+            "2.B1correction"
+        compresslevel : int
+            gzip compression level of the compressed intermediate images. Default is the nibabel one
+        precision : string
+            floating point type of the filtering, resampling, inversion and R1 computation, 'float32' or 'float64'
+            (see PRECISIONS for the differences between both)
+        foreground : bool
+            only correct the voxels of the head, found in the T1 uni image (see hiplay.filtering.foreground_mask).
+            The B1 map is resampled and the T1 map inverted only in these voxels, which saves time and memory in
+            proportion of the background. The background gets a T1 of T1_FILL_VALUE and a B1 of 0. The mask of the
+            whole volume is computed first, with about 6 bytes per voxel (see hiplay.filtering.foreground_mask)
 
 
     Outputs
     ---------
     Compute the following output in the folder "2.B1_correction" of the subject directory :
-            b1_to_mp2r.nii.gz : b1map resampled at the T1 mp2rage resolution
+            b1_to_mp2r.nii.gz : b1map resampled at the T1 mp2rage resolution (depends on io_policy)
             t1q_cor.nii : T1 map corrected from the B1+
             R1q_cor.nii : R1 map corrected from the B1+
             (optional) t1uni_cor.nii : T1 uni corrected from the B1+
@@ -52,216 +395,148 @@ def apply_B1correction(path_directory, steps, project_directory, fslHome):
 
     """
    
+    if interpolation not in INTERPOLATION_MODES:
+        raise ValueError('Unknown interpolation {}, choose one of {}'.format(interpolation, INTERPOLATION_MODES))
+    if resampling not in RESAMPLING_MODES:
+        raise ValueError('Unknown resampling {}, choose one of {}'.format(resampling, RESAMPLING_MODES))
+
+    if io_policy not in IO_POLICIES:
+        raise ValueError('Unknown I/O policy {}, choose one of {}'.format(io_policy, IO_POLICIES))
+
+    dtype = get_precision(precision)
+    scalings = output_scalings(output_dtype)
+
     print('INFO : Start B1 correction and save results in folder {} '.format(steps[1]))
-    # ---------- PART 1 : Process the B1map & Add B1+ correction to T1map------------------------------------------------------
-    from subprocess import Popen, PIPE
-
-    # 1. Apply median filter on B1map to remove noise
-    file_name = 'b1map.nii.gz'
-    path = os.path.join(path_directory, steps[0], file_name)
-    tmp = nib.load(path)
-    b1 = tmp.get_data()  # load datas from nifti image
-    b1 = b1.astype(float)  # convert in float
-    k = 0
-    while k < tmp.shape[2]:
-        b1[:, :, k] = sig.medfilt2d(b1[:, :, k])
-        k = k + 1
-    np.uint16(b1)
-    file_name2 = 'b1_to_mp2r.nii.gz'
-    path = os.path.join(path_directory, steps[1], file_name2)
-    new_tmp = nib.Nifti1Image(b1, tmp.affine, tmp.header)
-    new_tmp.to_filename(path)
-
-    del tmp, new_tmp, b1, path, file_name, file_name2
-
-    # 2. Resample B1map to T1map using FSL
-    path_in = os.path.join(path_directory, steps[1], 'b1_to_mp2r.nii.gz')
-    path_ref = os.path.join(path_directory, steps[0], 't1uni.nii.gz')
-    path_out = os.path.join(path_directory, steps[1], 'b1_to_mp2r.nii.gz')
-
-    # Initialise fsl variable environment and run flirt
-    ini_fsl = format(". {}/etc/fslconf/fsl.sh".format(fslHome))
-    flirt = format("{}/bin/flirt -in {} -ref {} -usesqform -applyxfm -out {}".format(fslHome,path_in, path_ref, path_out))
-    command = ini_fsl + ';' + flirt
-    sub.call(command, shell=True)
-    del path_in, path_out, path_ref
-
-    # 3. Apply offset FAnom outside B1+ FOV
-
-    file_name = 'b1_to_mp2r.nii.gz'
-    path = os.path.join(path_directory, steps[1], file_name)
-    tmp = nib.load(path)
-    b1 = tmp.get_data()
-    flipAngle = 60
-    b1[b1 == 0] = flipAngle * 10
-
-    # 4. correction for reference value
-
-    dicom_name = ['info_b1', 'info_t1_image']
-    ref_value = [0, 0]
-    for i in range(2):
-        files = os.path.join(path_directory, steps[0], dicom_name[i])
-
-        with open(files, encoding='latin-1') as f:  # return reference value from dicom data
-            for line in f:
-                line = line.strip()
-                if re.match(r'(.*)flReferenceAmplitude(.*)', line):
-                    line_split = re.split(r'=', line)
-                    ref_value[i] = int(line_split[1])
-
-    ref_b1 = ref_value[0]
-    ref_mp2r = ref_value[1]
-    coef_ref = ref_mp2r / ref_b1
-    b1 = b1 * coef_ref
-    path = os.path.join(path_directory, steps[1], file_name)
-    new_tmp = nib.Nifti1Image(b1, tmp.affine, tmp.header)
-    new_tmp.to_filename(path)
-
-    del tmp, new_tmp, b1, path, file_name
-
-    # 5. Load T1 uni
-    file_name = 't1uni.nii.gz'
-    path = os.path.join(path_directory, steps[0], file_name)
-    tmp = nib.load(path)
-    uni = tmp.get_data()
-    uni = uni / 4096 - 0.5
-
-    # 6. Load b1 map and create a relative map
-    file_name = 'b1_to_mp2r.nii.gz'
-    path = os.path.join(path_directory, steps[1], file_name)
-    tmp = nib.load(path)
-    B1m = tmp.get_data()
-
-    flipAngleNom = flipAngle * 10 * coef_ref
-    B1map_rel = 100 / flipAngleNom * B1m
-    B1map_rel[B1map_rel < 20] = 20  # limit B1 from 20% to 120% nominal value for corection
-    B1map_rel[B1map_rel > 120] = 120
-    B1 = [i for i in range(20, 121)]  # go from 200% B1 to 120% B1
-    B1 = np.int32(B1)
-
-    # 7. Calculate theoretical MP2RAGE signal for a given B1rel and T1 range
-    # Update MP2RAGE parameters in MR_system_parameters.txt (this should be the protocol run on the MR system)
-    file_path = os.path.join(project_directory,'MR_system_parameters')
-    newfile_path = os.path.join(path_directory, steps[1], 'MR_system_parameters')
-    shutil.copyfile(file_path, newfile_path)
-    param_system = [0 for i in range(9)]
-    with open(newfile_path, encoding='latin-1') as f:  # return reference value from dicom data
-        i = 0
-        for line in f:
-            if not line.startswith("#"):
-                line = line.strip()
-                line_split = re.split(r'=', line)
-                param_system[i] = float(line_split[1])
-                i = i + 1
-
-    T1 = np.arange(200, 5000, 10)  # list of T1 in ms
-    alpha1deg = param_system[0]  # FA1 in deg
-    alpha2deg = param_system[1]  # FA2 in deg
-    nbefore = param_system[2]  # FLASH pulses before k-space center
-    nafter = param_system[3]  # FLASH pulses after k-space center
-    n = nbefore + nafter  # Total number of FLASH pulses = number of slices * PF(slice)
-    TR = param_system[4]  # Echo spacing in ms
-    BTR = param_system[5]  # Sequence TR in ms
-    TI1 = param_system[6]  # First inversion time in ms
-    TI2 = param_system[7]  # Second inversion time in ms
-    eff = param_system[8]  # Inversion efficiency for adiabatic pulse (empirical)
-
-    # Intermediate terms
-    TA = TI1 - nbefore * TR  # TA with PF
-    TB = TI2 - TI1 - n * TR  # TB with PF
-    TC = BTR - TI2 - nafter * TR  # TC with PF
-    E1 = np.exp(-(np.divide(TR, T1)))
-    EA = np.exp(-(np.divide(TA, T1)))
-    EB = np.exp(-(np.divide(TB, T1)))
-    EC = np.exp(-(np.divide(TC, T1)))
-    M0 = 1  # Magnetization
-    C = 1
-
-    k = 0
-    signal = np.zeros((T1.shape[0], B1.shape[0]))
-    matrix = np.zeros((T1.shape[0], B1.shape[0]))
-    while k < B1.shape[0]:  # loop over different B1rel values
-        B1rel = (B1[k].astype(float)) / 100
-        alpha1cor = alpha1deg / 180 * math.pi * B1rel  # corrected FA1 in rad
-        alpha2cor = alpha2deg / 180 * math.pi * B1rel  # corrected FA2 in rad
-        SA1 = math.sin(alpha1cor)
-        SA2 = math.sin(alpha2cor)
-        CA1 = math.cos(alpha1cor)
-        CA2 = math.cos(alpha2cor)
-
-        # Steady state FLASH signal PFourier ok
-        tmp1 = np.divide((1 - (CA1 * E1) ** n), (1 - (CA1 * E1)))  # PFourier ok
-        tmp2 = np.divide((1 - (CA2 * E1) ** n), (1 - (CA2 * E1)))  # PFourier ok
-        num = M0 * ((((1 - EA) * (CA1 * E1) ** n + (1 - E1) * tmp1) * EB + (1 - EB)) * (CA2 * E1) ** n + (
-                1 - E1) * tmp2) * EC + (1 - EC);  # PFourier ok
-        den = 1 + eff * (CA1 * CA2) ** n * np.exp(-(np.divide(BTR, T1)))  # PFourier ok
-        mzss = np.divide(num, den)
-
-        # Signal in the middle of the First readout --> only nbefore matters
-        MZtemp = ((-eff * mzss * np.divide(EA, M0) + (1 - EA)) * (CA1 * E1) ** (nbefore) + (1 - E1) * np.divide(
-            (1 - (CA1 * E1) ** (nbefore)), (1 - (CA1 * E1))))
-        GRETI1 = C * SA1 * MZtemp
-
-        # Signal in the middle of the First readout --> both nbefore and nafter matter
-        MZtemp = MZtemp * (CA1 * E1) ** (nafter) + (1 - E1) * np.divide((1 - (CA1 * E1) ** (nafter)),
-                                                                        (1 - (CA1 * E1)))  # PFourier ok
-        MZtemp = (MZtemp * EB + (1 - EB)) * (CA2 * E1) ** (nbefore) + (1 - E1) * np.divide(
-            (1 - (CA2 * E1) ** (nbefore)), (1 - CA2 * E1))  # PFourier ok
-        GRETI2 = C * SA2 * MZtemp
-
-        # Resulting signal (a.u. or dicom levels)
-        SMP2R = np.divide((GRETI1 * GRETI2), (GRETI1 ** 2 + GRETI2 ** 2))
-
-        signal[:, k] = SMP2R
-
-        # little trick for correct CSF
-        value = -0.5
-        near_value = SMP2R.flat[np.abs(SMP2R - value).argmin()]
-        ind = np.where(SMP2R == near_value)
-        # vect = np.zeros((1, len(SMP2R)))
-        vect = SMP2R
-        vect[np.int(ind[0]):vect.shape[0]] = near_value
-
-        signal[:, k] = vect
-
-        # matrix[:, k] = vect
-        k = k + 1
-
-    # 8. create abaque and interpolation
-    # Generate 2D T1 and B1 object matching signal's size
-    T12D = np.tile(T1, (B1.shape[0], 1)).T
-    B12D = np.tile(B1, (T1.shape[0], 1))
-    B12D = B12D.astype(float)
-    # Generate 2D interpolant
-    triang = tri.Triangulation(B12D.flatten(), signal.flatten())
-    interpolator = tri.LinearTriInterpolator(triang, T12D.flatten())
-
-    # 9. Compute T1 unbiased and saved it as Nifti object
-    zi = interpolator(B1map_rel, uni)
-    # Calculate corrected T1 data on the measured B1/signal grid & save as Nifti
-    T1map = zi
-    T1map[np.isnan(T1map)] = 4096
-    file_name = 't1q.nii.gz'
-    path = os.path.join(path_directory, steps[0], file_name)
-    tmp = nib.load(path)
-    file_name = 't1q_cor.nii.gz'
-    path = os.path.join(path_directory, steps[1], file_name)
-    new_tmp = nib.Nifti1Image(T1map, tmp.affine, tmp.header)
-    new_tmp.to_filename(path)
-
-    del tmp, new_tmp, path, file_name
-
-    # ----------------PART 2 : compute R1 corrected ---------------------------------------------------------#
-
-    # Compute the inverse image of T1 map corrected using FSL
-    input_path = os.path.join(path_directory, steps[1], 't1q_cor.nii.gz')
-    output_path = os.path.join(path_directory, steps[1], 'R1q_cor.nii.gz')
-    multiple = '1000'
-
-    ini_fsl = format(". {}/etc/fslconf/fsl.sh".format(fslHome))
-    fslmaths = format("{}/bin/fslmaths {} -recip -mul {} {}".format(fslHome, input_path, multiple, output_path))
-    command = ini_fsl + ';' + fslmaths
-    sub.call(command, shell=True)
+    io_stats = IOStats()
+    output_directory = os.path.join(path_directory, steps[1])
+
+    # Path of the B1 map resampled at the T1 resolution (intermediate image). It is kept in the output folder with
+    # the 'compressed' policy, or with the 'uncompressed' one without scratch folder. Otherwise it is written in a
+    # temporary folder of its own (the scratch folder is shared by the subjects of a batch), removed at the end.
+    # With the 'memory' policy it is only written for flirt.
+    tmp_directory = None
+    if io_policy == 'compressed':
+        b1_path = os.path.join(output_directory, 'b1_to_mp2r.nii.gz')
+    elif io_policy == 'uncompressed' and scratch_directory is None:
+        b1_path = os.path.join(output_directory, 'b1_to_mp2r.nii')
+    elif io_policy == 'uncompressed' or resampling == 'flirt':
+        tmp_directory = tempfile.mkdtemp(prefix='b1correction_', dir=scratch_directory or output_directory)
+        b1_path = os.path.join(tmp_directory, 'b1_to_mp2r.nii')
+    else:
+        b1_path = None
+
+    try:
+        # ---------- PART 1 : Process the B1map & Add B1+ correction to T1map--------------------------------------------------
+        # 1. Apply median filter on B1map to remove noise
+        path = find_image(os.path.join(path_directory, steps[0]), 'b1map')
+        b1_img = nib.load(path)
+        with stage('median filter', mode=filter_mode, size=filter_size):
+            b1_filtered = median_filter(b1_img.get_fdata(dtype=dtype), kernel_size=filter_size, mode=filter_mode,
+                                        n_jobs=n_jobs, dtype=dtype)
+        io_stats.add_read('filtering', path)
+
+        # 2. Resample B1map to T1map. The native resampling is done slab by slab in step 5, flirt resamples the whole
+        # B1 map on disk
+        uni_path = find_image(os.path.join(path_directory, steps[0]), 't1uni')
+        uni_img = nib.load(uni_path)
+        if resampling == 'flirt':
+            with stage('write'), NiftiSlabWriter(b1_path, b1_img.shape, b1_img.affine, b1_img.header,
+                                                 compresslevel=compresslevel) as writer:
+                writer.write(b1_filtered)
+            io_stats.add_written('resampling', size=writer.bytes_written)
+
+            # Run flirt in the fsl environment. flirt writes uncompressed images for the uncompressed and memory
+            # policies
+            environment = fsl_environment(fslHome)
+            if not b1_path.endswith('.gz'):
+                environment['FSLOUTPUTTYPE'] = 'NIFTI'
+            flirt = [os.path.join(fslHome, 'bin', 'flirt'), '-in', b1_path, '-ref', uni_path, '-usesqform', '-applyxfm',
+                     '-out', b1_path]
+            log_path = subject_log(path_directory, 'fsl')
+            try:
+                run_tool(flirt, env=environment, log_path=log_path, timeout=TIMEOUTS['flirt'])
+            except (sub.CalledProcessError, sub.TimeoutExpired) as error:
+                raise RuntimeError('Resampling of the B1 map with flirt failed ({}), see {}'.format(error, log_path))
+            io_stats.add_read('resampling', uni_path)
+            io_stats.add_written('resampling', b1_path)
+
+        # 3. Read the reference amplitudes in the dicom headers of the B1 map and of the MP2RAGE
+        ref_b1 = read_reference_amplitude(os.path.join(path_directory, steps[0], 'info_b1'))
+        ref_mp2r = read_reference_amplitude(os.path.join(path_directory, steps[0], 'info_t1_image'))
+
+        # 4. Calculate theoretical MP2RAGE signal for a given B1rel and T1 range
+        # Update MP2RAGE parameters in MR_system_parameters.txt (this should be the protocol run on the MR system)
+        file_path = os.path.join(project_directory,'MR_system_parameters')
+        newfile_path = os.path.join(path_directory, steps[1], 'MR_system_parameters')
+        shutil.copyfile(file_path, newfile_path)
+        param_system = read_system_parameters(newfile_path)
+
+        # The table only depends on the protocol : it is computed once and then read from the cache directory
+        with stage('lookup table'):
+            lookup_table = load_lookup_table(param_system, cache_directory=cache_directory)
+        tables = correction_tables(lookup_table, interpolation, dtype)
+
+        # 5. Process the volume slab by slab along z (see iter_b1_correction) : the B1 map is resampled (or read from
+        # the flirt output) and the T1 uni is read one slab at a time, the corrected B1 map, T1 and R1 maps are written
+        # as the slabs are computed
+        t1_ref = nib.load(find_image(os.path.join(path_directory, steps[0]), 't1q'))
+        t1_path = os.path.join(path_directory, steps[1], 't1q_cor.nii.gz')
+        shape = uni_img.shape
+        mask = None
+        if foreground:
+            mask = compute_foreground(uni_img.dataobj, slab_size)
+        if resampling == 'flirt':
+            b1_ref = nib.load(b1_path)
+            b1_affine, b1_header = b1_ref.affine, b1_ref.header
+            b1_shape = b1_ref.shape
+            b1_slabs = (slab for _, _, slab in iter_slabs(b1_path, slab_size, dtype))
+            del b1_ref
+        else:
+            b1_affine, b1_header = uni_img.affine, uni_img.header
+            b1_shape = shape
+            b1_slabs = iter_resampled_slabs(b1_filtered, b1_img.affine, shape, uni_img.affine, slab_size, n_jobs, dtype,
+                                            mask)
+        if b1_shape != shape or t1_ref.shape != shape:
+            raise ValueError('The B1 map {}, T1 uni {} and T1 map {} should have the same shape'
+                             .format(b1_shape, shape, t1_ref.shape))
+
+        r1_path = os.path.join(path_directory, steps[1], 'R1q_cor.nii.gz')
+        with contextlib.ExitStack() as stack:
+            t1_writer = stack.enter_context(NiftiSlabWriter(t1_path, shape, t1_ref.affine, t1_ref.header,
+                                                            dtype=output_dtype, slope=scalings['t1'][0],
+                                                            inter=scalings['t1'][1]))
+            r1_writer = stack.enter_context(NiftiSlabWriter(r1_path, shape, t1_ref.affine, t1_ref.header,
+                                                            dtype=output_dtype, slope=scalings['r1'][0],
+                                                            inter=scalings['r1'][1]))
+            b1_writer = None
+            if io_policy != 'memory':
+                b1_writer = stack.enter_context(NiftiSlabWriter(b1_path, shape, b1_affine, b1_header,
+                                                                compresslevel=compresslevel))
+
+            mask_slabs = None if mask is None else (slab for _, _, slab in iter_array_slabs(mask, slab_size))
+            slabs = iter_b1_correction(iter_slabs(uni_path, slab_size, dtype), b1_slabs, tables, ref_mp2r / ref_b1,
+                                       interpolation, dtype, mask_slabs)
+            for z_start, z_stop, b1, T1map, R1map in slabs:
+                with stage('write', z_start=z_start, z_stop=z_stop):
+                    if b1_writer is not None:
+                        b1_writer.write(b1)
+                    t1_writer.write(T1map)
+                    r1_writer.write(R1map)
+                del b1, T1map, R1map
+
+        io_stats.add_read('correction', uni_path)
+        if resampling == 'flirt':
+            io_stats.add_read('correction', b1_path)
+        for writer in [t1_writer, r1_writer, b1_writer]:
+            if writer is not None:
+                io_stats.add_written('correction', size=writer.bytes_written)
+    finally:
+        # the temporary folder of the intermediate images is removed even if the correction fails
+        if tmp_directory is not None:
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+    io_stats.report()
+
+    del b1_img, b1_filtered, uni_img, t1_ref, mask
 
     # # ----------------PART 3 :  Recreate uniform T1 volume corrected from B1+ ---------------------------------------------------------#
     # # Uncomment if you want to reconstruct the T1 uniform corrected from B1+ inhomogeneities
@@ -270,60 +545,11 @@ def apply_B1correction(path_directory, steps, project_directory, fslHome):
     # file_name = 't1q_cor.nii.gz'
     # path = os.path.join(path_directory, steps[1], file_name)
     # tmp = nib.load(path)
-    # T1map_cor = tmp.get_data()
-    # T1map_cor = T1map_cor.astype(float)
+    # T1map_cor = tmp.get_fdata()
     #
     # # 2. Compute a synthetic T1uni unbiased from the T1q unbiased
-    # # Recreate UNI MP2R protocol
-    # alpha1deg = param_system[0]  # FA1 in deg
-    # alpha2deg = param_system[1]  # FA2 in deg
-    # nbefore = param_system[2]  # FLASH pulses before k-space center
-    # nafter = param_system[3]  # FLASH pulses after k-space center
-    # n = nbefore + nafter  # Total number of FLASH pulses = number of slices * PF(slice)
-    # TR = param_system[4]  # Echo spacing in ms
-    # BTR = param_system[5]  # Sequence TR in ms
-    # TI1 = param_system[6]  # First inversion time in ms
-    # TI2 = param_system[7]  # Second inversion time in ms
-    # eff = param_system[8]  # Inversion efficiency for adiabatic pulse (empirical)
-    #
-    # # Intermediate terms
-    # TA = TI1 - nbefore * TR  # TA with PF
-    # TB = TI2 - TI1 - n * TR  # TB with PF
-    # TC = BTR - TI2 - nafter * TR  # TC with PF
-    # E1 = np.exp(-(np.divide(TR, T1map_cor)))
-    # EA = np.exp(-(np.divide(TA, T1map_cor)))
-    # EB = np.exp(-(np.divide(TB, T1map_cor)))
-    # EC = np.exp(-(np.divide(TC, T1map_cor)))
-    # M0 = 1  # Magnetization
-    # C = 1
-    # SA1 = math.sin(alpha1deg / 180 * math.pi)
-    # SA2 = math.sin(alpha2deg / 180 * math.pi)
-    # CA1 = math.cos(alpha1deg / 180 * math.pi)
-    # CA2 = math.cos(alpha2deg / 180 * math.pi)
-    #
-    # # Steady state FLASH signal   PFourier ok
-    # # Steady state FLASH signal PFourier ok
-    # tmp1 = np.divide((1 - (CA1 * E1) ** n), (1 - (CA1 * E1)))  # PFourier ok
-    # tmp2 = np.divide((1 - (CA2 * E1) ** n), (1 - (CA2 * E1)))  # PFourier ok
-    # num = M0 * ((((1 - EA) * (CA1 * E1) ** n + (1 - E1) * tmp1) * EB + (1 - EB)) * (CA2 * E1) ** n + (
-    #             1 - E1) * tmp2) * EC + (1 - EC);  # PFourier ok
-    # den = 1 + eff * (CA1 * CA2) ** n * np.exp(-(np.divide(BTR, T1map_cor)))  # PFourier ok
-    # mzss = np.divide(num, den)
-    #
-    # # Signal in the middle of the First readout --> only nbefore matters
-    # MZtemp = ((-eff * mzss * np.divide(EA, M0) + (1 - EA)) * (CA1 * E1) ** (nbefore) + (1 - E1) * np.divide(
-    #     (1 - (CA1 * E1) ** (nbefore)), (1 - (CA1 * E1))))
-    # GRETI1 = C * SA1 * MZtemp
-    #
-    # # Signal in the middle of the First readout --> both nbefore and nafter matter
-    # MZtemp = MZtemp * (CA1 * E1) ** (nafter) + (1 - E1) * np.divide((1 - (CA1 * E1) ** (nafter)),
-    #                                                                 (1 - (CA1 * E1)))  # PFourier ok
-    # MZtemp = (MZtemp * EB + (1 - EB)) * (CA2 * E1) ** (nbefore) + (1 - E1) * np.divide((1 - (CA2 * E1) ** (nbefore)),
-    #                                                                                    (1 - CA2 * E1))  # PFourier ok
-    # GRETI2 = C * SA2 * MZtemp
-    #
-    # # Resulting signal (a.u. or dicom levels)
-    # SMP2R = np.divide((GRETI1 * GRETI2), (GRETI1 ** 2 + GRETI2 ** 2))
+    # # Recreate UNI MP2R protocol at the nominal flip angles
+    # SMP2R = mp2rage_signal(T1map_cor, 1, param_system)  # see hiplay.lookup_table
     #
     # # Going back to DICOM levels
     # SMP2R_dicom = np.int16(SMP2R * 4096 + 2048)
@@ -0,0 +1,271 @@
+# Module
+import os
+import json
+import time
+import shutil
+import platform
+import tempfile
+import numpy as np
+import nibabel as nib
+
+import hiplay
+from hiplay.lookup_table import read_system_parameters, mp2rage_signal, load_lookup_table
+from hiplay.b1correction import apply_B1correction, correct_b1
+from hiplay.instrumentation import tracing, stage, summarize
+
+PROJECT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+STEPS = ['1.Inputs', '2.B1correction']
+
+# sizes of the phantoms : (shape, voxel size in mm) of the T1 uni and of the B1 map. 'full' is a whole brain
+# MP2RAGE at 0.75 mm iso with a B1 map at the usual resolution
+PHANTOM_SIZES = {'small': (((64, 64, 48), (3.0, 3.0, 3.0)), ((24, 24, 16), (8.0, 8.0, 9.0))),
+                 'medium': (((160, 160, 120), (1.5, 1.5, 1.5)), ((48, 48, 32), (5.0, 5.0, 5.6))),
+                 'full': (((320, 320, 240), (0.75, 0.75, 0.75)), ((64, 64, 48), (3.75, 3.75, 3.75)))}
+
+# T1 in ms of the tissues of the phantom (7T values). The MP2RAGE signal of the CSF is beyond the end of the
+# lookup table (see hiplay.lookup_table.CSF_SIGNAL) : its T1 is expected to be underestimated
+TISSUE_T1 = {'white_matter': 1150., 'grey_matter': 1900., 'csf': 4000.}
+
+# reference amplitude written in the dicom headers of the phantom (same for the B1 map and the MP2RAGE)
+REFERENCE_AMPLITUDE = 250
+
+
+def phantom_b1(x, y, z):
+    """relative B1 (1 = 100%) of the phantom at the coordinates x, y, z in mm : higher in the centre of the head"""
+    return 0.65 + 0.5 * np.exp(-(x ** 2 + y ** 2 + (z / 1.2) ** 2) / (2 * 60. ** 2))
+
+
+def grid_coordinates(shape, affine):
+    """coordinates in mm of the voxel centres of a grid with a diagonal affine, as broadcastable x, y, z arrays"""
+    axes = [affine[i, i] * np.arange(shape[i]) + affine[i, 3] for i in range(3)]
+    return axes[0][:, None, None], axes[1][None, :, None], axes[2][None, None, :]
+
+
+def centred_affine(shape, voxel_size):
+    """affine of a grid of shape and voxel_size centred on the origin"""
+    affine = np.diag(list(voxel_size) + [1.])
+    affine[:3, 3] = -(np.array(shape) - 1) * np.array(voxel_size) / 2
+    return affine
+
+
+def make_phantom(directory, shape, voxel_size, b1_shape, b1_voxel_size, param_system, noise=0., seed=0):
+    """
+    Write the inputs of apply_B1correction for a synthetic head in the folder "1.Inputs" of directory
+
+    The head is an ellipsoid of white matter, grey matter and CSF (with two ventricles) in a smooth B1 field. The T1
+    uni image is the MP2RAGE signal of the forward model (see hiplay.lookup_table.mp2rage_signal) for the true T1 and
+    B1 of each voxel, the B1 map samples the same field at its own resolution. The background of the T1 uni image is
+    random, like in real MP2RAGE images.
+
+    Parameters
+    ----------
+        directory : string
+            folder of the phantom subject
+        shape, voxel_size : tuples
+            grid of the T1 uni image
+        b1_shape, b1_voxel_size : tuples
+            grid of the B1 map
+        param_system : dict
+            MP2RAGE protocol parameters (see hiplay.lookup_table.read_system_parameters)
+        noise : float
+            standard deviation of a gaussian noise added to the MP2RAGE signal (range [-0.5, 0.5])
+        seed : int
+            seed of the random generator
+
+    Returns
+    ---------
+        T1 : array
+            true T1 map in ms (0 in the background)
+        tissues : dict
+            boolean mask of each tissue of TISSUE_T1
+
+    """
+    rng = np.random.default_rng(seed)
+    input_directory = os.path.join(directory, STEPS[0])
+    os.makedirs(input_directory, exist_ok=True)
+    os.makedirs(os.path.join(directory, STEPS[1]), exist_ok=True)
+
+    # anatomy : radius relative to an ellipsoid filling 80% of the field of view
+    affine = centred_affine(shape, voxel_size)
+    x, y, z = grid_coordinates(shape, affine)
+    half_size = 0.4 * np.array(shape) * np.array(voxel_size)
+    radius = np.sqrt((x / half_size[0]) ** 2 + (y / half_size[1]) ** 2 + (z / half_size[2]) ** 2)
+    ventricles = ((np.abs(x) - 0.15 * half_size[0]) / (0.08 * half_size[0])) ** 2 + \
+                 (y / (0.3 * half_size[1])) ** 2 + (z / (0.15 * half_size[2])) ** 2 < 1
+    tissues = {'white_matter': (radius < 0.7) & ~ventricles,
+               'grey_matter': (radius >= 0.7) & (radius < 0.85),
+               'csf': ((radius >= 0.85) & (radius < 1)) | ventricles}
+    T1 = np.zeros(shape)
+    for name, mask in tissues.items():
+        T1[mask] = TISSUE_T1[name]
+    head = T1 > 0
+
+    # T1 uni in dicom levels [0, 4095], random outside of the head
+    signal = mp2rage_signal(np.where(head, T1, 1000.), phantom_b1(x, y, z), param_system)
+    if noise:
+        signal = signal + rng.normal(0, noise, shape)
+    uni = np.clip(np.round((signal + 0.5) * 4096), 0, 4095)
+    uni[~head] = rng.integers(0, 4096, np.count_nonzero(~head))
+    del signal
+    img = nib.Nifti1Image(uni.astype(np.uint16), affine)
+    img.to_filename(os.path.join(input_directory, 't1uni.nii.gz'))
+    del uni
+    # the T1 map of the scanner is only used for its header
+    nib.Nifti1Image(np.zeros(shape, np.uint16), affine).to_filename(os.path.join(input_directory, 't1q.nii.gz'))
+
+    # B1 map in the units of the scanner : flip angle in 0.1 degrees for a nominal angle of 60 degrees
+    b1_affine = centred_affine(b1_shape, b1_voxel_size)
+    b1 = 600 * phantom_b1(*grid_coordinates(b1_shape, b1_affine)) * np.ones(b1_shape)
+    nib.Nifti1Image(np.round(b1).astype(np.int16), b1_affine).to_filename(os.path.join(input_directory,
+                                                                                       'b1map.nii.gz'))
+
+    # dicom headers with the reference amplitudes
+    for name in ['info_b1', 'info_t1_image']:
+        with open(os.path.join(input_directory, name), 'w', encoding='latin-1') as f:
+            f.write('sAdjData.flReferenceAmplitude = {}\n'.format(REFERENCE_AMPLITUDE))
+
+    return T1, tissues
+
+
+def accuracy(T1map, T1, tissues):
+    """
+    Errors of a T1 map against the true T1 of the phantom in each tissue
+
+    Returns
+    ---------
+        errors : dict
+            for each tissue, the bias, mean and maximum absolute errors in ms and the mean absolute error of T1 and
+            R1 in % of the true value
+
+    """
+    errors = {}
+    for name, mask in tissues.items():
+        estimated = T1map[mask].astype(np.float64)
+        true = T1[mask]
+        difference = estimated - true
+        errors[name] = {'voxels': int(mask.sum()), 'true_t1_ms': float(true[0]),
+                        'bias_ms': float(difference.mean()),
+                        'mean_absolute_error_ms': float(np.abs(difference).mean()),
+                        'max_absolute_error_ms': float(np.abs(difference).max()),
+                        'mean_relative_error_percent': float(100 * np.abs(difference / true).mean()),
+                        'r1_mean_relative_error_percent':
+                            float(100 * np.abs(np.divide(true, estimated, out=np.zeros_like(true),
+                                                         where=estimated != 0) - 1).mean())}
+    return errors
+
+
+def float64_reference(directory, param_system, b1_options):
+    """
+    Compute the T1 and R1 maps of a phantom in memory with the float64 precision (see hiplay.b1correction.correct_b1)
+    and the options of b1_options which change the maps
+    """
+    uni_img = nib.load(os.path.join(directory, STEPS[0], 't1uni.nii.gz'))
+    b1_img = nib.load(os.path.join(directory, STEPS[0], 'b1map.nii.gz'))
+    options = {key: b1_options[key] for key in ['interpolation', 'filter_mode', 'filter_size', 'slab_size', 'n_jobs',
+                                                'foreground'] if key in b1_options}
+    lookup_table = load_lookup_table(param_system, cache_directory=b1_options.get('cache_directory'))
+    return correct_b1(np.asanyarray(uni_img.dataobj), np.asanyarray(b1_img.dataobj), uni_img.affine, b1_img.affine,
+                      param_system, REFERENCE_AMPLITUDE, REFERENCE_AMPLITUDE, lookup_table, precision='float64',
+                      output_dtype=np.float64, **options)
+
+
+def difference(maps, reference, mask):
+    """maximum and mean absolute differences of the T1 and R1 maps with the reference maps, in the voxels of mask"""
+    differences = {}
+    for name, unit in [('t1', 'ms'), ('r1', 's-1')]:
+        error = np.abs(maps[name][mask] - reference[name][mask])
+        differences['{}_max_{}'.format(name, unit)] = float(error.max())
+        differences['{}_mean_{}'.format(name, unit)] = float(error.mean())
+    return differences
+
+
+def run_benchmark(sizes=('small',), repeats=1, noise=0., b1_options=None, directory=None, output_path=None):
+    """
+    Time apply_B1correction on synthetic phantoms and check its T1 maps against the true T1
+
+    No FSL, freesurfer or dicom database is needed : the phantoms are written in a temporary folder and the B1 map
+    is resampled natively. Each run is traced (see hiplay.instrumentation) to time the stages of the correction. The
+    first run of each size uses an empty lookup table cache, so that the cost of building the table is measured.
+    The maps are also compared with maps computed in float64 (see float64_reference), to measure the effect of the
+    precision and of the output data type (see hiplay.b1correction.PRECISIONS).
+
+    Parameters
+    ----------
+        sizes : list of strings
+            sizes of the phantoms (keys of PHANTOM_SIZES)
+        repeats : int
+            number of runs for each size
+        noise : float
+            noise of the MP2RAGE signal (see make_phantom)
+        b1_options : dict
+            other arguments of apply_B1correction (e.g. slab_size, n_jobs, interpolation)
+        directory : string
+            folder where the phantoms and results are kept. Default is a temporary folder, removed at the end
+        output_path : string
+            json file where the results are saved
+
+    Returns
+    ---------
+        results : dict
+            description of the machine and, for each run, the size, the total time, the summary of the stages
+            (see hiplay.instrumentation.summarize), the errors in each tissue (see accuracy), the differences with
+            the float64 maps in the head and in the whole image, and the size of the T1 and R1 files
+
+    """
+    b1_options = dict(b1_options or {})
+    b1_options['resampling'] = 'native'
+    param_system = read_system_parameters(os.path.join(PROJECT_DIRECTORY, 'MR_system_parameters'))
+    results = {'hiplay_version': hiplay.__version__, 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'machine': platform.node(), 'processor': platform.processor() or platform.machine(),
+               'cpu_count': os.cpu_count(), 'python': platform.python_version(), 'numpy': np.__version__,
+               'nibabel': nib.__version__, 'noise': noise,
+               'options': {key: str(value) for key, value in b1_options.items()}, 'runs': []}
+
+    root = tempfile.mkdtemp(prefix='hiplay_benchmark_') if directory is None else directory
+    try:
+        for size in sizes:
+            if size not in PHANTOM_SIZES:
+                raise ValueError('Unknown phantom size {}, choose among {}'.format(size, list(PHANTOM_SIZES)))
+            (shape, voxel_size), (b1_shape, b1_voxel_size) = PHANTOM_SIZES[size]
+            subject_directory = os.path.join(root, size)
+            print('INFO : Create the {} phantom {} in {}'.format(size, shape, subject_directory))
+            T1, tissues = make_phantom(subject_directory, shape, voxel_size, b1_shape, b1_voxel_size, param_system,
+                                       noise)
+            options = dict(b1_options)
+            options.setdefault('cache_directory', os.path.join(subject_directory, 'lookup_tables'))
+            if os.path.isdir(options['cache_directory']) and 'cache_directory' not in b1_options:
+                shutil.rmtree(options['cache_directory'])
+
+            reference = None
+            for repeat in range(repeats):
+                start = time.perf_counter()
+                with tracing(None) as tracer, stage('b1correction'):
+                    apply_B1correction(subject_directory, STEPS, PROJECT_DIRECTORY, None, **options)
+                seconds = time.perf_counter() - start
+                paths = {name: os.path.join(subject_directory, STEPS[1], file_name)
+                         for name, file_name in [('t1', 't1q_cor.nii.gz'), ('r1', 'R1q_cor.nii.gz')]}
+                maps = {name: nib.load(path).get_fdata() for name, path in paths.items()}
+                if reference is None:
+                    reference = dict(zip(['t1', 'r1'], float64_reference(subject_directory, param_system, options)))
+                run = {'size': size, 'shape': list(shape), 'voxel_size': list(voxel_size), 'b1_shape': list(b1_shape),
+                       'repeat': repeat, 'wall_s': round(seconds, 3),
+                       'stages': summarize(tracer.events)['stages'], 'accuracy': accuracy(maps['t1'], T1, tissues),
+                       'float64_difference': {'head': difference(maps, reference, T1 > 0),
+                                              'image': difference(maps, reference, np.ones(shape, bool))},
+                       'output_mb': {name: round(os.path.getsize(path) / 1e6, 3) for name, path in paths.items()}}
+                results['runs'].append(run)
+                print('INFO : {} phantom, run {} : {:.2f} s, mean T1 error {}'
+                      .format(size, repeat + 1, seconds,
+                              ', '.join('{} {:.1f} ms'.format(name, error['mean_absolute_error_ms'])
+                                        for name, error in run['accuracy'].items())))
+                del maps
+            del T1, tissues, reference
+    finally:
+        if directory is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if output_path is not None:
+        with open(output_path, 'w') as f:
+            json.dump(results, f, indent=1)
+        print('INFO : Benchmark results saved in {}'.format(output_path))
+    return results
@@ -0,0 +1,226 @@
+# Module
+import os
+import csv
+import glob
+import time
+import sqlite3
+import contextlib
+import numpy as np
+
+import hiplay
+from hiplay.roi_statistics import read_statistics_table, PERCENTILES, TABLE_FORMATS
+from hiplay.manifest import read_manifest
+
+# name of the store in the main output folder
+COHORT_STORE_NAME = 'cohort_results.sqlite'
+
+# version of the results whose step manifest does not give the version of hiplay which computed them
+UNKNOWN_VERSION = 'unknown'
+
+# folder and name (without extension) of the table of the statistics of a subject
+RESULTS_STEP = '4.Myelin_proxy'
+RESULTS_TABLE = 'R1_per_regions'
+
+# statistics stored for each region
+STATISTICS = ['count', 'volume_mm3', 'mean', 'std', 'min', 'max', 'median'] + ['p{:g}'.format(q) for q in PERCENTILES]
+
+
+def results_version(table_path):
+    """
+    return the version of hiplay which computed a table of statistics, read in the manifest of its step folder (see
+    hiplay.manifest), or UNKNOWN_VERSION for the results without manifest (e.g. computed before the manifests)
+    """
+    manifest = read_manifest(os.path.dirname(os.path.abspath(table_path))) or {}
+    return (manifest.get('tool_versions') or {}).get('hiplay') or UNKNOWN_VERSION
+
+
+def find_result_tables(output_folder):
+    """
+    Find the tables of statistics of the subject folders of an output folder, in all the formats (TABLE_FORMATS)
+
+    Returns
+    ---------
+        tables : dict
+            path of the table of each subject (the last modified one if the subject has several formats)
+
+    """
+    tables = {}
+    for table_format in TABLE_FORMATS:
+        pattern = os.path.join(output_folder, '*', RESULTS_STEP, '{}.{}'.format(RESULTS_TABLE, table_format))
+        for table_path in glob.glob(pattern):
+            subject = os.path.basename(os.path.dirname(os.path.dirname(table_path)))
+            if subject not in tables or os.path.getmtime(table_path) > os.path.getmtime(tables[subject]):
+                tables[subject] = table_path
+    return dict(sorted(tables.items()))
+
+
+class CohortStore(object):
+    """
+    Results of all the subjects of an output folder in one SQLite file
+
+    Each subject adds the statistics of its regions (see hiplay.roi_statistics) when its step 4.Myelin_proxy is done,
+    keyed by subject (date_NIP), atlas, label and version of hiplay. The tables of a cohort are then read from this
+    file only, without opening the folders of the subjects.
+
+    Parameters
+    ----------
+        output_folder : string
+            main output folder of the pipeline, where the store is created
+        store_path : string
+            path of the SQLite file. Default is cohort_results.sqlite in output_folder
+
+    Example
+    ---------
+        with CohortStore('/home/Documents/Hiplay_results') as store:
+            regions, subjects, table = store.group_table('dkt', 'mean')
+
+    """
+
+    def __init__(self, output_folder=None, store_path=None):
+        if store_path is None:
+            store_path = os.path.join(output_folder, COHORT_STORE_NAME)
+        self.store_path = store_path
+        self.connection = sqlite3.connect(store_path, timeout=60)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS subjects '
+                                    '(subject TEXT, version TEXT, added REAL, source TEXT, '
+                                    'PRIMARY KEY (subject, version))')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS statistics '
+                                    '(subject TEXT, version TEXT, atlas TEXT, label INTEGER, name TEXT, {}, '
+                                    'PRIMARY KEY (subject, version, atlas, label))'
+                                    .format(', '.join('{} REAL'.format(column) for column in STATISTICS)))
+            self.connection.execute('CREATE INDEX IF NOT EXISTS statistics_atlas ON statistics (atlas, version)')
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add_subject(self, subject, rows, version=None, source=None):
+        """
+        Add (or replace) the statistics of a subject
+
+        Parameters
+        ----------
+            subject : string
+                subject identifier in format date_NIP
+            rows : list of dict
+                statistics of the regions, as returned by hiplay.roi_statistics.atlas_statistics
+            version : string
+                version of the pipeline which computed the statistics. Default is the installed hiplay version
+            source : string
+                file the statistics were read from (optional)
+
+        """
+        version = version or hiplay.__version__
+        values = [(subject, version, row['atlas'], int(row['label']), row['name']) +
+                  tuple(row.get(column) for column in STATISTICS) for row in rows]
+        with self.connection:
+            self.connection.execute('DELETE FROM statistics WHERE subject = ? AND version = ?', (subject, version))
+            self.connection.executemany('INSERT INTO statistics VALUES ({})'.format(', '.join(['?'] * (5 + len(STATISTICS)))),
+                                        values)
+            self.connection.execute('INSERT OR REPLACE INTO subjects VALUES (?, ?, ?, ?)',
+                                    (subject, version, time.time(), source))
+
+    def add_table(self, subject, table_path, version=None):
+        """
+        add the statistics of a subject from its table R1_per_regions.tsv (or .parquet). Default version is the one
+        which computed the table (see results_version)
+        """
+        version = version or results_version(table_path)
+        self.add_subject(subject, read_statistics_table(table_path), version, os.path.abspath(table_path))
+
+    def remove_subject(self, subject, version=None):
+        """remove a subject (all its versions if version is None)"""
+        with self.connection:
+            for table in ['statistics', 'subjects']:
+                if version is None:
+                    self.connection.execute('DELETE FROM {} WHERE subject = ?'.format(table), (subject,))
+                else:
+                    self.connection.execute('DELETE FROM {} WHERE subject = ? AND version = ?'.format(table),
+                                            (subject, version))
+
+    def subjects(self, version=None):
+        """return the subjects of the store as a list of (subject, version, time added), ordered by subject"""
+        if version is None:
+            return self.connection.execute('SELECT subject, version, added FROM subjects '
+                                           'ORDER BY subject, added').fetchall()
+        return self.connection.execute('SELECT subject, version, added FROM subjects WHERE version = ? '
+                                       'ORDER BY subject', (version,)).fetchall()
+
+    def atlases(self):
+        """return the names of the atlases in the store"""
+        return [row[0] for row in self.connection.execute('SELECT DISTINCT atlas FROM statistics ORDER BY atlas')]
+
+    def group_table(self, atlas, statistic='mean', version=None, subjects=None):
+        """
+        Return a table of a statistic in the regions of an atlas (rows) for the subjects of the store (columns)
+
+        Parameters
+        ----------
+            atlas : string
+                name of the atlas (e.g. 'dkt', 'hippo_lh', 'hippo_rh')
+            statistic : string
+                one of STATISTICS
+            version : string
+                only use the results of this version of the pipeline. Default uses the last version added for
+                each subject
+            subjects : list of strings
+                only return these subjects. Default returns all the subjects of the store
+
+        Returns
+        ---------
+            regions : list of (label, name)
+            subjects : list of strings
+            table : array (n_regions, n_subjects)
+                value of the statistic, NaN for the regions missing in a subject
+
+        """
+        if statistic not in STATISTICS:
+            raise ValueError('Unknown statistic {}, choose one of {}'.format(statistic, STATISTICS))
+        if version is None:
+            # last version added for each subject
+            selected = 'SELECT subject, version FROM subjects AS s WHERE added = ' \
+                       '(SELECT MAX(added) FROM subjects WHERE subject = s.subject)'
+            parameters = ()
+        else:
+            selected = 'SELECT subject, version FROM subjects WHERE version = ?'
+            parameters = (version,)
+        rows = self.connection.execute(
+            'SELECT st.subject, st.label, st.name, st.{} FROM statistics AS st '
+            'JOIN ({}) AS sel ON st.subject = sel.subject AND st.version = sel.version '
+            'WHERE st.atlas = ?'.format(statistic, selected), parameters + (atlas,)).fetchall()
+        if subjects is not None:
+            wanted = set(subjects)
+            rows = [row for row in rows if row[0] in wanted]
+
+        present = set(row[0] for row in rows)
+        subject_names = sorted(present) if subjects is None else [s for s in subjects if s in present]
+        names = {}
+        for row in rows:
+            names.setdefault(row[1], row[2])
+        regions = sorted(names.items())
+        subject_index = {name: i for i, name in enumerate(subject_names)}
+        region_index = {label: i for i, (label, _) in enumerate(regions)}
+        table = np.full((len(regions), len(subject_names)), np.nan)
+        for subject, label, _, value in rows:
+            table[region_index[label], subject_index[subject]] = np.nan if value is None else value
+        return regions, subject_names, table
+
+
+def write_group_table(file_path, regions, subjects, table):
+    """
+    Write a table returned by CohortStore.group_table in a tab separated text file (one row per region)
+
+    file_path can also be an open file (e.g. sys.stdout)
+    """
+    with contextlib.ExitStack() as stack:
+        f = file_path if hasattr(file_path, 'write') else stack.enter_context(open(file_path, 'w', newline=''))
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(['label', 'name'] + list(subjects))
+        for (label, name), values in zip(regions, table):
+            writer.writerow([label, name] + ['' if np.isnan(value) else '{:.6g}'.format(value) for value in values])
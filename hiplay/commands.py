@@ -0,0 +1,242 @@
+# Module
+import os
+import time
+import shlex
+import asyncio
+import resource
+import functools
+import subprocess as sub
+
+from hiplay.instrumentation import get_tracer
+
+# folder of each subject where the output of the external commands is written (one log file per tool)
+LOG_DIRECTORY = 'logs'
+
+# maximum duration of the external commands in seconds (None : no limit)
+TIMEOUTS = {'recon-all': 72 * 3600, 'hippocampal-subfields': 12 * 3600, 'flirt': 3600}
+
+# seconds given to a command to stop after SIGTERM (timeout or cancellation) before it is killed
+TERMINATE_DELAY = 10
+
+# commands running in the process, to know if the CPU time of the children belongs to a single command
+_running = {}
+
+
+@functools.lru_cache(maxsize=None)
+def _sourced_environment(setup_script, variables):
+    """environment after sourcing setup_script in bash with the extra variables (tuple of (name, value))"""
+    base = dict(os.environ, **dict(variables))
+    if not os.path.isfile(setup_script):
+        print('WARNING : Could not find {}, the current environment is used'.format(setup_script))
+        return base
+    script = '. {} > /dev/null 2>&1; env -0'.format(shlex.quote(setup_script))
+    output = sub.run(['bash', '-c', script], env=base, stdout=sub.PIPE, check=True).stdout
+    return dict(line.split('=', 1) for line in output.decode(errors='replace').split('\0') if '=' in line)
+
+
+def tool_environment(setup_script, **variables):
+    """
+    Return the environment of a tool initialised by its setup script (e.g. fsl.sh or SetUpFreeSurfer.sh)
+
+    The script is sourced once per process in bash, with the variables added to the current environment, and the
+    resulting environment is reused by all the commands of the tool, which are then run without a shell.
+
+    Returns
+    ---------
+        environment : dict
+            copy of the environment of the tool (can be modified by the caller)
+
+    """
+    return dict(_sourced_environment(setup_script, tuple(sorted(variables.items()))))
+
+
+def fsl_environment(fslHome):
+    """return the environment of the FSL installation fslHome (see tool_environment)"""
+    environment = tool_environment(os.path.join(fslHome, 'etc', 'fslconf', 'fsl.sh'), FSLDIR=fslHome)
+    environment['PATH'] = os.pathsep.join([os.path.join(fslHome, 'bin'), environment.get('PATH', '')])
+    return environment
+
+
+def freesurfer_environment(freesurferHome):
+    """return the environment of the freesurfer installation freesurferHome (see tool_environment)"""
+    return tool_environment(os.path.join(freesurferHome, 'SetUpFreeSurfer.sh'), FREESURFER_HOME=freesurferHome)
+
+
+def subject_log(subject_directory, name):
+    """return the path of the log of the commands name in the folder of a subject (the folder is created)"""
+    log_directory = os.path.join(subject_directory, LOG_DIRECTORY)
+    os.makedirs(log_directory, exist_ok=True)
+    return os.path.join(log_directory, '{}.log'.format(name))
+
+
+async def _copy_stream(stream, log):
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            return
+        log.write(chunk)
+        log.flush()
+
+
+async def _terminate(process):
+    """stop a process with SIGTERM, then SIGKILL if it is still running after TERMINATE_DELAY seconds"""
+    if process.returncode is not None:
+        return
+    try:
+        process.terminate()
+        await asyncio.wait_for(process.wait(), TERMINATE_DELAY)
+    except ProcessLookupError:
+        pass
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+
+
+async def run_async(command, env=None, log_path=None, timeout=None, name=None, cwd=None, check=True):
+    """
+    Run an external program without shell and record its duration and exit status (see hiplay.instrumentation)
+
+    If the command is cancelled (e.g. another command of run_commands failed) or lasts longer than timeout, the
+    program is terminated before the exception is raised.
+
+    Parameters
+    ----------
+        command : list of strings
+            program and its arguments
+        env : dict
+            environment of the program (see tool_environment). Default is the current environment
+        log_path : string
+            file where the standard output and error of the program are appended (see subject_log). Default prints
+            them in the terminal
+        timeout : float
+            maximum duration in seconds. None waits until the end of the program
+        name : string
+            name of the command in the trace and in the log. Default is the name of the program
+        cwd : string
+            working directory of the program
+        check : bool
+            raise a subprocess.CalledProcessError if the program fails
+
+    Returns
+    ---------
+        returncode : int
+            exit status of the program
+
+    """
+    command = [str(argument) for argument in command]
+    if name is None:
+        name = os.path.basename(command[0])
+    log = None
+    if log_path is not None:
+        log = open(log_path, 'ab')
+        log.write('\n### {} {} : {}\n'.format(time.strftime('%Y-%m-%d %H:%M:%S'), name,
+                                             ' '.join(shlex.quote(argument) for argument in command)).encode())
+        log.flush()
+
+    key = object()
+    for other in _running:
+        _running[other] = True
+    _running[key] = bool(_running)
+    start = time.time()
+    wall = time.perf_counter()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    returncode = None
+    try:
+        output = sub.PIPE if log is not None else None
+        process = await asyncio.create_subprocess_exec(*command, env=env, cwd=cwd, stdout=output,
+                                                       stderr=sub.STDOUT if log is not None else None)
+        waits = [process.wait()] + ([_copy_stream(process.stdout, log)] if log is not None else [])
+        try:
+            await asyncio.wait_for(asyncio.gather(*waits), timeout)
+        except asyncio.TimeoutError:
+            await _terminate(process)
+            raise sub.TimeoutExpired(command, timeout)
+        except asyncio.CancelledError:
+            await _terminate(process)
+            raise
+        finally:
+            returncode = process.returncode
+    finally:
+        wall = time.perf_counter() - wall
+        overlapped = _running.pop(key)
+        if log is not None:
+            log.write('### {} ended with status {} after {:.1f} s\n'.format(name, returncode, wall).encode())
+            log.close()
+        tracer = get_tracer()
+        if tracer is not None:
+            cpu = None
+            if not overlapped:
+                children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+                cpu = (children_end.ru_utime - children.ru_utime) + (children_end.ru_stime - children.ru_stime)
+            tracer.add_command(name, ' '.join(command), start, wall, returncode, cpu)
+    if check and returncode != 0:
+        raise sub.CalledProcessError(returncode, command)
+    return returncode
+
+
+async def gather_commands(commands, max_concurrent=None):
+    """
+    Run independent commands at the same time, at most max_concurrent at once
+
+    commands is a list of dict with the arguments of run_async. max_concurrent defaults to the number of cores
+    (os.cpu_count()) : on a single core machine the commands then run one after the other, give max_concurrent
+    explicitly for commands which mostly wait (e.g. I/O). If a command fails, the other ones are cancelled (their
+    programs are terminated) and the exception is raised.
+    """
+    semaphore = asyncio.Semaphore(max_concurrent or os.cpu_count() or 1)
+
+    async def run(arguments):
+        async with semaphore:
+            return await run_async(**arguments)
+
+    tasks = [asyncio.ensure_future(run(arguments)) for arguments in commands]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def _run(coroutine):
+    """run a coroutine until its end in a new event loop, raise a RuntimeError if an event loop is already running"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    coroutine.close()
+    raise RuntimeError('The external commands cannot be run synchronously from a running event loop, await '
+                       'run_async or gather_commands instead')
+
+
+def run_tool(command, **kwargs):
+    """
+    Run one external program and wait for its end (see run_async for the arguments), return its exit status
+
+    The program is run in its own event loop : run_tool cannot be called from a coroutine (e.g. in a notebook or an
+    asyncio application), which must await run_async instead.
+    """
+    return _run(run_async(command, **kwargs))
+
+
+def run_commands(commands, max_concurrent=None):
+    """
+    Run independent external programs concurrently and wait for their end (see gather_commands)
+
+    Like run_tool, run_commands cannot be called from a running event loop (await gather_commands instead).
+
+    Example
+    ---------
+        environment = freesurfer_environment(freesurferHome)
+        run_commands([{'command': ['mri_convert', path, path.replace('.mgz', '.nii.gz')], 'env': environment,
+                       'log_path': subject_log(subject_directory, 'mri_convert')} for path in paths],
+                     max_concurrent=4)
+
+    Returns
+    ---------
+        returncodes : list of int
+            exit status of each command
+
+    """
+    return _run(gather_commands(commands, max_concurrent))
@@ -1,7 +1,87 @@
 import os
-import subprocess as sub
+import time
+import contextlib
+import numpy as np
+import nibabel as nib
 
-def apply_processResults(path_directory, steps, freesurf_output_dir, subj_name, freesurferHome):
+from hiplay.roi_statistics import (read_color_lut, atlas_statistics, write_statistics_table, write_segstats_sum,
+                                   TABLE_FORMATS)
+from hiplay.resampling import resample_nearest
+from hiplay.cortical_profiles import compute_depth_profiles, PROFILE_COLUMNS
+from hiplay.nifti_io import iter_slabs, NiftiSlabWriter
+from hiplay.instrumentation import stage
+
+# labels of the freesurfer segmentation (aseg) corresponding to cerebrospinal fluid : ventricles and CSF
+CSF_LABELS = [4, 5, 14, 15, 24, 43, 44, 72]
+
+
+def register_to_original(input_path, ref_img, output_path):
+    """
+    Resample a freesurfer volume (labels or mask) in the original space of the subject with a nearest neighbour
+    interpolation, like "mri_convert -rt nearest -rl", and save it in output_path
+
+    The voxel mapping is shared by all the volumes with the same geometry (see hiplay.resampling.resample_nearest)
+
+    Returns
+    ---------
+        data : array
+            resampled volume, in the data type of the input volume
+
+    """
+    with stage('resampling', image=os.path.basename(input_path)):
+        img = nib.load(input_path)
+        data = resample_nearest(np.asanyarray(img.dataobj), img.affine, ref_img.shape[:3], ref_img.affine)
+    with stage('write', image=os.path.basename(output_path)):
+        new_img = nib.MGHImage(data, ref_img.affine, ref_img.header)
+        new_img.header.set_data_dtype(data.dtype)
+        nib.save(new_img, output_path)
+    return data
+
+
+def apply_skullstrip(input_paths, output_paths, mask, slab_size=None):
+    """
+    Apply a brain mask on several images of the same grid (e.g. T1 and R1 maps) in a single pass over their slabs
+
+    Parameters
+    ----------
+        input_paths : list of strings
+            paths of the images to mask (nifti)
+        output_paths : list of lists of strings
+            for each image, the paths of the masked images, one per mask
+        mask : array of bool (nx, ny, nz) or list of arrays
+            brain mask, or several masks (e.g. with and without CSF), in the grid of the images
+        slab_size : int
+            number of slices processed at a time. None processes the whole volume at once
+
+    Raises a RuntimeError with the time spent if the masking fails (missing image, different grids, ...)
+
+    """
+    start = time.time()
+    masks = [mask] if isinstance(mask, np.ndarray) else list(mask)
+    try:
+        images = [nib.load(path) for path in input_paths]
+        for path, img in zip(input_paths, images):
+            for m in masks:
+                if img.shape[:3] != m.shape:
+                    raise ValueError('{} has shape {}, the brain mask has shape {}'.format(path, img.shape, m.shape))
+        with contextlib.ExitStack() as stack:
+            writers = [[stack.enter_context(NiftiSlabWriter(path, img.shape[:3], img.affine, img.header))
+                        for path in paths] for img, paths in zip(images, output_paths)]
+            for slabs in zip(*[iter_slabs(path, slab_size) for path in input_paths]):
+                z_start, z_stop = slabs[0][:2]
+                for (_, _, slab), image_writers in zip(slabs, writers):
+                    for m, writer in zip(masks, image_writers):
+                        writer.write(np.where(m[:, :, z_start:z_stop], slab, 0))
+    except Exception as error:
+        raise RuntimeError('Skull-stripping of {} failed after {:.1f} s : {}'
+                           .format(', '.join(os.path.basename(path) for path in input_paths), time.time() - start,
+                                   error)) from error
+    print('INFO : Skull-stripping of {} done in {:.1f} s'
+          .format(', '.join(os.path.basename(path) for path in input_paths), time.time() - start))
+
+
+def apply_processResults(path_directory, steps, freesurf_output_dir, subj_name, freesurferHome, table_format='tsv',
+                         exclude_csf=False, slab_size=None, n_depths=0, depth_method='equivolume'):
     """
     Skull-stripped and remove CSF from R1 and T1 maps.
     Register the ROI in the original space of the T1 map
@@ -19,6 +99,16 @@ def apply_processResults(path_directory, steps, freesurf_output_dir, subj_name,
        subject folder name. Should looks like date_NIP.
     freesurferHome : string
         path of the freesurfer installation folder
+    table_format : string
+        format of the tables of statistics, 'tsv' or 'parquet' (requires pyarrow)
+    exclude_csf : bool
+        also save the T1 and R1 maps without the CSF (ventricles and voxels outside of the segmentation)
+    slab_size : int
+        number of slices masked at a time. None processes the whole volume at once
+    n_depths : int
+        number of cortical depths where the R1 profiles are sampled (see hiplay.cortical_profiles). 0 : no profiles
+    depth_method : string
+        placement of the depths between the pial and white surfaces, 'equivolume' or 'equidistant'
 
 
     Outputs
@@ -32,11 +122,18 @@ def apply_processResults(path_directory, steps, freesurf_output_dir, subj_name,
      Compute the following output in the folder "4.Results" of the subject directory :
             R1q_cor_clean.nii.gz: Final R1 map skull-stripped
             T1q_cor_clean.nii.gz: Final T1 map skull-stripped
+            (optional) R1q_cor_clean_nocsf.nii.gz, t1q_cor_clean_nocsf.nii.gz : maps skull-stripped without CSF
             R1_per_regions_dkt.txt : text file with the average R1 values on the cortical ROIs
             R1_per_regions_hippo_lh.txt : text file with the average R1 values on the left hippocampal ROIs
             R1_per_regions_hippo_rh.txt : text file with the average R1 values on the right hippocampal ROIs
+            R1_per_regions.tsv (or .parquet) : table of the R1 statistics (count, volume, mean, std, min, max, median
+                                               and percentiles) in the regions of all the atlases
+            (optional) R1_depth_profiles.tsv (or .parquet) : table of the R1 statistics at each cortical depth in
+                                               the regions of the DKT atlas of the surfaces
 
     """
+    if table_format not in TABLE_FORMATS:
+        raise ValueError('Unknown table format {}, choose one of {}'.format(table_format, TABLE_FORMATS))
     
     freesurfer_subj = os.path.join(freesurf_output_dir, subj_name)
     
@@ -48,57 +145,25 @@ def apply_processResults(path_directory, steps, freesurf_output_dir, subj_name,
     mask_path = os.path.join(freesurfer_subj, 'mri/brainmask.mgz')                         # mask of gm+wm (remove CSF and skull)
     mask_new_path = os.path.join(path_directory, steps[2], 'brainmask_orig.mgz')
 
-    mrisconvert = format("{}/bin/mri_convert -rt nearest -rl {} {} {}"
-                         .format(freesurferHome, ref_path, mask_path, mask_new_path ))
-    try:
-        sub.check_call(mrisconvert, shell=True)
-    except sub.CalledProcessError:
-        pass
-
-
-    ## Apply brain mask on T1 and R1
-    input_path = os.path.join(path_directory, steps[1], 't1q_cor.nii.gz')
-    output_path = os.path.join(path_directory, steps[3], 't1q_cor_clean.nii.gz')
-
-    mrisCalc = format("{}/bin/mris_calc -o {} {} masked"
-                      .format(freesurferHome, output_path, input_path, mask_new_path))
-    try:
-        sub.check_call(mrisCalc, shell=True)
-    except sub.CalledProcessError:
-        pass
-
-
-    del input_path, output_path
+    ref_img = nib.load(ref_path)
+    brain_mask = register_to_original(mask_path, ref_img, mask_new_path) > 0
 
 
-    ## Apply brain mask on R1
-    input_path = os.path.join(path_directory, steps[1], 'R1q_cor.nii.gz')
-    output_path = os.path.join(path_directory, steps[3], 'R1q_cor_clean.nii.gz')
-
-    mrisCalc = format("{}/bin/mris_calc -o {} {} masked"
-                      .format(freesurferHome, output_path, input_path, mask_new_path))
-    try:
-        sub.check_call(mrisCalc, shell=True)
-    except sub.CalledProcessError:
-        pass
-
-    ## Compute R1 values in differents region of the cotex and hippocampus
+    ## Register the atlases in the original space
     atlas = ['hippo_lh', 'hippo_rh', 'dkt']                                                 # anytging else would perform the destrieux atlas
+    seg_file_paths = {}
+    atlases = {}
     for i in range(len(atlas)):
         if atlas[i] == 'dkt':
-            print('INFO : Compute statistics in DKT atlas')
             input_name = 'mri/aparc.DKTatlas+aseg.mgz'                              # for DKT atlas
             output_name = 'seg_DKT_orig.mgz'
         elif atlas[i] == 'hippo_lh':
-            print('INFO : Compute statistics in left hippocampus atlas')
             input_name = 'mri/lh.hippoSfLabels-T1.v10.mgz'                          # for left hippocampus atlas
             output_name = 'seg_hippo_lh_orig.mgz'
         elif atlas[i] == 'hippo_rh':
-            print('INFO : Compute statistics in right hippocampus atlas')
             input_name = 'mri/rh.hippoSfLabels-T1.v10.mgz'                          # for right hippocampus atlas
             output_name = 'seg_hippo_rh_orig.mgz'
         else:
-            print('INFO : Compute statistics in Destrieux atlas')
             input_name = 'mri/aseg.mgz'  # for Destrieux atlas                      # for Destrieux atlas
             output_name = 'seg_Destrieux_orig.mgz'
 
@@ -106,29 +171,54 @@ def apply_processResults(path_directory, steps, freesurf_output_dir, subj_name,
         output_path = os.path.join(path_directory, steps[2], output_name)
 
         # Register atlas labels to original space
-        mrisconvert = format("{}/bin/mri_convert -rt nearest -rl {} {} {}"
-                             .format(freesurferHome, ref_path, input_path, output_path))
-        try:
-            sub.check_call(mrisconvert, shell=True)
-        except sub.CalledProcessError:
-            pass
-
-
-        # Compute statistics on volume
-        input_name = 'R1q_cor.nii.gz'
-        input_path = os.path.join(path_directory, steps[1], input_name)
-        seg_file_path = output_path                                                  # files which contains the labels on the original space
-        output_name = 'R1_per_regions_{}.txt'.format(atlas[i])
-        output_path = os.path.join(path_directory, steps[3], output_name)
-
-        color_labels = os.path.join(freesurferHome, 'FreeSurferColorLUT.txt')
-        mrisegstats = format("{}/bin/mri_segstats --seg {} --sum {} --i {} --ctab {}"
-                             .format(freesurferHome, seg_file_path, output_path, input_path, color_labels))
-
-        try:
-            sub.check_call(mrisegstats, shell=True)
-            print("INFO : Print mean R1 regions values from {} atlas in {}".format(atlas[i], output_name))
-        except sub.CalledProcessError:
-            pass
-
+        atlases[atlas[i]] = register_to_original(input_path, ref_img, output_path)
+        seg_file_paths[atlas[i]] = output_path                                     # files which contains the labels on the original space
 
+    ## Apply brain mask on T1 and R1
+    maps = ['t1q_cor', 'R1q_cor']
+    masks = [brain_mask]
+    suffixes = ['_clean']
+    if exclude_csf:
+        # remove the ventricles and the voxels outside of the segmentation (sulcal CSF)
+        segmentation = atlases['dkt']
+        masks.append(brain_mask & (segmentation > 0) & ~np.isin(segmentation, CSF_LABELS))
+        suffixes.append('_clean_nocsf')
+    with stage('skull-stripping'):
+        apply_skullstrip([os.path.join(path_directory, steps[1], name + '.nii.gz') for name in maps],
+                         [[os.path.join(path_directory, steps[3], name + suffix + '.nii.gz') for suffix in suffixes]
+                          for name in maps],
+                         masks, slab_size)
+    del masks
+
+    ## Compute statistics of R1 in the regions of all the atlases, reading the R1 map once
+    print('INFO : Compute statistics in {} atlases'.format(', '.join(atlas)))
+    input_path = os.path.join(path_directory, steps[1], 'R1q_cor.nii.gz')
+    r1_img = nib.load(input_path)
+    R1map = np.asanyarray(r1_img.dataobj, dtype=np.float32)
+    color_labels = os.path.join(freesurferHome, 'FreeSurferColorLUT.txt')
+    names = read_color_lut(color_labels) if os.path.isfile(color_labels) else {}
+    voxel_volume = float(np.prod(r1_img.header.get_zooms()[:3]))
+    with stage('statistics'):
+        rows = atlas_statistics(R1map, atlases, names, voxel_volume)
+
+    # One table for all the atlases and one file per atlas in the summary format of mri_segstats
+    table_path = os.path.join(path_directory, steps[3], 'R1_per_regions.{}'.format(table_format))
+    with stage('write', image=os.path.basename(table_path)):
+        write_statistics_table(table_path, rows)
+        for name in atlas:
+            output_name = 'R1_per_regions_{}.txt'.format(name)
+            write_segstats_sum(os.path.join(path_directory, steps[3], output_name),
+                               [row for row in rows if row['atlas'] == name], seg_file_paths[name], input_path,
+                               color_labels)
+            print("INFO : Print mean R1 regions values from {} atlas in {}".format(name, output_name))
+    print("INFO : Statistics of all the atlases saved in {}".format(table_path))
+
+    ## Sample the skull-stripped R1 map across the cortical depth
+    if n_depths:
+        profile_rows = compute_depth_profiles(freesurfer_subj,
+                                              os.path.join(path_directory, steps[3], 'R1q_cor_clean.nii.gz'),
+                                              n_depths, depth_method)
+        profile_path = os.path.join(path_directory, steps[3], 'R1_depth_profiles.{}'.format(table_format))
+        with stage('write', image=os.path.basename(profile_path)):
+            write_statistics_table(profile_path, profile_rows, PROFILE_COLUMNS)
+        print("INFO : R1 profiles at {} cortical depths saved in {}".format(n_depths, profile_path))
@@ -0,0 +1,145 @@
+# Module
+import os
+import re
+import sys
+import json
+
+# file of the cache directory where the versions of the tool installations already read are recorded
+TOOL_VERSIONS_NAME = 'tool_versions.json'
+
+
+def get_cache_directory():
+    """
+    Return the directory where hiplay stores its persistent caches (lookup tables, indexes, ...)
+
+    The directory can be set with the environment variable HIPLAY_CACHE_DIR. By default it is ~/.cache/hiplay.
+    The directory is created if it does not exist.
+
+    """
+    cache_directory = os.environ.get('HIPLAY_CACHE_DIR',
+                                     os.path.join(os.path.expanduser('~'), '.cache', 'hiplay'))
+    os.makedirs(cache_directory, exist_ok=True)
+    return cache_directory
+
+
+def cached_tool_version(version_file, read_version):
+    """
+    Return the version of a tool installation read in version_file by read_version(version_file)
+
+    The versions are recorded in TOOL_VERSIONS_NAME of the cache directory with the modification time and size of
+    their file : the file is only read again when it changes (e.g. the tool is updated in the same folder).
+
+    Returns
+    ---------
+        version : string
+            version of the tool, None if version_file does not exist or contains no version
+
+    """
+    try:
+        status = os.stat(version_file)
+    except OSError:
+        return None
+    key = os.path.realpath(version_file)
+    signature = [status.st_mtime_ns, status.st_size]
+    cache_path = os.path.join(get_cache_directory(), TOOL_VERSIONS_NAME)
+    try:
+        with open(cache_path) as f:
+            versions = json.load(f)
+    except (OSError, ValueError):
+        versions = {}
+    entry = versions.get(key)
+    if entry is not None and entry.get('signature') == signature:
+        return entry['version']
+
+    version = read_version(version_file)
+    versions[key] = {'signature': signature, 'version': version}
+    try:
+        with open(cache_path + '.{}.tmp'.format(os.getpid()), 'w') as f:
+            json.dump(versions, f, indent=1)
+        os.replace(cache_path + '.{}.tmp'.format(os.getpid()), cache_path)
+    except OSError:
+        pass
+    return version
+
+
+def _read_freesurfer_version(file_path):
+    pattern = re.compile('^v([0-9]+)([.])([0-9]+)([.])([0-9]+)?$')
+    try:
+        data = open(file_path).read().split("-")
+    except OSError:
+        return None
+    versions = [pattern.search(f).group() for f in data if pattern.search(f) is not None]
+    return versions[0] if versions else None
+
+
+def _read_fsl_version(file_path):
+    pattern = re.compile('^([0-9]+)([.])([0-9]+)([.])([0-9]+)?$')
+    try:
+        data = open(file_path).read().split()
+    except OSError:
+        return None
+    versions = [pattern.search(f).group() for f in data if pattern.search(f) is not None]
+    return versions[0] if versions else None
+
+
+def get_freesurfer_version(freesurferHome):
+    """
+    return the version of freesurfer (e.g. 'v6.0.0') read in build-stamp.txt, or None if it cannot be read
+    (cached, see cached_tool_version)
+    """
+    return cached_tool_version(os.path.join(freesurferHome, 'build-stamp.txt'), _read_freesurfer_version)
+
+
+def get_fsl_version(fslHome):
+    """
+    return the version of fsl (e.g. '6.0.0') read in etc/fslversion, or None if it cannot be read
+    (cached, see cached_tool_version)
+    """
+    return cached_tool_version(os.path.join(fslHome, 'etc/fslversion'), _read_fsl_version)
+
+
+def get_package_version(name):
+    """return the installed version of a python package, or None if it is not installed"""
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:
+        import pkg_resources
+        try:
+            return pkg_resources.get_distribution(name).version
+        except pkg_resources.DistributionNotFound:
+            return None
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return None
+
+
+def check_version(freesurferHome, fslHome, fsl_required=True):
+    """
+    Check the versions of freesurfer and fsl, and exit with an error if they are not the required ones (used by the
+    scripts before they start any processing)
+
+    FSL is only checked when fsl_required (the B1 map is resampled with flirt), the native resampling does not use it.
+    """
+
+    #Global version
+    glob_version_freesurfer='v6.0.0'
+    glob_version_fsl = '6.0.0'
+
+    #Freesurfer
+    version_freesurfer = get_freesurfer_version(freesurferHome)
+    if version_freesurfer != glob_version_freesurfer:
+        print('ERROR : The scripts required version {} of freesurfer and version {} has been given'.format(glob_version_freesurfer,version_freesurfer))
+        sys.exit(1)
+    else:
+        print('Use of Freesurfer {} find at {}'.format(glob_version_freesurfer,freesurferHome))
+
+    #fsl, only used by the flirt resampling of the B1 map
+    if not fsl_required:
+        return
+    version_fsl = get_fsl_version(fslHome)
+    if version_fsl != glob_version_fsl:
+        print('ERROR : The B1 resampling with flirt required version {} of fsl and version {} has been given'.format(glob_version_fsl, version_fsl))
+        sys.exit(1)
+    else:
+        print('Use of FSL {} find at {}'.format(glob_version_fsl,fslHome))
@@ -0,0 +1,260 @@
+# Module
+import os
+import numpy as np
+import nibabel as nib
+
+from hiplay.roi_statistics import label_statistics, PERCENTILES
+from hiplay.resampling import trilinear_sample
+from hiplay.instrumentation import stage
+
+# methods placing the intermediate surfaces between the pial and the white surfaces
+DEPTH_METHODS = ['equivolume', 'equidistant']
+
+# hemispheres of the freesurfer surfaces, and offset of their cortical labels in aparc.DKTatlas+aseg (ctx-lh-*, ...)
+HEMISPHERES = {'lh': 1000, 'rh': 2000}
+
+# minimum fraction of the interpolation weights inside the map for a sample to be kept (see sample_volume)
+MIN_WEIGHT = 0.5
+
+# columns of the table of the depth profiles
+PROFILE_COLUMNS = ['hemisphere', 'label', 'name', 'depth_index', 'depth', 'count', 'mean', 'std', 'min', 'max',
+                   'median'] + ['p{:g}'.format(q) for q in PERCENTILES]
+
+
+def read_surface(surface_path):
+    """read a freesurfer surface (e.g. surf/lh.white), return its vertices (n, 3) in tkRAS (mm) and faces (m, 3)"""
+    vertices, faces = nib.freesurfer.read_geometry(surface_path)
+    return vertices.astype(np.float64), faces.astype(np.int64)
+
+
+def vertex_areas(vertices, faces):
+    """return the area of each vertex of a mesh : a third of the area of the triangles which contain it"""
+    edges_1 = vertices[faces[:, 1]] - vertices[faces[:, 0]]
+    edges_2 = vertices[faces[:, 2]] - vertices[faces[:, 0]]
+    triangle_areas = 0.5 * np.linalg.norm(np.cross(edges_1, edges_2), axis=1)
+    return np.bincount(faces.ravel(), np.repeat(triangle_areas / 3., 3), minlength=len(vertices))
+
+
+def depth_fractions(n_depths):
+    """return the depths of n_depths intermediate surfaces : the centres of n_depths layers of the same size"""
+    if n_depths < 1:
+        raise ValueError('The number of depths must be at least 1, got {}'.format(n_depths))
+    return (np.arange(n_depths) + 0.5) / n_depths
+
+
+def equivolume_distances(fractions, pial_areas, white_areas):
+    """
+    Convert fractions of the cortical volume into fractions of the cortical thickness (equivolume model of Bok)
+
+    The area of a column of cortex is assumed to change linearly between the pial and the white surfaces, so that
+    the layer between the pial surface and the distance d (fraction of the thickness) contains the fraction
+    alpha = (2 d A_pial + d^2 (A_white - A_pial)) / (A_pial + A_white) of the volume of the column.
+
+    Parameters
+    ----------
+        fractions : array (n_depths,)
+            fractions of the volume from the pial surface (0) to the white surface (1)
+        pial_areas, white_areas : arrays (n_vertices,)
+            areas of the vertices on the pial and white surfaces (see vertex_areas)
+
+    Returns
+    ---------
+        distances : array (n_vertices, n_depths)
+            fractions of the thickness from the pial surface of each depth and vertex
+
+    """
+    alpha = np.asarray(fractions, dtype=np.float64)[np.newaxis, :]
+    pial = pial_areas[:, np.newaxis]
+    white = white_areas[:, np.newaxis]
+    difference = white - pial
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distances = (np.sqrt((1 - alpha) * pial ** 2 + alpha * white ** 2) - pial) / difference
+    # same areas (or degenerated vertices) : the volume and the thickness are proportional
+    same = np.abs(difference) <= 1e-6 * np.maximum(pial + white, 1e-12)
+    return np.where(same | ~np.isfinite(distances), alpha, np.clip(distances, 0, 1))
+
+
+def depth_coordinates(pial, white, faces, n_depths, method='equivolume'):
+    """
+    Compute the coordinates of the intermediate surfaces between the pial and the white surfaces
+
+    Parameters
+    ----------
+        pial, white : arrays (n_vertices, 3)
+            vertices of the pial and white surfaces of a hemisphere (the vertices correspond one to one)
+        faces : array (n_faces, 3)
+            triangles of the surfaces
+        n_depths : int
+            number of intermediate surfaces (see depth_fractions)
+        method : string
+            'equivolume' (layers of the same volume) or 'equidistant' (layers of the same thickness)
+
+    Returns
+    ---------
+        coordinates : array (n_vertices, n_depths, 3)
+            coordinates of the intermediate surfaces, in the space of the surfaces
+        fractions : array (n_depths,)
+            depth of each surface from the pial surface (0) to the white surface (1), as fraction of the volume
+            (equivolume) or of the thickness (equidistant)
+
+    """
+    if method not in DEPTH_METHODS:
+        raise ValueError('Unknown depth method {}, choose one of {}'.format(method, DEPTH_METHODS))
+    if pial.shape != white.shape:
+        raise ValueError('The pial and white surfaces have {} and {} vertices'.format(len(pial), len(white)))
+    fractions = depth_fractions(n_depths)
+    if method == 'equivolume':
+        distances = equivolume_distances(fractions, vertex_areas(pial, faces), vertex_areas(white, faces))
+    else:
+        distances = np.broadcast_to(fractions, (len(pial), n_depths))
+    coordinates = pial[:, np.newaxis, :] + distances[:, :, np.newaxis] * (white - pial)[:, np.newaxis, :]
+    return coordinates, fractions
+
+
+def surface_to_voxel(surface_reference, affine):
+    """
+    Return the affine (4, 4) from the coordinates of the freesurfer surfaces (tkRAS) to the voxels of an image
+
+    The surfaces are in the tkregister space of the conformed volumes of freesurfer (e.g. mri/brainmask.mgz), which
+    is mapped to the scanner space with the affine of the conformed volume, then to the voxels of the image.
+    """
+    reference = nib.load(surface_reference)
+    tkr_to_world = reference.affine.dot(np.linalg.inv(reference.header.get_vox2ras_tkr()))
+    return np.linalg.inv(affine).dot(tkr_to_world)
+
+
+def sample_volume(volume, coordinates, surface_to_vox, min_weight=MIN_WEIGHT):
+    """
+    Sample a volume at the points of the intermediate surfaces with a trilinear interpolation
+
+    All the points are interpolated at once with trilinear_sample. The voxels at 0 or not finite (outside of the
+    brain mask of the skull-stripped maps) are not averaged with the cortex : the values are divided by the
+    interpolated weights of the voxels inside the mask, and the points with less than min_weight of their weights
+    inside the mask are NaN.
+
+    Parameters
+    ----------
+        volume : array (nx, ny, nz)
+            image to sample (e.g. R1q_cor_clean)
+        coordinates : array (..., 3)
+            coordinates of the points in the space of the surfaces
+        surface_to_vox : array (4, 4)
+            affine from the space of the surfaces to the voxels of volume (see surface_to_voxel)
+        min_weight : float
+            minimum fraction of the interpolation weights inside the mask
+
+    Returns
+    ---------
+        values : array (...)
+            sampled values, in float64
+
+    """
+    shape = coordinates.shape[:-1]
+    points = coordinates.reshape(-1, 3)
+    voxels = surface_to_vox[:3, :3].dot(points.T) + surface_to_vox[:3, 3:]
+    inside = np.isfinite(volume) & (volume != 0)
+    values = trilinear_sample(np.where(inside, volume, 0), voxels, cval=0., dtype=np.float32).astype(np.float64)
+    weights = trilinear_sample(inside, voxels, cval=0., dtype=np.float32)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values = np.where(weights >= min_weight, values / weights, np.nan)
+    return values.reshape(shape)
+
+
+def read_annotation(annotation_path):
+    """read a freesurfer annotation (e.g. label/lh.aparc.DKTatlas.annot), return the index of the structure of each
+    vertex (-1 if the vertex has no structure) and the names of the structures"""
+    labels, _, names = nib.freesurfer.read_annot(annotation_path)
+    return labels.astype(np.int64), [name.decode() if isinstance(name, bytes) else name for name in names]
+
+
+def profile_statistics(profiles, labels, names, fractions, hemisphere, percentiles=PERCENTILES):
+    """
+    Compute the statistics of the depth profiles in each structure of an annotation, at each depth
+
+    The vertices are grouped by (structure, depth) with one call to label_statistics. The structures are reported
+    with the labels and names of the cortical structures of aparc.DKTatlas+aseg (e.g. 1003 ctx-lh-caudalmiddlefrontal).
+
+    Parameters
+    ----------
+        profiles : array (n_vertices, n_depths)
+            values sampled at each vertex and depth (see sample_volume)
+        labels : array of int (n_vertices,)
+            index of the structure of each vertex, -1 for no structure (see read_annotation)
+        names : list of strings
+            names of the structures of the annotation
+        fractions : array (n_depths,)
+            depths of the intermediate surfaces (see depth_coordinates)
+        hemisphere : string
+            'lh' or 'rh'
+
+    Returns
+    ---------
+        rows : list of dict
+            one dict per structure and depth with the keys of PROFILE_COLUMNS
+
+    """
+    n_vertices, n_depths = profiles.shape
+    if labels.shape != (n_vertices,):
+        raise ValueError('The annotation has {} vertices, the surfaces have {}'.format(labels.size, n_vertices))
+    keys = np.where(labels[:, np.newaxis] >= 0, labels[:, np.newaxis] * n_depths + np.arange(n_depths), -1)
+    statistics = label_statistics(profiles, keys, percentiles, exclude_labels=(-1,))
+
+    rows = []
+    for i, key in enumerate(statistics['label']):
+        structure, depth_index = divmod(int(key), n_depths)
+        row = {'hemisphere': hemisphere, 'label': HEMISPHERES[hemisphere] + structure,
+               'name': 'ctx-{}-{}'.format(hemisphere, names[structure]), 'depth_index': depth_index,
+               'depth': float(fractions[depth_index]), 'count': int(statistics['count'][i])}
+        for column in ['mean', 'std', 'min', 'max', 'median'] + ['p{:g}'.format(q) for q in percentiles]:
+            row[column] = float(statistics[column][i])
+        rows.append(row)
+    return rows
+
+
+def compute_depth_profiles(freesurfer_subj, map_path, n_depths=10, method='equivolume',
+                           annotation='aparc.DKTatlas', surface_reference='mri/brainmask.mgz'):
+    """
+    Sample a map (e.g. R1q_cor_clean) across the cortical depth and average it in the structures of an annotation
+
+    For each hemisphere, the n_depths intermediate surfaces between surf/<hemi>.pial and surf/<hemi>.white are
+    computed for all the vertices at once, sampled with one trilinear interpolation and grouped per structure of
+    label/<hemi>.<annotation>.annot and depth, without a loop over the vertices.
+
+    Parameters
+    ----------
+        freesurfer_subj : string
+            freesurfer directory of the subject
+        map_path : string
+            path of the map to sample (nifti or mgz), in any space of the scanner (e.g. the original space)
+        n_depths : int
+            number of intermediate surfaces
+        method : string
+            'equivolume' or 'equidistant' (see depth_coordinates)
+        annotation : string
+            name of the freesurfer annotation of the structures
+        surface_reference : string
+            conformed volume of the subject giving the space of the surfaces (see surface_to_voxel)
+
+    Returns
+    ---------
+        rows : list of dict
+            statistics of each hemisphere, structure and depth (see profile_statistics)
+
+    """
+    img = nib.load(map_path)
+    volume = np.asanyarray(img.dataobj, dtype=np.float32)
+    surface_to_vox = surface_to_voxel(os.path.join(freesurfer_subj, surface_reference), img.affine)
+    rows = []
+    for hemisphere in HEMISPHERES:
+        with stage('depth profiles', image=hemisphere):
+            pial, faces = read_surface(os.path.join(freesurfer_subj, 'surf', hemisphere + '.pial'))
+            white, _ = read_surface(os.path.join(freesurfer_subj, 'surf', hemisphere + '.white'))
+            coordinates, fractions = depth_coordinates(pial, white, faces, n_depths, method)
+            profiles = sample_volume(volume, coordinates, surface_to_vox)
+            del coordinates
+            labels, names = read_annotation(os.path.join(freesurfer_subj, 'label',
+                                                         '{}.{}.annot'.format(hemisphere, annotation)))
+            rows.extend(profile_statistics(profiles, labels, names, fractions, hemisphere))
+        print('INFO : Sampled {} vertices at {} {} depths of the {} hemisphere'
+              .format(len(pial), n_depths, method, hemisphere))
+    return rows
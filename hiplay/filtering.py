@@ -0,0 +1,148 @@
+# Module
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from scipy import signal as sig
+from scipy import ndimage
+
+FILTER_MODES = ['2d', '3d']
+
+
+def _filter_slab(slab, kernel_size, mode, halo):
+    """median filter of one slab, the halo slices on each side are only used as neighbours"""
+    if mode == '2d':
+        filtered = np.empty(slab.shape, dtype=slab.dtype)
+        for k in range(slab.shape[2]):
+            filtered[:, :, k] = sig.medfilt2d(slab[:, :, k], kernel_size)
+        return filtered
+    filtered = ndimage.median_filter(slab, size=kernel_size, mode='constant', cval=0)
+    return filtered[:, :, halo[0]:slab.shape[2] - halo[1]]
+
+
+def median_filter(volume, kernel_size=3, mode='2d', n_jobs=1, executor='process', dtype=np.float64):
+    """
+    Apply a median filter on a 3D volume, split in slabs along z processed in parallel
+
+    Parameters
+    ----------
+        volume : array (nx, ny, nz)
+            volume to filter
+        kernel_size : int
+            size of the median kernel (odd)
+        mode : string
+            '2d' : filter each slice (x, y) independently, identical to scipy.signal.medfilt2d slice by slice
+            '3d' : filter with a cubic kernel. The slabs overlap so the result does not depend on n_jobs
+        n_jobs : int
+            number of workers. None uses all the cores of the machine
+        executor : string
+            'process' or 'thread' pool used when n_jobs > 1
+        dtype : numpy dtype
+            floating point type of the computation, np.float32 or np.float64
+
+    Returns
+    ---------
+        filtered : array (nx, ny, nz)
+            filtered volume in dtype. Outside of the volume is considered as 0 (zero padding)
+
+    """
+    if mode not in FILTER_MODES:
+        raise ValueError('Unknown filter mode {}, choose one of {}'.format(mode, FILTER_MODES))
+    if kernel_size % 2 != 1:
+        raise ValueError('The kernel size of the median filter must be odd, got {}'.format(kernel_size))
+    if executor not in ['process', 'thread']:
+        raise ValueError("Unknown executor {}, choose 'process' or 'thread'".format(executor))
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+
+    volume = np.asarray(volume, dtype=dtype)
+    nz = volume.shape[2]
+    n_slabs = max(1, min(n_jobs, nz))
+    bounds = np.linspace(0, nz, n_slabs + 1).astype(int)
+    radius = kernel_size // 2 if mode == '3d' else 0
+
+    tasks = []
+    for z_start, z_stop in zip(bounds[:-1], bounds[1:]):
+        halo = (min(radius, z_start), min(radius, nz - z_stop))
+        tasks.append((volume[:, :, z_start - halo[0]:z_stop + halo[1]], kernel_size, mode, halo))
+
+    if n_slabs == 1:
+        slabs = [_filter_slab(*tasks[0])]
+    else:
+        pool_class = ProcessPoolExecutor if executor == 'process' else ThreadPoolExecutor
+        with pool_class(max_workers=n_slabs) as pool:
+            slabs = list(pool.map(_filter_slab, *zip(*tasks)))
+
+    return np.concatenate(slabs, axis=2)
+
+
+# local standard deviation (dicom levels) below which a voxel of the T1 uni image is considered as tissue. The
+# background of MP2RAGE images is uniform noise over [0, 4095] (standard deviation ~1200), tissues are smooth
+FOREGROUND_NOISE_LEVEL = 600
+
+
+def _low_noise_slab(slab, noise_level, window, halo):
+    """mask of the voxels of one slab with a local standard deviation below noise_level, without the halo slices"""
+    slab = np.asarray(slab, dtype=np.float32)
+    mean = ndimage.uniform_filter(slab, size=window)
+    variance = ndimage.uniform_filter(slab * slab, size=window)
+    variance -= mean * mean
+    return (variance < noise_level ** 2)[:, :, halo[0]:slab.shape[2] - halo[1]]
+
+
+def foreground_mask(uni, noise_level=FOREGROUND_NOISE_LEVEL, window=3, dilation=3, slab_size=None):
+    """
+    Compute a mask of the head from the T1 uni image of the MP2RAGE
+
+    The background of the T1 uni image is random, so a voxel belongs to the head if the standard deviation of the
+    image in its neighbourhood is low. The mask is then cleaned with a binary opening, only its largest connected
+    component is kept, its holes are filled and it is dilated to keep the border of the head (the dark CSF next to
+    the background is partly rejected by the standard deviation).
+
+    The standard deviation is computed on slabs of slab_size slices read with a halo of window // 2 slices, so the
+    mask does not depend on slab_size. The cleaning is done on the whole volume : it needs about 6 bytes per voxel
+    (boolean masks and the int32 labels of the connected components), plus 16 bytes per voxel of a slab for the
+    standard deviation (e.g. 150 MB for a 320 x 320 x 240 volume read by slabs of 32 slices).
+
+    Parameters
+    ----------
+        uni : array (nx, ny, nz)
+            T1 uniform image in dicom levels [0, 4095]. Any array which can be sliced along z (e.g. the dataobj of a
+            nibabel image), only the slabs are read in memory
+        noise_level : float
+            local standard deviation above which a voxel is background
+        window : int
+            size of the cubic neighbourhood of the standard deviation
+        dilation : int
+            number of voxels added around the mask
+        slab_size : int
+            number of slices of the slabs of the standard deviation. Default computes it on the whole volume at once
+
+    Returns
+    ---------
+        mask : array of bool (nx, ny, nz)
+            True in the head
+
+    """
+    nz = uni.shape[2]
+    slab_size = slab_size or nz
+    radius = window // 2
+    mask = np.empty(uni.shape, dtype=bool)
+    for z_start in range(0, nz, slab_size):
+        z_stop = min(z_start + slab_size, nz)
+        halo = (min(radius, z_start), min(radius, nz - z_stop))
+        mask[:, :, z_start:z_stop] = _low_noise_slab(uni[:, :, z_start - halo[0]:z_stop + halo[1]], noise_level,
+                                                     window, halo)
+
+    structure = ndimage.generate_binary_structure(3, 1)
+    mask = ndimage.binary_opening(mask, structure)
+    labels, n_labels = ndimage.label(mask, structure)
+    if n_labels == 0:
+        return mask
+    sizes = np.bincount(labels.ravel())
+    sizes[0] = 0
+    mask = labels == np.argmax(sizes)
+    del labels
+    mask = ndimage.binary_fill_holes(mask)
+    if dilation:
+        mask = ndimage.binary_dilation(mask, structure, iterations=dilation)
+    return mask
@@ -0,0 +1,274 @@
+# Module
+import os
+import sys
+import json
+import time
+import resource
+import threading
+import contextlib
+import subprocess as sub
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# files written in the folder of each subject
+TRACE_NAME = 'pipeline_trace.json'          # every stage and command, in the Chrome trace format (chrome://tracing)
+PROFILE_NAME = 'pipeline_profile.json'      # summary per stage and list of the commands
+
+# tracer of the current process (None when nothing is recorded)
+_tracer = None
+
+
+def _read_proc(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _io_counters():
+    """bytes read and written by the process through I/O system calls (rchar, wchar of /proc/self/io)"""
+    content = _read_proc('/proc/self/io')
+    if content is None:
+        return None, None
+    counters = dict(line.split(': ') for line in content.splitlines() if ': ' in line)
+    return int(counters['rchar']), int(counters['wchar'])
+
+
+def _peak_rss():
+    """peak resident memory of the process in MB (VmHWM, or ru_maxrss when /proc is not available)"""
+    content = _read_proc('/proc/self/status')
+    if content is not None:
+        for line in content.splitlines():
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _reset_peak_rss():
+    """reset the peak resident memory of the process to its current value (linux only), return True if done"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class Stage(object):
+    """measures of a stage, filled by Tracer.stage"""
+
+    def __init__(self, name, path, args):
+        self.name = name
+        self.path = path
+        self.args = args
+        self.peak_rss = 0.
+        self.start = time.time()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        self._io = _io_counters()
+
+
+class Tracer(object):
+    """
+    Record the wall time, CPU time, peak memory and I/O of the stages of the pipeline and the external commands
+
+    Stages can be nested : the name of a sub-stage is prefixed by the names of its parents in the summary
+    (e.g. 2.B1correction/median filter). The events are kept in memory and saved with save().
+    """
+
+    def __init__(self):
+        self.events = []
+        self.stack = []
+        self.lock = threading.Lock()
+        self.can_reset_rss = _reset_peak_rss()
+
+    @contextlib.contextmanager
+    def stage(self, name, **args):
+        parent = self.stack[-1] if self.stack else None
+        if parent is not None:
+            parent.peak_rss = max(parent.peak_rss, _peak_rss())
+        if self.can_reset_rss:
+            _reset_peak_rss()
+        current = Stage(name, name if parent is None else parent.path + '/' + name, args)
+        self.stack.append(current)
+        status = 'success'
+        try:
+            yield current
+        except BaseException:
+            status = 'failure'
+            raise
+        finally:
+            self.stack.pop()
+            current.peak_rss = max(current.peak_rss, _peak_rss())
+            if parent is not None:
+                parent.peak_rss = max(parent.peak_rss, current.peak_rss)
+            io_end = _io_counters()
+            event = {'name': name, 'cat': 'stage', 'ph': 'X', 'ts': current.start * 1e6,
+                     'dur': (time.perf_counter() - current._wall) * 1e6, 'pid': os.getpid(),
+                     'tid': threading.get_ident() % 100000,
+                     'args': dict(args, path=current.path, status=status,
+                                  cpu_s=time.process_time() - current._cpu,
+                                  peak_rss_mb=current.peak_rss,
+                                  read_mb=None if io_end[0] is None else (io_end[0] - current._io[0]) / 1e6,
+                                  written_mb=None if io_end[1] is None else (io_end[1] - current._io[1]) / 1e6)}
+            with self.lock:
+                self.events.append(event)
+
+    def add_command(self, name, command, start, wall, returncode, cpu_s):
+        path = name if not self.stack else self.stack[-1].path + '/' + name
+        with self.lock:
+            self.events.append({'name': name, 'cat': 'command', 'ph': 'X', 'ts': start * 1e6, 'dur': wall * 1e6,
+                                'pid': os.getpid(), 'tid': threading.get_ident() % 100000,
+                                'args': {'path': path, 'command': command, 'returncode': returncode,
+                                         'cpu_s': cpu_s}})
+
+    def save(self, directory):
+        """
+        Merge the events in the trace file of directory (TRACE_NAME) and update its summary (PROFILE_NAME)
+
+        Several processes can save in the same folder (e.g. steps of a subject run at the same time), the files are
+        locked while they are updated.
+        """
+        if not self.events:
+            return
+        trace_path = os.path.join(directory, TRACE_NAME)
+        with open(os.path.join(directory, '.trace.lock'), 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(trace_path) as f:
+                    events = json.load(f)['traceEvents']
+            except (OSError, ValueError, KeyError):
+                events = []
+            events.extend(self.events)
+            events.sort(key=lambda event: event['ts'])
+            _write_json(trace_path, {'traceEvents': events, 'displayTimeUnit': 'ms'})
+            _write_json(os.path.join(directory, PROFILE_NAME), summarize(events))
+        self.events = []
+
+
+def _write_json(path, content):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(content, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def summarize(events):
+    """
+    Summary of trace events : for each stage (by path) the number of calls, total wall and CPU time, peak memory and
+    I/O, and the list of the external commands with their duration and exit status
+    """
+    stages = OrderedDict()
+    commands = []
+    for event in events:
+        args = event['args']
+        if event['cat'] == 'command':
+            commands.append({'name': args['path'], 'command': args['command'], 'returncode': args['returncode'],
+                             'wall_s': round(event['dur'] / 1e6, 3),
+                             'cpu_s': None if args['cpu_s'] is None else round(args['cpu_s'], 3),
+                             'start': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(event['ts'] / 1e6))})
+            continue
+        stage = stages.setdefault(args['path'], {'calls': 0, 'failures': 0, 'wall_s': 0., 'cpu_s': 0.,
+                                                 'peak_rss_mb': 0., 'read_mb': 0., 'written_mb': 0.})
+        stage['calls'] += 1
+        stage['failures'] += args['status'] != 'success'
+        stage['wall_s'] += event['dur'] / 1e6
+        stage['cpu_s'] += args['cpu_s']
+        stage['peak_rss_mb'] = max(stage['peak_rss_mb'], args['peak_rss_mb'])
+        stage['read_mb'] += args['read_mb'] or 0.
+        stage['written_mb'] += args['written_mb'] or 0.
+    for stage in stages.values():
+        for key in ['wall_s', 'cpu_s', 'peak_rss_mb', 'read_mb', 'written_mb']:
+            stage[key] = round(stage[key], 3)
+    return {'stages': stages, 'commands': commands}
+
+
+def get_tracer():
+    """return the tracer of the current process, None if nothing is recorded"""
+    return _tracer
+
+
+@contextlib.contextmanager
+def tracing(directory):
+    """
+    Record the stages and commands run in the block and save them in the trace files of directory (e.g. the folder
+    of a subject). With directory None, the events are only kept in the tracer (e.g. to summarize them).
+    Nested calls use the tracer of the outer block.
+    """
+    global _tracer
+    if _tracer is not None:
+        yield _tracer
+        return
+    _tracer = Tracer()
+    try:
+        yield _tracer
+    finally:
+        tracer, _tracer = _tracer, None
+        if directory is not None:
+            tracer.save(directory)
+
+
+@contextlib.contextmanager
+def stage(name, **args):
+    """
+    Measure a stage of the pipeline (wall and CPU time, peak memory, bytes read and written) when tracing is active
+
+    Example
+    ---------
+        with stage('median filter', mode='2d'):
+            filtered = median_filter(volume)
+
+    """
+    if _tracer is None:
+        yield None
+    else:
+        with _tracer.stage(name, **args) as current:
+            yield current
+
+
+def import_times(module):
+    """
+    Measure the time to import a module in a new python interpreter (python -X importtime)
+
+    Returns
+    ---------
+        times : list of tuples
+            (name, self_ms, cumulative_ms) of each module imported, in the order they were loaded. The last one is
+            module, its cumulative time is the total cost of the import
+
+    """
+    result = sub.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)], stdout=sub.DEVNULL,
+                     stderr=sub.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise ImportError('Could not import {} : {}'.format(module, result.stderr.strip().splitlines()[-1:]))
+    times = []
+    for line in result.stderr.splitlines():
+        fields = line[len('import time:'):].split('|')
+        if not line.startswith('import time:') or len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        times.append((fields[2].strip(), int(fields[0]) / 1000., int(fields[1]) / 1000.))
+    return times
+
+
+def import_report(modules, top=8):
+    """
+    Text report of the import cost of modules : for each one, the total time of its import in a new interpreter
+    and the packages which take most of it (sum of the self times of their modules)
+    """
+    lines = []
+    for module in modules:
+        times = import_times(module)
+        packages = OrderedDict()
+        for name, self_ms, _ in times:
+            package = name.split('.')[0] if not name.startswith('hiplay.') else name
+            packages[package] = packages.get(package, 0.) + self_ms
+        lines.append('{:<32s} {:8.1f} ms'.format(module, times[-1][2] if times else 0.))
+        for package, milliseconds in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+            lines.append('    {:<28s} {:8.1f} ms'.format(package, milliseconds))
+    return '\n'.join(lines)
+
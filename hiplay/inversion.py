@@ -0,0 +1,135 @@
+# Module
+import numpy as np
+
+# number of levels of the MP2RAGE UNI image (dicom levels 0 to 4095)
+UNI_LEVELS = 4096
+
+# T1 value given to the voxels that fall outside the lookup table
+T1_FILL_VALUE = 4096
+
+
+def increasing_samples(column):
+    """
+    Return the mask of the samples of a column of the lookup table (signal by increasing order) which form a strictly
+    increasing sequence, so that the column can be inverted with np.interp
+
+    A sample is kept when it is below all the following ones : in a flat part (e.g. the CSF plateau of
+    hiplay.lookup_table.build_lookup_table) only its last sample is kept, and the samples which break the
+    monotonicity (or are not finite) are dropped.
+    """
+    column = np.where(np.isfinite(column), column, np.inf)
+    following_min = np.append(np.minimum.accumulate(column[::-1])[::-1][1:], np.inf)
+    return np.isfinite(column) & (column < following_min)
+
+
+def build_inverse_table(T1, B1, signal, n_levels=UNI_LEVELS):
+    """
+    Invert the MP2RAGE lookup table on a dense regular grid of signal values
+
+    Each column of the lookup table (signal as a function of T1 for one B1 value) is monotonic, so it can be inverted
+    with a 1D interpolation. The signal axis is sampled on the UNI dicom levels (signal = level / 4096 - 0.5).
+    The samples of a column which are not strictly monotonic are not used (see increasing_samples).
+
+    Parameters
+    ----------
+        T1 : array (nT1,)
+            T1 axis of the lookup table in ms
+        B1 : array (nB1,)
+            B1 axis of the lookup table in % (regular)
+        signal : array (nT1, nB1)
+            MP2RAGE signal for each T1 (rows) and B1 (columns), non-increasing along T1
+        n_levels : int
+            number of signal levels of the inverse table
+
+    Returns
+    ---------
+        inverse_table : array (n_levels, nB1)
+            T1 value for each signal level (rows) and B1 (columns). NaN where the signal is outside the column range
+
+    """
+    levels = np.arange(n_levels) / n_levels - 0.5
+    T1 = np.asarray(T1, dtype=float)
+    inverse_table = np.full((n_levels, B1.shape[0]), np.nan)
+    for k in range(B1.shape[0]):
+        # signal is non-increasing with T1 : reverse the column to get increasing sample points
+        column = np.asarray(signal[::-1, k], dtype=float)
+        keep = increasing_samples(column)
+        if keep.sum() >= 2:
+            inverse_table[:, k] = np.interp(levels, column[keep], T1[::-1][keep], left=np.nan, right=np.nan)
+    return inverse_table
+
+
+def invert_signal(inverse_table, B1, B1map_rel, uni):
+    """
+    Compute T1 from the relative B1 map and the MP2RAGE signal with a bilinear lookup in the inverse table
+
+    Parameters
+    ----------
+        inverse_table : array (n_levels, nB1)
+            output of build_inverse_table
+        B1 : array (nB1,)
+            B1 axis of the lookup table in % (regular)
+        B1map_rel : array
+            relative B1 value of each voxel in %, within the B1 axis range (T1 is NaN where it is not finite)
+        uni : array
+            MP2RAGE signal of each voxel in [-0.5, 0.5[ (same shape as B1map_rel)
+
+    Returns
+    ---------
+        T1map : array
+            T1 in ms of each voxel, NaN outside the lookup table or without B1. The computation is done in the floating point type
+            of B1map_rel and uni (float32 inputs and table give a float32 map)
+
+    """
+    n_levels, n_b1 = inverse_table.shape
+
+    # position on the B1 axis, voxels without B1 (NaN) are flagged and looked up in the first column
+    b1_step = float(B1[1] - B1[0])
+    pos_b1 = (B1map_rel - float(B1[0])) / b1_step
+    no_b1 = ~np.isfinite(pos_b1)
+    pos_b1 = np.clip(np.where(no_b1, 0, pos_b1), 0, n_b1 - 1)
+    ind_b1 = np.minimum(pos_b1.astype(np.intp), n_b1 - 2)
+    w_b1 = pos_b1 - ind_b1.astype(pos_b1.dtype)
+
+    # position on the signal axis, voxels outside the table are flagged and looked up on the first level
+    pos_s = (uni + 0.5) * n_levels
+    outside = ~((pos_s >= 0) & (pos_s <= n_levels - 1))
+    pos_s[outside] = 0
+    ind_s = np.minimum(pos_s.astype(np.intp), n_levels - 2)
+    w_s = pos_s - ind_s.astype(pos_s.dtype)
+    del pos_b1, pos_s
+
+    # interpolate along the signal axis in the two neighbouring B1 columns. A neighbour with a null weight is
+    # ignored so that a NaN on the other side of the cell does not propagate.
+    columns = []
+    for ind_col in (ind_b1, ind_b1 + 1):
+        low = inverse_table[ind_s, ind_col]
+        high = inverse_table[ind_s + 1, ind_col]
+        columns.append(np.where(w_s > 0, low + w_s * (high - low), low))
+    low, high = columns
+    T1map = np.where(w_b1 > 0, low + w_b1 * (high - low), low)
+    T1map[outside | no_b1] = np.nan
+
+    return T1map
+
+
+def invert_signal_triangulation(T1, B1, signal, B1map_rel, uni):
+    """
+    Compute T1 from the relative B1 map and the MP2RAGE signal with a linear interpolation on a Delaunay
+    triangulation of the lookup table (original implementation, requires matplotlib)
+
+    Parameters and returns are the same as invert_signal, with the lookup table (T1, B1, signal) given directly.
+
+    """
+    import matplotlib.tri as tri
+
+    # Generate 2D T1 and B1 object matching signal's size
+    T12D = np.tile(T1, (B1.shape[0], 1)).T
+    B12D = np.tile(B1, (T1.shape[0], 1))
+    B12D = B12D.astype(float)
+    # Generate 2D interpolant
+    triang = tri.Triangulation(B12D.flatten(), np.asarray(signal).flatten())
+    interpolator = tri.LinearTriInterpolator(triang, T12D.flatten())
+
+    T1map = interpolator(B1map_rel, uni)
+    return np.ma.filled(T1map.astype(float), np.nan)
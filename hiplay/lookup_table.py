@@ -0,0 +1,229 @@
+# Module
+import os
+import re
+import json
+import hashlib
+import tempfile
+import numpy as np
+
+from hiplay.config import get_cache_directory
+from hiplay.instrumentation import stage
+
+# names of the parameters in the MR_system_parameters file, in order of appearance
+PARAMETER_NAMES = ['alpha1deg', 'alpha2deg', 'nbefore', 'nafter', 'TR', 'BTR', 'TI1', 'TI2', 'eff']
+
+# default grid of the lookup table as (start, stop, step) given to np.arange
+T1_RANGE = (200, 5000, 10)      # T1 in ms
+B1_RANGE = (20, 121, 1)         # B1 in % of the nominal value (20% to 120%)
+
+# signal value used to correct the CSF part of the table
+CSF_SIGNAL = -0.5
+
+
+def read_system_parameters(file_path):
+    """
+    Read the MP2RAGE protocol parameters from a MR_system_parameters file
+
+    Parameters
+    ----------
+        file_path : string
+            path to the MR_system_parameters file (lines "name = value", comments start with #)
+
+    Returns
+    ---------
+        param_system : dict
+            parameters of the protocol keyed by the names in PARAMETER_NAMES
+
+    """
+    values = []
+    with open(file_path, encoding='latin-1') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                line_split = re.split(r'=', line)
+                values.append(float(line_split[1]))
+
+    if len(values) != len(PARAMETER_NAMES):
+        raise ValueError('Expected {} parameters in {}, found {}'.format(len(PARAMETER_NAMES), file_path, len(values)))
+
+    return dict(zip(PARAMETER_NAMES, values))
+
+
+def mp2rage_signal(T1, B1rel, param_system):
+    """
+    Compute the theoretical MP2RAGE signal [1] for given T1 and relative B1 values
+
+    T1 and B1rel are broadcasted against each other, so that a T1 column and a B1 row give the full T1 x B1 table.
+
+    Parameters
+    ----------
+        T1 : array
+            T1 values in ms
+        B1rel : array
+            B1 values relative to the nominal flip angle (1 = 100%)
+        param_system : dict
+            MP2RAGE protocol parameters (see read_system_parameters)
+
+    Returns
+    ---------
+        SMP2R : array
+            MP2RAGE signal in [-0.5, 0.5]
+
+    References
+    ----------
+    [1] J.Marques et al, MP2RAGE, a self bias-field corrected sequence for improved segmentation and T1-mapping at high field, NeuroImage, 2010
+
+    """
+    T1 = np.asarray(T1, dtype=float)
+    B1rel = np.asarray(B1rel, dtype=float)
+
+    alpha1deg = param_system['alpha1deg']  # FA1 in deg
+    alpha2deg = param_system['alpha2deg']  # FA2 in deg
+    nbefore = param_system['nbefore']  # FLASH pulses before k-space center
+    nafter = param_system['nafter']  # FLASH pulses after k-space center
+    n = nbefore + nafter  # Total number of FLASH pulses = number of slices * PF(slice)
+    TR = param_system['TR']  # Echo spacing in ms
+    BTR = param_system['BTR']  # Sequence TR in ms
+    TI1 = param_system['TI1']  # First inversion time in ms
+    TI2 = param_system['TI2']  # Second inversion time in ms
+    eff = param_system['eff']  # Inversion efficiency for adiabatic pulse (empirical)
+
+    # Intermediate terms
+    TA = TI1 - nbefore * TR  # TA with PF
+    TB = TI2 - TI1 - n * TR  # TB with PF
+    TC = BTR - TI2 - nafter * TR  # TC with PF
+    E1 = np.exp(-(np.divide(TR, T1)))
+    EA = np.exp(-(np.divide(TA, T1)))
+    EB = np.exp(-(np.divide(TB, T1)))
+    EC = np.exp(-(np.divide(TC, T1)))
+    M0 = 1  # Magnetization
+    C = 1
+
+    alpha1cor = alpha1deg / 180 * np.pi * B1rel  # corrected FA1 in rad
+    alpha2cor = alpha2deg / 180 * np.pi * B1rel  # corrected FA2 in rad
+    SA1 = np.sin(alpha1cor)
+    SA2 = np.sin(alpha2cor)
+    CA1 = np.cos(alpha1cor)
+    CA2 = np.cos(alpha2cor)
+
+    # Steady state FLASH signal PFourier ok
+    tmp1 = np.divide((1 - (CA1 * E1) ** n), (1 - (CA1 * E1)))  # PFourier ok
+    tmp2 = np.divide((1 - (CA2 * E1) ** n), (1 - (CA2 * E1)))  # PFourier ok
+    num = M0 * ((((1 - EA) * (CA1 * E1) ** n + (1 - E1) * tmp1) * EB + (1 - EB)) * (CA2 * E1) ** n + (
+            1 - E1) * tmp2) * EC + (1 - EC)  # PFourier ok
+    den = 1 + eff * (CA1 * CA2) ** n * np.exp(-(np.divide(BTR, T1)))  # PFourier ok
+    mzss = np.divide(num, den)
+
+    # Signal in the middle of the First readout --> only nbefore matters
+    MZtemp = ((-eff * mzss * np.divide(EA, M0) + (1 - EA)) * (CA1 * E1) ** (nbefore) + (1 - E1) * np.divide(
+        (1 - (CA1 * E1) ** (nbefore)), (1 - (CA1 * E1))))
+    GRETI1 = C * SA1 * MZtemp
+
+    # Signal in the middle of the First readout --> both nbefore and nafter matter
+    MZtemp = MZtemp * (CA1 * E1) ** (nafter) + (1 - E1) * np.divide((1 - (CA1 * E1) ** (nafter)),
+                                                                    (1 - (CA1 * E1)))  # PFourier ok
+    MZtemp = (MZtemp * EB + (1 - EB)) * (CA2 * E1) ** (nbefore) + (1 - E1) * np.divide(
+        (1 - (CA2 * E1) ** (nbefore)), (1 - CA2 * E1))  # PFourier ok
+    GRETI2 = C * SA2 * MZtemp
+
+    # Resulting signal (a.u. or dicom levels)
+    return np.divide((GRETI1 * GRETI2), (GRETI1 ** 2 + GRETI2 ** 2))
+
+
+def build_lookup_table(param_system, t1_range=T1_RANGE, b1_range=B1_RANGE):
+    """
+    Compute the theoretical MP2RAGE signal for the whole T1 x B1 grid in one pass
+
+    Parameters
+    ----------
+        param_system : dict
+            MP2RAGE protocol parameters (see read_system_parameters)
+        t1_range : tuple
+            (start, stop, step) of the T1 axis in ms
+        b1_range : tuple
+            (start, stop, step) of the B1 axis in % of the nominal value
+
+    Returns
+    ---------
+        T1 : array (nT1,)
+            T1 axis of the table in ms
+        B1 : array (nB1,)
+            B1 axis of the table in %
+        signal : array (nT1, nB1)
+            MP2RAGE signal for each T1 (rows) and B1 (columns)
+
+    """
+    T1 = np.arange(*t1_range)
+    B1 = np.int32(np.arange(*b1_range))
+
+    signal = mp2rage_signal(T1[:, np.newaxis], B1[np.newaxis, :] / 100, param_system)
+
+    # little trick for correct CSF : in each column, the signal is kept constant after the value closest to -0.5
+    ind = np.abs(signal - CSF_SIGNAL).argmin(axis=0)
+    near_value = signal[ind, np.arange(B1.shape[0])]
+    rows = np.arange(T1.shape[0])[:, np.newaxis]
+    signal = np.where(rows >= ind, near_value, signal)
+
+    return T1, B1, signal
+
+
+def lookup_table_key(param_system, t1_range=T1_RANGE, b1_range=B1_RANGE):
+    """
+    Return a hash identifying a lookup table from the protocol parameters and the grid definition
+    """
+    description = {'parameters': [float(param_system[name]) for name in PARAMETER_NAMES],
+                   't1_range': [float(v) for v in t1_range],
+                   'b1_range': [float(v) for v in b1_range]}
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def load_lookup_table(param_system, t1_range=T1_RANGE, b1_range=B1_RANGE, cache_directory=None):
+    """
+    Return the MP2RAGE lookup table, computed once per protocol and stored in a cache directory
+
+    The first call for a given protocol and grid computes the table and saves it as a .npy file named after
+    lookup_table_key. The next calls memory-map this file instead of computing the table again.
+
+    Parameters
+    ----------
+        param_system : dict
+            MP2RAGE protocol parameters (see read_system_parameters)
+        t1_range : tuple
+            (start, stop, step) of the T1 axis in ms
+        b1_range : tuple
+            (start, stop, step) of the B1 axis in % of the nominal value
+        cache_directory : string
+            directory where the tables are stored. Default is given by hiplay.config.get_cache_directory
+
+    Returns
+    ---------
+        T1, B1, signal : see build_lookup_table. signal is a read-only memory-mapped array
+
+    """
+    if cache_directory is None:
+        cache_directory = get_cache_directory()
+    else:
+        os.makedirs(cache_directory, exist_ok=True)
+
+    key = lookup_table_key(param_system, t1_range, b1_range)
+    table_path = os.path.join(cache_directory, 'mp2rage_lut_{}.npy'.format(key[:16]))
+
+    T1 = np.arange(*t1_range)
+    B1 = np.int32(np.arange(*b1_range))
+
+    if not os.path.isfile(table_path):
+        print('INFO : Compute the MP2RAGE lookup table and store it in {}'.format(table_path))
+        with stage('build'):
+            T1, B1, signal = build_lookup_table(param_system, t1_range, b1_range)
+        # write in a temporary file first so that concurrent runs never read a partial table
+        fd, tmp_path = tempfile.mkstemp(suffix='.npy', dir=cache_directory)
+        os.chmod(tmp_path, 0o644)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, signal)
+        os.replace(tmp_path, table_path)
+
+    signal = np.load(table_path, mmap_mode='r')
+    if signal.shape != (T1.shape[0], B1.shape[0]):
+        raise ValueError('The cached lookup table {} does not match the grid definition'.format(table_path))
+
+    return T1, B1, signal
@@ -0,0 +1,145 @@
+# Module
+import os
+import json
+import time
+import gzip
+import hashlib
+
+# name of the manifest file written in the folder of each step
+MANIFEST_NAME = 'manifest.json'
+
+
+def file_checksum(path, block_size=1 << 20):
+    """
+    Return the sha256 of the content of a file
+
+    Compressed images (.gz, .mgz) are hashed after decompression, so that writing the same image again (with a new
+    time stamp in the gzip header) does not change its checksum.
+
+    """
+    digest = hashlib.sha256()
+    opener = gzip.open if path.endswith(('.gz', '.mgz')) else open
+    with opener(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def directory_checksum(path):
+    """
+    Return a sha256 of the listing of a folder (name, size and modification time of each file)
+
+    The content of the files is not read, which keeps the checksum of large dicom series cheap to compute.
+
+    """
+    digest = hashlib.sha256()
+    with os.scandir(path) as it:
+        entries = sorted((entry.name, entry.stat().st_size, entry.stat().st_mtime) for entry in it if entry.is_file())
+    for entry in entries:
+        digest.update(repr(entry).encode())
+    return digest.hexdigest()
+
+
+def checksum(path):
+    """checksum of a file (content) or of a folder (listing). None if path does not exist"""
+    if os.path.isdir(path):
+        return directory_checksum(path)
+    if os.path.isfile(path):
+        return file_checksum(path)
+    return None
+
+
+def build_manifest(inputs, parameters=None, tool_versions=None):
+    """
+    Describe a run of a step with the checksums of its inputs, its parameters and the version of the tools it uses
+
+    Parameters
+    ----------
+        inputs : dict
+            path of the input files or folders of the step, keyed by a name
+        parameters : dict
+            parameters of the step which change its outputs. Values which are not json types are stored as strings
+        tool_versions : dict
+            version of the programs and packages used by the step
+
+    Returns
+    ---------
+        manifest : dict
+            with keys 'inputs' (checksums), 'parameters' and 'tool_versions'
+
+    """
+    manifest = {'inputs': {name: checksum(path) for name, path in sorted(inputs.items())},
+                'parameters': parameters or {},
+                'tool_versions': tool_versions or {}}
+    # round trip in json so that the manifest compares equal to the one read from the disk
+    return json.loads(json.dumps(manifest, sort_keys=True, default=str))
+
+
+def read_manifest(step_directory):
+    """return the manifest stored in step_directory, or None if there is none or if it cannot be read"""
+    try:
+        with open(os.path.join(step_directory, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(step_directory, manifest, outputs):
+    """
+    Store the manifest of a successful run in step_directory, with the checksums of the outputs of the step
+
+    Parameters
+    ----------
+        step_directory : string
+            folder of the step
+        manifest : dict
+            manifest returned by build_manifest
+        outputs : dict
+            path of the output files of the step, keyed by a name. They must all exist
+
+    """
+    manifest = dict(manifest)
+    manifest['outputs'] = {name: checksum(path) for name, path in sorted(outputs.items())}
+    missing = [outputs[name] for name, value in manifest['outputs'].items() if value is None]
+    if missing:
+        raise FileNotFoundError('Outputs of the step are missing : {}'.format(missing))
+    manifest['date'] = time.strftime('%Y-%m-%d %H:%M:%S')
+
+    path = os.path.join(step_directory, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def remove_manifest(step_directory):
+    """remove the manifest of step_directory, so that the step is run again next time"""
+    path = os.path.join(step_directory, MANIFEST_NAME)
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def is_up_to_date(step_directory, manifest, outputs):
+    """
+    Check if a step can be skipped : its last run had the same inputs, parameters and tool versions, and its outputs
+    are still the ones produced by that run
+
+    Returns
+    ---------
+        up_to_date : bool
+        reason : string
+            why the step has to be run again (empty if up to date)
+
+    """
+    stored = read_manifest(step_directory)
+    if stored is None:
+        return False, 'no manifest of a previous run'
+    for key in ['inputs', 'parameters', 'tool_versions']:
+        if stored.get(key) != manifest[key]:
+            changed = sorted(name for name in set(stored.get(key, {})) | set(manifest[key])
+                             if stored.get(key, {}).get(name) != manifest[key].get(name))
+            return False, '{} changed : {}'.format(key.replace('_', ' '), ', '.join(changed))
+    stored_outputs = stored.get('outputs', {})
+    for name, path in sorted(outputs.items()):
+        if name not in stored_outputs or checksum(path) != stored_outputs[name]:
+            return False, 'output {} is missing or was modified'.format(name)
+    return True, ''
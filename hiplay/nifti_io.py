@@ -0,0 +1,250 @@
+# Module
+import os
+import gzip
+import tempfile
+from collections import OrderedDict
+import nibabel as nib
+import numpy as np
+from nibabel.openers import Opener
+
+
+# strategies to store the intermediate images of the pipeline
+#   compressed : .nii.gz files next to the final outputs
+#   uncompressed : .nii files in a scratch directory (e.g. on a tmpfs)
+#   memory : intermediate images are kept in memory and not written, unless an external tool needs them
+IO_POLICIES = ['compressed', 'uncompressed', 'memory']
+
+
+class IOStats(object):
+    """
+    Count the bytes read from and written to disk by each step of the pipeline
+    """
+
+    def __init__(self):
+        self.steps = OrderedDict()
+
+    def _step(self, step):
+        return self.steps.setdefault(step, {'read': 0, 'written': 0})
+
+    def add_read(self, step, path):
+        """record the reading of the file path by step"""
+        self._step(step)['read'] += os.path.getsize(path)
+
+    def add_written(self, step, path=None, size=None):
+        """record the writing of the file path (or of size bytes) by step"""
+        self._step(step)['written'] += os.path.getsize(path) if size is None else size
+
+    def report(self):
+        """print the bytes read and written by each step"""
+        for step, counts in self.steps.items():
+            print('INFO : I/O of {} : {:.1f} MB read, {:.1f} MB written'
+                  .format(step, counts['read'] / 1e6, counts['written'] / 1e6))
+
+
+def iter_slabs(path, slab_size=None, dtype=np.float64):
+    """
+    Read a 3D nifti image slab by slab along the third (z) axis
+
+    Uncompressed images (.nii) are memory-mapped, compressed images (.nii.gz) are decompressed sequentially, so that
+    only one slab is held in memory at a time.
+
+    Parameters
+    ----------
+        path : string
+            path of the nifti image
+        slab_size : int
+            number of slices per slab. None reads the whole volume in one slab
+        dtype : numpy dtype
+            floating point type of the slabs
+
+    Returns
+    ---------
+        generator of (z_start, z_stop, slab) with slab the scaled data of the slices z_start to z_stop - 1 in dtype
+
+    """
+    img = nib.load(path)
+    shape = img.shape
+    if len(shape) != 3:
+        raise ValueError('Slab reading expects a 3D image, {} has shape {}'.format(path, shape))
+    if slab_size is None:
+        slab_size = shape[2]
+
+    # on-disk layout of the data as read by nibabel
+    data_dtype = img.dataobj.dtype
+    offset = int(img.dataobj.offset)
+    slope = float(img.dataobj.slope)
+    inter = float(img.dataobj.inter)
+    plane_size = shape[0] * shape[1]
+
+    def scaled(raw):
+        slab = raw.astype(dtype)
+        if slope != 1 or inter != 0:
+            slab *= slope
+            slab += inter
+        return slab
+
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as f:
+            f.read(offset)
+            for z_start in range(0, shape[2], slab_size):
+                z_stop = min(z_start + slab_size, shape[2])
+                count = plane_size * (z_stop - z_start)
+                raw = np.frombuffer(f.read(count * data_dtype.itemsize), dtype=data_dtype, count=count)
+                yield z_start, z_stop, scaled(raw.reshape((shape[0], shape[1], z_stop - z_start), order='F'))
+    else:
+        data = np.memmap(path, dtype=data_dtype, mode='r', offset=offset, shape=shape, order='F')
+        for z_start in range(0, shape[2], slab_size):
+            z_stop = min(z_start + slab_size, shape[2])
+            yield z_start, z_stop, scaled(data[:, :, z_start:z_stop])
+        del data
+
+
+class NiftiSlabWriter(object):
+    """
+    Write a 3D nifti image slab by slab along the third (z) axis
+
+    The header is written first, then each slab is appended to the file in the nifti (Fortran) order, so the full
+    volume never has to be held in memory. The image is written in a temporary file and moved to its final path
+    when all the slices have been written.
+
+    Parameters
+    ----------
+        path : string
+            path of the output image (.nii or .nii.gz)
+        shape : tuple
+            shape of the 3D volume
+        affine : array (4, 4)
+            voxel to world affine of the image
+        header : nibabel header
+            header to copy the meta-data from (optional)
+        dtype : numpy dtype
+            on-disk data type. Default keeps the header data type if it is a float type and uses float32 otherwise
+        compresslevel : int
+            gzip compression level for .nii.gz outputs. Default is the nibabel one
+        slope, inter : float
+            scaling stored in the header (scl_slope, scl_inter) : the values written are (slab - inter) / slope,
+            rounded and clipped to the range of dtype for an integer dtype (see integer_scaling)
+
+    Example
+    ---------
+        with NiftiSlabWriter(path, shape, affine, header) as writer:
+            for z_start, z_stop, slab in iter_slabs(input_path, 16):
+                writer.write(slab)
+
+    """
+
+    def __init__(self, path, shape, affine, header=None, dtype=None, compresslevel=None, slope=1., inter=0.):
+        if len(shape) != 3:
+            raise ValueError('Slab writing expects a 3D image, got shape {}'.format(shape))
+        if dtype is None:
+            if header is not None and np.issubdtype(header.get_data_dtype(), np.floating):
+                dtype = header.get_data_dtype()
+            else:
+                dtype = np.float32
+        if compresslevel is None:
+            compresslevel = Opener.default_compresslevel
+
+        # build the header of the output image without allocating its data
+        img = nib.Nifti1Image(np.broadcast_to(np.zeros((), dtype=dtype), shape), affine, header)
+        img.update_header()
+        self.header = img.header
+        self.header.set_data_dtype(dtype)
+        self.header.set_slope_inter(slope, inter)
+        self.dtype = self.header.get_data_dtype()
+        # the scaling is stored in float32 in the header : quantize with the stored values so that the data read back
+        # is within half a step of the written values
+        self.slope = float(self.header['scl_slope'])
+        self.inter = float(self.header['scl_inter'])
+
+        self.path = path
+        self.shape = tuple(shape)
+        self.z_written = 0
+        self.bytes_written = 0
+
+        directory = os.path.dirname(os.path.abspath(path))
+        suffix = '.nii.gz' if path.endswith('.gz') else '.nii'
+        fd, self.tmp_path = tempfile.mkstemp(suffix=suffix, dir=directory)
+        os.chmod(self.tmp_path, 0o644)
+        self.raw_file = os.fdopen(fd, 'wb')
+        if path.endswith('.gz'):
+            self.file = gzip.GzipFile(fileobj=self.raw_file, mode='wb', compresslevel=compresslevel)
+        else:
+            self.file = self.raw_file
+
+        self.header.write_to(self.file)
+        offset = int(self.header.get_data_offset())
+        self.file.write(b'\x00' * (offset - self.file.tell()))
+
+    def write(self, slab):
+        """append the next slab (array of shape (nx, ny, nz_slab)) to the image"""
+        slab = np.asarray(slab)
+        if slab.ndim == 2:
+            slab = slab[:, :, np.newaxis]
+        if slab.shape[:2] != self.shape[:2] or self.z_written + slab.shape[2] > self.shape[2]:
+            raise ValueError('Slab of shape {} does not fit in image {} of shape {} ({} slices written)'
+                             .format(slab.shape, self.path, self.shape, self.z_written))
+        if self.slope != 1 or self.inter != 0:
+            # in float64 : a float32 quotient can round across the half step of the large integer types
+            slab = (slab.astype(np.float64) - self.inter) / self.slope
+        if np.issubdtype(self.dtype, np.integer):
+            limits = np.iinfo(self.dtype)
+            slab = np.clip(np.rint(slab), limits.min, limits.max)
+        self.file.write(slab.astype(self.dtype).tobytes(order='F'))
+        self.z_written += slab.shape[2]
+
+    def close(self):
+        """finish the image and move it to its final path"""
+        if self.z_written != self.shape[2]:
+            self.abort()
+            raise ValueError('Image {} is incomplete : {} slices written out of {}'
+                             .format(self.path, self.z_written, self.shape[2]))
+        if self.file is not self.raw_file:
+            self.file.close()
+        self.raw_file.close()
+        self.bytes_written = os.path.getsize(self.tmp_path)
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        """remove the temporary file without writing the image"""
+        if self.file is not self.raw_file:
+            self.file.close()
+        self.raw_file.close()
+        if os.path.isfile(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def integer_scaling(dtype, maximum, minimum=0.):
+    """
+    Return the (slope, inter) mapping the values [minimum, maximum] on the range of the integer type dtype, for
+    NiftiSlabWriter. Float types are stored without scaling (1, 0). The quantization error of a value is at most
+    slope / 2.
+    """
+    dtype = np.dtype(dtype)
+    if not np.issubdtype(dtype, np.integer):
+        return 1., 0.
+    limits = np.iinfo(dtype)
+    if minimum >= 0 and limits.min < 0:
+        # keep 0 exactly representable (e.g. background of the maps)
+        return float(maximum) / limits.max, 0.
+    slope = (float(maximum) - minimum) / (float(limits.max) - limits.min)
+    return slope, float(minimum) - limits.min * slope
+
+
+def find_image(directory, name):
+    """
+    Return the path of the nifti image name (without extension) in directory, preferring the uncompressed .nii file
+    (which can be memory-mapped) over the .nii.gz file when both exist
+    """
+    path = os.path.join(directory, name + '.nii')
+    if os.path.isfile(path):
+        return path
+    return os.path.join(directory, name + '.nii.gz')
@@ -1,7 +1,15 @@
 import os
+import time
+import shutil
 import subprocess as sub
 
-def apply_segmentation(path_directory,steps,freesurf_output_dir, freesurferHome, subj_name):
+from hiplay.commands import run_tool, freesurfer_environment, subject_log, TIMEOUTS
+
+# suffix of the freesurfer subject folder of the previous run, moved aside when recon-all is run again
+PREVIOUS_RUN_SUFFIX = '.previous'
+
+def apply_segmentation(path_directory,steps,freesurf_output_dir, freesurferHome, subj_name, n_threads=None,
+                       parallel=False):
     """
     Perform cortical and hippocampal parcellation based on T1w contrast image using Freesurfer recon-all [1][2]
 
@@ -19,10 +27,15 @@ def apply_segmentation(path_directory,steps,freesurf_output_dir, freesurferHome,
             the path directory where freesurfer has been stored
        subj_name : string
             the name of the subject folder. Should match the format Date_NIP
+       n_threads : int
+            number of threads used by recon-all (-openmp). Default is the freesurfer one
+       parallel : bool
+            run the processing of both hemispheres at the same time (-parallel of recon-all)
 
     Outputs
     ---------
     Compute the freesurfer outputs for each subject in the "freesurfer_output" folder. See freesurfer architecture for more information
+    Raises a RuntimeError if recon-all fails
 
      References
         ----------
@@ -31,6 +44,83 @@ def apply_segmentation(path_directory,steps,freesurf_output_dir, freesurferHome,
 
     """
 
+    apply_recon_all(path_directory, steps, freesurf_output_dir, freesurferHome, subj_name, n_threads, parallel)
+    apply_hippocampal_segmentation(freesurf_output_dir, freesurferHome, subj_name, n_threads,
+                                   log_path=subject_log(path_directory, 'freesurfer'))
+
+
+def recon_all_options(n_threads=None, parallel=False):
+    """return the options (list) of recon-all to use n_threads threads (-openmp) and run the hemispheres in parallel"""
+    options = []
+    if n_threads is not None:
+        options += ['-openmp', str(int(n_threads))]
+    if parallel:
+        options += ['-parallel']
+    return options
+
+
+def recon_all_command(input_path, freesurf_output_dir, freesurferHome, subj_name, n_threads=None, parallel=False):
+    """return the command (list) of recon-all -all on input_path with the expert options of freesurf_output_dir"""
+    return [os.path.join(freesurferHome, 'bin', 'recon-all'), '-sd', freesurf_output_dir, '-s', subj_name,
+            '-i', input_path, '-hires', '-all', '-expert', os.path.join(freesurf_output_dir, 'expert.opts')] + \
+        recon_all_options(n_threads, parallel)
+
+
+def move_previous_run(output_dir):
+    """
+    Move aside the freesurfer subject folder of a previous run (recon-all refuses -i on an existing subject)
+
+    The folder is renamed with PREVIOUS_RUN_SUFFIX, replacing the one kept from an older run, so that at most one
+    previous run is kept per subject.
+
+    Returns
+    ---------
+        previous_dir : string
+            new path of the previous run, or None if there was no previous run
+
+    """
+    if not os.path.lexists(output_dir):
+        return None
+    previous_dir = output_dir.rstrip(os.sep) + PREVIOUS_RUN_SUFFIX
+    if os.path.lexists(previous_dir):
+        print('INFO : Remove the older freesurfer run {}'.format(previous_dir))
+        if os.path.isdir(previous_dir) and not os.path.islink(previous_dir):
+            shutil.rmtree(previous_dir)
+        else:
+            os.remove(previous_dir)
+    os.rename(output_dir, previous_dir)
+    print('INFO : The freesurfer outputs of a previous run (modified on {}) are moved to {}'
+          .format(time.strftime('%Y-%m-%d %H:%M', time.localtime(os.path.getmtime(previous_dir))), previous_dir))
+    return previous_dir
+
+
+def run_freesurfer(command, freesurferHome, description, log_path=None, timeout=None):
+    """
+    Run a freesurfer command (list) in the freesurfer environment (see hiplay.commands.freesurfer_environment)
+
+    The output of the command is appended to log_path. Raises a RuntimeError if the command fails or lasts more than
+    timeout seconds, so that the caller can report the failure and go on with other jobs
+
+    """
+    try:
+        run_tool(command, env=freesurfer_environment(freesurferHome), log_path=log_path, timeout=timeout,
+                 name=description)
+    except sub.CalledProcessError as error:
+        raise RuntimeError('{} failed with exit code {} : {}{}'
+                           .format(description, error.returncode, ' '.join(command),
+                                   '' if log_path is None else ' (see {})'.format(log_path)))
+    except sub.TimeoutExpired:
+        raise RuntimeError('{} was stopped after {} s : {}'.format(description, timeout, ' '.join(command)))
+
+
+def apply_recon_all(path_directory, steps, freesurf_output_dir, freesurferHome, subj_name, n_threads=None,
+                    parallel=False):
+    """
+    Perform the cortical parcellation with recon-all -all on the t1uni_den.nii.gz of the folder 1.Inputs
+
+    The freesurfer folder of a previous run of the subject (outdated, forced or interrupted run) is moved aside
+    first (see move_previous_run). See apply_segmentation for the parameters
+    """
     input_path = os.path.join(path_directory, steps[0], 't1uni_den.nii.gz')
     expert_file = os.path.join(freesurf_output_dir, 'expert.opts')
     output_dir=os.path.join(freesurf_output_dir,subj_name)
@@ -42,31 +132,29 @@ def apply_segmentation(path_directory,steps,freesurf_output_dir, freesurferHome,
     if not os.path.isfile(input_path) :
         raise FileNotFoundError('Could not find {}. Run again the whole process for the subject {}'.format(input_path,subj_name))
 
-    # Initialise freesurfer variable environment
-    ini_freesurfer = format("{}/SetUpFreeSurfer.sh".format(freesurferHome))
+    # Perform cortical segmentation from scratch
+    move_previous_run(output_dir)
+    recon_all = recon_all_command(input_path, freesurf_output_dir, freesurferHome, subj_name, n_threads, parallel)
+    log_path = subject_log(path_directory, 'freesurfer')
+    print("INFO : Start cortical parcellation of {} (~35h). Please wait, the output is written in {}"
+          .format(subj_name, log_path))
+    run_freesurfer(recon_all, freesurferHome, 'Cortical parcellation of {}'.format(subj_name), log_path,
+                   TIMEOUTS['recon-all'])
+    print("INFO : End of cortical parcellation. Results stored in {}".format(output_dir))
 
-    # Perform cortical segmentation
 
+def apply_hippocampal_segmentation(freesurf_output_dir, freesurferHome, subj_name, n_threads=None, log_path=None):
+    """
+    Perform the hippocampal parcellation with recon-all -hippocampal-subfields-T1 (after apply_recon_all)
 
-    recon_all = format("{}/bin/recon-all -sd {} -s {} -i {} -hires -all -expert {}"
-                       .format(freesurferHome, freesurf_output_dir, subj_name, input_path, expert_file))
-    command1 = ini_freesurfer + ';' + recon_all
-    try:
-        print("INFO : Start cortical parcellation (~35h). Please wait")
-        sub.check_call(command1, shell=True)
-        print("INFO : End of cortical parcellation. Results stored in {}".format(output_dir))
-    except sub.CalledProcessError:
-        quit()
-
+    See apply_segmentation for the parameters. The output of recon-all is appended to log_path (default : printed)
+    """
+    output_dir = os.path.join(freesurf_output_dir, subj_name)
 
     # Perform Hippocampal segmentation
-
-    seghip = format("{}/bin/recon-all -sd {} -s {} -hippocampal-subfields-T1 -cm".format(freesurferHome,freesurf_output_dir, subj_name))
-    command2 = ini_freesurfer + ';' + seghip
-    try:
-        print("INFO : Start hippocampal parcellation (~1h). Please wait")
-        sub.check_call(command2, shell=True)
-        print("INFO : End of hippocampal parcellation. Results stored in {}".format(output_dir))
-    except sub.CalledProcessError:
-        quit()
-
+    seghip = [os.path.join(freesurferHome, 'bin', 'recon-all'), '-sd', freesurf_output_dir, '-s', subj_name,
+              '-hippocampal-subfields-T1', '-cm'] + recon_all_options(n_threads)
+    print("INFO : Start hippocampal parcellation of {} (~1h). Please wait".format(subj_name))
+    run_freesurfer(seghip, freesurferHome, 'Hippocampal parcellation of {}'.format(subj_name), log_path,
+                   TIMEOUTS['hippocampal-subfields'])
+    print("INFO : End of hippocampal parcellation. Results stored in {}".format(output_dir))
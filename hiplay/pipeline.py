@@ -0,0 +1,473 @@
+# Module
+import os
+import shutil
+
+import hiplay
+from hiplay.preprocess_mp2r import (apply_processInput, find_series_directories, ACQUISITION_DICOM_IDENTIFIERS,
+                                    ACQUISITION_NIFTI_IDENTIFIERS, OUTPUT_FILES_NAMES)
+from hiplay.acquisition_index import AcquisitionIndex
+from hiplay.perform_segmentation import apply_segmentation, apply_recon_all, apply_hippocampal_segmentation
+from hiplay.manifest import build_manifest, is_up_to_date, write_manifest, remove_manifest
+from hiplay.config import get_freesurfer_version, get_fsl_version, get_package_version
+from hiplay.scheduler import ResourceScheduler
+from hiplay.instrumentation import tracing, stage
+from hiplay.commands import subject_log
+
+# name of the folder of each step in the subject directory
+STEPS = ['1.Inputs', '2.B1correction', '3.Segmentation', '4.Myelin_proxy']
+
+# modules loaded by each step (and by the pipeline itself), only imported when the step is run. The steps with
+# numpy, scipy and nibabel import their module in their function, so that the scripts start fast
+STEP_MODULES = ['hiplay.pipeline', 'dicom2nifti', 'hiplay.b1correction', 'hiplay.perform_segmentation',
+                'hiplay.compute_results']
+
+# options of apply_B1correction which change the speed or the memory of the correction but not its results
+B1_PERFORMANCE_OPTIONS = ['cache_directory', 'slab_size', 'n_jobs', 'scratch_directory', 'compresslevel']
+
+# estimate of the peak memory (GB) of the tasks of a subject, used to schedule the batches
+TASK_MEMORY = {'inputs': 1, 'b1correction': 2, 'recon-all': 8, 'hippocampal': 8, 'results': 1}
+
+# freesurfer outputs of the segmentation used to compute the results
+FREESURFER_OUTPUTS = ['mri/rawavg.mgz', 'mri/brainmask.mgz', 'mri/aparc.DKTatlas+aseg.mgz',
+                      'mri/lh.hippoSfLabels-T1.v10.mgz', 'mri/rh.hippoSfLabels-T1.v10.mgz']
+
+# freesurfer surfaces and annotations used by the cortical depth profiles of the results
+FREESURFER_SURFACES = ['surf/{}.{}'.format(hemisphere, name) for hemisphere in ['lh', 'rh'] for name in
+                       ['white', 'pial']] + ['label/{}.aparc.DKTatlas.annot'.format(hemisphere) for hemisphere in
+                                             ['lh', 'rh']]
+
+# folder of the package, which contains MR_system_parameters and expert.opts
+PROJECT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def prepare_output_folder(output_folder):
+    """
+    Create the main output folder and the freesurfer output folder (with the expert.opts file) if needed
+
+    Returns
+    ---------
+        freesurf_output_dir : string
+            path of the freesurfer output folder
+
+    """
+    # Check if main directory exists. If not create it
+    if os.path.isdir(output_folder):
+        print('INFO : Dive into the main output folder : {} '.format(output_folder))
+    else:
+        print('INFO : Create the main output folder : {} '.format(output_folder))
+        os.makedirs(output_folder, exist_ok=True)
+
+    #Check if freesurfer output directory exists. If not create it.
+    freesurf_output_dir = os.path.join(output_folder, "freesurfer_outputs")
+    if os.path.isdir(freesurf_output_dir):
+        print('INFO : Freesurfer output folder present : {} '.format(freesurf_output_dir))
+    else:
+        print('INFO : Create the freesurfer output folder : {} '.format(freesurf_output_dir))
+        os.makedirs(freesurf_output_dir, exist_ok=True)
+
+    # Check if expert.opts exists in freesurfer output directory. If not copy it from the project folder.
+    expert_path = os.path.join(PROJECT_DIRECTORY, 'expert.opts')
+    expert_newpath = os.path.join(freesurf_output_dir, 'expert.opts')
+    if not os.path.isfile(expert_newpath):
+        try:
+            shutil.copyfile(expert_path, expert_newpath)
+        except FileNotFoundError:
+            print('Could not copy the expert.opt file from the hiplay package.')
+
+    return freesurf_output_dir
+
+
+def make_step_folder(subject_directory, step):
+    """create the folder of a step in the subject directory if needed and return its path"""
+    folder_path = os.path.join(subject_directory, step)
+    os.makedirs(folder_path, exist_ok=True)
+    return folder_path
+
+
+def run_step(step_directory, step, function, inputs, parameters=None, tool_versions=None, outputs=None,
+             force=False):
+    """
+    Run a step of the pipeline unless its manifest shows that it is up to date (see hiplay.manifest)
+
+    Parameters
+    ----------
+        step_directory : string
+            folder of the step, where its manifest is stored
+        step : string
+            name of the step
+        function : callable
+            function without arguments which runs the step
+        inputs : dict
+            path of the input files or folders of the step
+        parameters : dict
+            parameters of the step which change its outputs
+        tool_versions : dict
+            version of the programs and packages used by the step
+        outputs : dict
+            path of the output files of the step
+        force : bool
+            run the step even if it is up to date
+
+    Returns
+    ---------
+        run : bool
+            True if the step was run, False if it was skipped
+
+    """
+    outputs = outputs or {}
+    manifest = build_manifest(inputs, parameters, tool_versions)
+    if force:
+        print('INFO : Run step {} (forced)'.format(step))
+    else:
+        up_to_date, reason = is_up_to_date(step_directory, manifest, outputs)
+        if up_to_date:
+            print('INFO : Step {} is up to date (same inputs, parameters and tool versions), skip it'.format(step))
+            return False
+        print('INFO : Run step {} ({})'.format(step, reason))
+
+    remove_manifest(step_directory)
+    # the time, memory and I/O of the step and of its stages are added to the trace files of the subject
+    with tracing(os.path.dirname(os.path.normpath(step_directory))), stage(step):
+        function()
+    try:
+        write_manifest(step_directory, manifest, outputs)
+    except FileNotFoundError as error:
+        print('WARNING : {}. Step {} will be run again next time'.format(error, step))
+    return True
+
+
+def input_images(subject_directory):
+    """return the paths of the images and dicom files produced by the step 1.Inputs, keyed by their name"""
+    folder_path = os.path.join(subject_directory, STEPS[0])
+    images = {name: os.path.join(folder_path, name + '.nii.gz') for name in OUTPUT_FILES_NAMES}
+    images.update({'info_' + name: os.path.join(folder_path, 'info_' + name) for name in ACQUISITION_NIFTI_IDENTIFIERS})
+    return images
+
+
+def b1correction_outputs(subject_directory):
+    """return the paths of the corrected maps produced by the step 2.B1correction, keyed by their name"""
+    return {name: os.path.join(subject_directory, STEPS[1], name + '.nii.gz') for name in ['t1q_cor', 'R1q_cor']}
+
+
+def segmentation_outputs(output_folder, subj_name):
+    """return the paths of the freesurfer outputs of the step 3.Segmentation used by the step 4.Myelin_proxy"""
+    freesurfer_subj = os.path.join(output_folder, "freesurfer_outputs", subj_name)
+    return {name: os.path.join(freesurfer_subj, name) for name in FREESURFER_OUTPUTS}
+
+
+def run_inputs_step(subj_name, output_folder, deviceSeptT_directory, selection='interactive', n_jobs=None,
+                    force=False):
+    """find the dicom series of the subject and convert them in nifti (step 1.Inputs, see apply_processInput)"""
+    subject_directory = os.path.join(output_folder, subj_name)
+    folder_path = make_step_folder(subject_directory, STEPS[0])
+    date = subj_name.split('_')[0]
+    NIP = subj_name.split('_')[1]
+    with AcquisitionIndex(deviceSeptT_directory) as index:
+        series_directories = find_series_directories(index, ACQUISITION_DICOM_IDENTIFIERS, NIP, date, selection)
+    return run_step(folder_path, STEPS[0],
+                    lambda: apply_processInput(deviceSeptT_directory, STEPS, folder_path, NIP, date, n_jobs=n_jobs,
+                                               series_directories=series_directories),
+                    inputs=dict(zip(OUTPUT_FILES_NAMES, series_directories)),
+                    tool_versions={'hiplay': hiplay.__version__, 'dicom2nifti': get_package_version('dicom2nifti')},
+                    outputs=input_images(subject_directory), force=force)
+
+
+def run_b1correction_step(subj_name, output_folder, fslHome, b1_options=None, force=False):
+    """correct the T1 map from the B1+ inhomogeneities and compute the R1 map (step 2.B1correction)"""
+    from hiplay.b1correction import apply_B1correction
+    b1_options = b1_options or {}
+    subject_directory = os.path.join(output_folder, subj_name)
+    folder_path = make_step_folder(subject_directory, STEPS[1])
+    images = input_images(subject_directory)
+    inputs = {name: images[name] for name in ['b1map', 't1q', 't1uni', 'info_b1', 'info_t1_image']}
+    inputs['MR_system_parameters'] = os.path.join(PROJECT_DIRECTORY, 'MR_system_parameters')
+    parameters = {key: value for key, value in b1_options.items() if key not in B1_PERFORMANCE_OPTIONS}
+    tool_versions = {'hiplay': hiplay.__version__, 'numpy': get_package_version('numpy'),
+                     'scipy': get_package_version('scipy'), 'nibabel': get_package_version('nibabel')}
+    if b1_options.get('resampling') == 'flirt':
+        tool_versions['fsl'] = get_fsl_version(fslHome)
+    return run_step(folder_path, STEPS[1],
+                    lambda: apply_B1correction(subject_directory, STEPS, PROJECT_DIRECTORY, fslHome, **b1_options),
+                    inputs=inputs, parameters=parameters, tool_versions=tool_versions,
+                    outputs=b1correction_outputs(subject_directory), force=force)
+
+
+def run_segmentation_step(subj_name, output_folder, freesurferHome, n_threads=None, parallel=False, part='all',
+                          force=False):
+    """
+    Perform the cortical and hippocampal parcellations with freesurfer (step 3.Segmentation, see apply_segmentation)
+
+    The step can be run in two parts, so that the hippocampal parcellation is scheduled as a task depending on the
+    cortical parcellation : part='recon' runs recon-all -all (if the step is not up to date) and part='hippocampal'
+    runs the hippocampal parcellation and writes the manifest of the step. part='all' runs both.
+    """
+    subject_directory = os.path.join(output_folder, subj_name)
+    folder_path = make_step_folder(subject_directory, STEPS[2])
+    freesurf_output_dir = os.path.join(output_folder, "freesurfer_outputs")
+    inputs = {'t1uni_den': input_images(subject_directory)['t1uni_den'],
+              'expert.opts': os.path.join(freesurf_output_dir, 'expert.opts')}
+    tool_versions = {'freesurfer': get_freesurfer_version(freesurferHome)}
+    outputs = segmentation_outputs(output_folder, subj_name)
+
+    if part == 'all':
+        function = lambda: apply_segmentation(subject_directory, STEPS, freesurf_output_dir, freesurferHome,
+                                              subj_name, n_threads, parallel)
+    elif part == 'recon':
+        up_to_date, reason = is_up_to_date(folder_path, build_manifest(inputs, None, tool_versions), outputs)
+        if up_to_date and not force:
+            print('INFO : Step {} is up to date (same inputs, parameters and tool versions), skip it'.format(STEPS[2]))
+            return False
+        print('INFO : Run cortical parcellation of step {} ({})'.format(STEPS[2], 'forced' if force else reason))
+        # without manifest, the hippocampal part will be run after recon-all
+        remove_manifest(folder_path)
+        with tracing(subject_directory), stage(STEPS[2]):
+            apply_recon_all(subject_directory, STEPS, freesurf_output_dir, freesurferHome, subj_name, n_threads,
+                            parallel)
+        return True
+    elif part == 'hippocampal':
+        function = lambda: apply_hippocampal_segmentation(freesurf_output_dir, freesurferHome, subj_name, n_threads,
+                                                          log_path=subject_log(subject_directory, 'freesurfer'))
+        force = False
+    else:
+        raise ValueError("Unknown part {}, choose 'all', 'recon' or 'hippocampal'".format(part))
+    return run_step(folder_path, STEPS[2], function, inputs=inputs, tool_versions=tool_versions, outputs=outputs,
+                    force=force)
+
+
+def run_results_step(subj_name, output_folder, freesurferHome, table_format='tsv', exclude_csf=False, slab_size=None,
+                     n_depths=0, depth_method='equivolume', force=False):
+    """
+    Compute the R1 values in the regions of the parcellations (step 4.Myelin_proxy, see apply_processResults)
+    and add them to the cohort store of the output folder (see hiplay.cohort_store)
+
+    With n_depths, the R1 profiles across the cortical depth are also computed from the freesurfer surfaces.
+    """
+    from hiplay.compute_results import apply_processResults
+    from hiplay.cohort_store import CohortStore
+    subject_directory = os.path.join(output_folder, subj_name)
+    segmentation_directory = make_step_folder(subject_directory, STEPS[2])
+    folder_path = make_step_folder(subject_directory, STEPS[3])
+    freesurf_output_dir = os.path.join(output_folder, "freesurfer_outputs")
+    inputs = dict(segmentation_outputs(output_folder, subj_name), **b1correction_outputs(subject_directory))
+    inputs['FreeSurferColorLUT'] = os.path.join(freesurferHome, 'FreeSurferColorLUT.txt')
+    if n_depths:
+        inputs.update({name: os.path.join(freesurf_output_dir, subj_name, name) for name in FREESURFER_SURFACES})
+    outputs = {name: os.path.join(segmentation_directory, name + '_orig.mgz')
+               for name in ['brainmask', 'seg_DKT', 'seg_hippo_lh', 'seg_hippo_rh']}
+    outputs.update({name: os.path.join(folder_path, name + '.nii.gz') for name in ['t1q_cor_clean', 'R1q_cor_clean']})
+    outputs.update({name: os.path.join(folder_path, name + '.txt')
+                    for name in ['R1_per_regions_dkt', 'R1_per_regions_hippo_lh', 'R1_per_regions_hippo_rh']})
+    outputs['R1_per_regions'] = os.path.join(folder_path, 'R1_per_regions.' + table_format)
+    if exclude_csf:
+        outputs.update({name: os.path.join(folder_path, name + '.nii.gz')
+                        for name in ['t1q_cor_clean_nocsf', 'R1q_cor_clean_nocsf']})
+    parameters = {'table_format': table_format, 'exclude_csf': exclude_csf}
+    if n_depths:
+        outputs['R1_depth_profiles'] = os.path.join(folder_path, 'R1_depth_profiles.' + table_format)
+        parameters.update(n_depths=n_depths, depth_method=depth_method)
+    run = run_step(folder_path, STEPS[3],
+                   lambda: apply_processResults(subject_directory, STEPS, freesurf_output_dir, subj_name,
+                                                freesurferHome, table_format, exclude_csf, slab_size, n_depths,
+                                                depth_method),
+                   inputs=inputs, parameters=parameters,
+                   tool_versions={'hiplay': hiplay.__version__,
+                                  'freesurfer': get_freesurfer_version(freesurferHome)},
+                   outputs=outputs, force=force)
+
+    # Add the statistics of the subject to the results of the cohort
+    if os.path.isfile(outputs['R1_per_regions']):
+        with CohortStore(output_folder) as store:
+            store.add_table(subj_name, outputs['R1_per_regions'])
+    return run
+
+
+def process_subject(subj_name, output_folder, freesurferHome, fslHome, deviceSeptT_directory, noseg=False,
+                    selection='interactive', b1_options=None, force_steps=(), recon_threads=None, parallel=False,
+                    table_format='tsv', exclude_csf=False, n_depths=0, depth_method='equivolume'):
+    """
+    Run the steps of the myelin_content pipeline for one subject
+
+    Each step records a manifest (checksums of its inputs and outputs, parameters and tool versions) in its folder.
+    A step is skipped when it is up to date, and run again when one of its inputs changed, for instance because a
+    previous step was run again and produced different images.
+
+    Parameters
+    ----------
+        subj_name : string
+            subject identifier in format date_NIP
+        output_folder : string
+            main output folder, prepared with prepare_output_folder
+        freesurferHome : string
+            path of the freesurfer installation folder
+        fslHome : string
+            path of the fsl installation folder
+        deviceSeptT_directory : string
+            path to the acquisition directory where the dicoms data are stored
+        noseg : bool
+            if True, only perform the first two steps (no cortical and hippocampal parcellations)
+        selection : string
+            policy to choose between several series matching the same acquisition (see hiplay.acquisition_index)
+        b1_options : dict
+            optional arguments of apply_B1correction (slab_size, n_jobs, io_policy, ...)
+        force_steps : list of strings
+            names of the steps (in STEPS) run even if they are up to date
+        recon_threads : int
+            number of threads of recon-all (-openmp). Default is the freesurfer one
+        parallel : bool
+            process both hemispheres at the same time in recon-all (-parallel)
+        table_format : string
+            format of the table of the R1 statistics, 'tsv' or 'parquet' (see apply_processResults)
+        exclude_csf : bool
+            also save the skull-stripped T1 and R1 maps without the CSF (see apply_processResults)
+        n_depths : int
+            number of cortical depths of the R1 profiles, 0 for no profiles (see apply_processResults)
+        depth_method : string
+            'equivolume' or 'equidistant' placement of the cortical depths
+
+    Returns
+    ---------
+        subject_directory : string
+            path of the folder of the subject results
+
+    """
+    unknown = set(force_steps) - set(STEPS)
+    if unknown:
+        raise ValueError('Unknown steps {}, choose among {}'.format(sorted(unknown), STEPS))
+    subject_directory = os.path.join(output_folder, subj_name)
+    os.makedirs(subject_directory, exist_ok=True)
+
+    #-------------1. Load DICOM and convert in Nifti-------------------
+    run_inputs_step(subj_name, output_folder, deviceSeptT_directory, selection, force=STEPS[0] in force_steps)
+
+    #----------- 2. B1 correction---------------------------------------------
+    run_b1correction_step(subj_name, output_folder, fslHome, b1_options, force=STEPS[1] in force_steps)
+
+    if not noseg:
+        #------------ 3. Segmentation  ------------------------------------------
+        run_segmentation_step(subj_name, output_folder, freesurferHome, recon_threads, parallel,
+                              force=STEPS[2] in force_steps)
+
+        #------------ 4. Analysis--------------------------------------------------------
+        run_results_step(subj_name, output_folder, freesurferHome, table_format, exclude_csf,
+                         (b1_options or {}).get('slab_size'), n_depths, depth_method, force=STEPS[3] in force_steps)
+
+    print("INFO : End of process. Results for {} can be find in {}".format(subj_name, subject_directory))
+    return subject_directory
+
+
+def read_subject_list(path):
+    """
+    Read a list of subjects from a text file : one date_NIP per line (first column if the line has several columns
+    separated by spaces, tabulations or commas). Empty lines and lines starting with # are ignored.
+    """
+    subjects = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                subjects.append(line.replace(',', ' ').split()[0])
+    return subjects
+
+
+def run_batch(subjects, output_folder, freesurferHome, fslHome, deviceSeptT_directory, noseg=False,
+              selection='highest', b1_options=None, force_steps=(), n_cores=None, memory=None, recon_threads=4,
+              parallel=False, table_format='tsv', exclude_csf=False, n_depths=0, depth_method='equivolume'):
+    """
+    Run the pipeline for several subjects with a ResourceScheduler (see hiplay.scheduler)
+
+    Each step of each subject is a task with an estimate of the cores and memory it needs. The cortical parcellation
+    of a subject starts as soon as its inputs are converted, so the B1 corrections of the other subjects run while
+    the segmentations are running, and the hippocampal parcellation is a task depending on the cortical one.
+    The MP2RAGE lookup table is computed once before starting the workers, which then read it from the cache.
+    A failing subject is reported in the summary and does not stop the other subjects.
+
+    Parameters
+    ----------
+        subjects : list of strings
+            subjects identifiers in format date_NIP
+        output_folder : string
+            main output folder
+        freesurferHome, fslHome, deviceSeptT_directory, noseg, selection, b1_options, force_steps, table_format,
+        exclude_csf, n_depths, depth_method :
+            see process_subject
+        n_cores : int
+            number of cores shared by all the tasks. Default is all the cores of the machine
+        memory : float
+            memory in GB shared by all the tasks. Default is the physical memory of the machine
+        recon_threads : int
+            number of threads of each recon-all job (-openmp)
+        parallel : bool
+            process both hemispheres at the same time in recon-all (-parallel), the job then uses twice more cores
+
+    Returns
+    ---------
+        summaries : list of dict
+            one dict per subject with keys 'subject', 'status' ('success' or 'failure'), 'error' and 'seconds'.
+            The summary is also written in batch_summary.tsv in the output folder.
+
+    """
+    unknown = set(force_steps) - set(STEPS)
+    if unknown:
+        raise ValueError('Unknown steps {}, choose among {}'.format(sorted(unknown), STEPS))
+    prepare_output_folder(output_folder)
+    b1_options = b1_options or {}
+
+    # Share one lookup table between the workers
+    from hiplay.lookup_table import read_system_parameters, load_lookup_table
+    param_system = read_system_parameters(os.path.join(PROJECT_DIRECTORY, 'MR_system_parameters'))
+    load_lookup_table(param_system, cache_directory=b1_options.get('cache_directory'))
+
+    scheduler = ResourceScheduler(n_cores, memory)
+    subject_tasks = {}
+    for subj_name in subjects:
+        os.makedirs(os.path.join(output_folder, subj_name), exist_ok=True)
+        tasks = [scheduler.submit('{} {}'.format(subj_name, STEPS[0]), run_inputs_step,
+                                  (subj_name, output_folder, deviceSeptT_directory, selection, 1),
+                                  {'force': STEPS[0] in force_steps}, cores=1, memory=TASK_MEMORY['inputs'])]
+        tasks.append(scheduler.submit('{} {}'.format(subj_name, STEPS[1]), run_b1correction_step,
+                                      (subj_name, output_folder, fslHome, b1_options),
+                                      {'force': STEPS[1] in force_steps}, cores=b1_options.get('n_jobs') or 1,
+                                      memory=TASK_MEMORY['b1correction'], depends_on=[tasks[0]]))
+        if not noseg:
+            tasks.append(scheduler.submit('{} {} (recon-all)'.format(subj_name, STEPS[2]), run_segmentation_step,
+                                          (subj_name, output_folder, freesurferHome, recon_threads, parallel, 'recon'),
+                                          {'force': STEPS[2] in force_steps},
+                                          cores=recon_threads * (2 if parallel else 1),
+                                          memory=TASK_MEMORY['recon-all'], depends_on=[tasks[0]]))
+            tasks.append(scheduler.submit('{} {} (hippocampal subfields)'.format(subj_name, STEPS[2]),
+                                          run_segmentation_step,
+                                          (subj_name, output_folder, freesurferHome, recon_threads, False,
+                                           'hippocampal'),
+                                          cores=recon_threads, memory=TASK_MEMORY['hippocampal'],
+                                          depends_on=[tasks[2]]))
+            tasks.append(scheduler.submit('{} {}'.format(subj_name, STEPS[3]), run_results_step,
+                                          (subj_name, output_folder, freesurferHome, table_format, exclude_csf,
+                                           b1_options.get('slab_size'), n_depths, depth_method),
+                                          {'force': STEPS[3] in force_steps}, cores=1,
+                                          memory=TASK_MEMORY['results'], depends_on=[tasks[1], tasks[3]]))
+        subject_tasks[subj_name] = tasks
+
+    print('INFO : Process {} subjects with {} cores and {:.0f} GB'.format(len(subjects), scheduler.n_cores,
+                                                                         scheduler.memory))
+    scheduler.run()
+    scheduler.report()
+
+    summaries = []
+    for subj_name in subjects:
+        tasks = subject_tasks[subj_name]
+        failed = [task for task in tasks if task.status != 'success']
+        summaries.append({'subject': subj_name, 'status': 'failure' if failed else 'success',
+                          'error': '{} : {}'.format(failed[0].name, failed[0].error) if failed else '',
+                          'seconds': sum(task.seconds for task in tasks)})
+
+    summary_path = os.path.join(output_folder, 'batch_summary.tsv')
+    with open(summary_path, 'w') as f:
+        f.write('subject\tstatus\tseconds\terror\n')
+        for summary in summaries:
+            f.write('{}\t{}\t{:.1f}\t{}\n'.format(summary['subject'], summary['status'], summary['seconds'],
+                                                  summary['error'].replace('\t', ' ').replace('\n', ' ')))
+
+    n_failures = sum(summary['status'] == 'failure' for summary in summaries)
+    print('INFO : {} subjects succeeded, {} failed. Summary saved in {}'
+          .format(len(summaries) - n_failures, n_failures, summary_path))
+    return summaries
@@ -1,10 +1,102 @@
-import subprocess
 import shutil
 import os
 import re
-import sys
+from concurrent.futures import ProcessPoolExecutor
+
+
+from hiplay.acquisition_index import AcquisitionIndex, select_series
+from hiplay.instrumentation import stage
+
+# regular expressions of the series folders of each acquisition, name of the copied dicom image and of the nifti image
+ACQUISITION_DICOM_IDENTIFIERS = ['(.*)b1-map-xfl-sag-B1(.*)',
+                                 '(.*)t1-mp2rage-sag-iso0.75mm-T1-Images(.*)',
+                                 '(.*)t1-mp2rage-sag-iso0.75mm-UNI-Images(.*)',
+                                 '(.*)t1-mp2rage-sag-iso0.75mm-UNI-DEN(.*)']
+ACQUISITION_NIFTI_IDENTIFIERS = ['b1', 't1_image', 'uni_images', 'uni-den']
+OUTPUT_FILES_NAMES = ['b1map', 't1q', 't1uni', 't1uni_den']
+
+
+def convert_series(dicom_directory, output_file, info_file):
+    """
+    Convert one dicom series to a compressed nifti image with dicom2nifti and copy one of its dicom images
+
+    Parameters
+    ----------
+        dicom_directory : string
+            folder of the dicom series
+        output_file : string
+            path of the nifti image to create (.nii.gz)
+        info_file : string
+            path where one dicom image of the series is copied (to extract header information)
+
+    Returns
+    ---------
+        output_file : string
+            path of the nifti image
+
+    """
+    import dicom2nifti  # imported here, it loads scipy and pydicom
+
+    dicom2nifti.dicom_series_to_nifti(dicom_directory, output_file, reorient_nifti=True)
+
+    # Copy one dcm image
+    dcm_list = sorted(os.listdir(dicom_directory))
+    shutil.copyfile(os.path.join(dicom_directory, dcm_list[1]), info_file)
+
+    return output_file
+
+
+def find_series_directories(acquisition_index, acquisition_dicom_identifiers, NIP, date, selection='interactive'):
+    """
+    Find the dicom folder of each acquisition of a subject in the acquisition database
+
+    Parameters
+    ----------
+        acquisition_index : AcquisitionIndex
+            index of the acquisition database
+        acquisition_dicom_identifiers : list of strings
+            regular expressions matching the name of the series folders, one per acquisition
+        NIP  : string
+            patient/control acquisition number
+        date  : string
+            patient/control date number in format yyyymmdd
+        selection : string
+            policy to choose between several series matching the same acquisition (see hiplay.acquisition_index)
+
+    Returns
+    ---------
+        series_directories : list of strings
+            path of the series folder of each acquisition
 
-def apply_processInput(deviceSeptT_directory, steps, acquisition_output_directory, NIP, date):
+    """
+    deviceSeptT_directory = acquisition_index.database_directory
+    # Find the subject folder based on NIP
+    matching_nip_folders = acquisition_index.subjects(date, NIP)
+    if len(matching_nip_folders) != 1:
+        raise OSError('Could not find folder matching the subject {} in the acquisition folder {}'.format(NIP, deviceSeptT_directory))
+
+    # Dive into the subject directory
+    subject_dicom = os.path.join(deviceSeptT_directory, date, matching_nip_folders[0])
+    series_directories = []
+    # Loop over the different acquisition we want to fetch
+    for identifier in acquisition_dicom_identifiers:
+        # Find the folder corresponding to the current identifiers
+        matching_series = acquisition_index.series(date, matching_nip_folders[0], identifier)
+        # If two or more matching pattern are found, choose one with the selection policy and raise a warning
+        if len(matching_series) >= 2:
+            print('WARNING : Find {} acquisition folders matching your request: {}. Selection : {}'
+                  .format(len(matching_series), [m['folder'] for m in matching_series], selection))
+        elif len(matching_series) == 0:
+            raise FileNotFoundError("Could not find an acquisition matching '{}' in the subject's acquisition folder {}".format(identifier, subject_dicom))
+
+        # Dive into the right dicom folder for the right folder
+        series_directories.append(os.path.join(subject_dicom, select_series(matching_series, selection)))
+
+    return series_directories
+
+
+def apply_processInput(deviceSeptT_directory, steps, acquisition_output_directory, NIP, date, n_jobs=None,
+                       selection='interactive', index=None, series_directories=None):
     """
     Download dicom images from a MRI scanner database, based on regular
     expression to search the right folder + Copy in the output directory one dicom image per dicom folder
@@ -21,7 +113,21 @@ def apply_processInput(deviceSeptT_directory, steps, acquisition_output_director
             patient/control acquisition number
         date  : string
             patient/control date number in format yyyymmdd
-
+        n_jobs : int
+            number of series converted in parallel. Default converts all the series at once
+        selection : string
+            policy to choose between several series matching the same acquisition :
+            'interactive' (ask), 'first', 'latest' or 'highest' (series number), see hiplay.acquisition_index
+        index : AcquisitionIndex
+            index of the acquisition database. Default opens the index stored in the hiplay cache directory
+        series_directories : list of strings
+            series folders already found with find_series_directories (in the order of ACQUISITION_DICOM_IDENTIFIERS).
+            Default looks for them in the acquisition database
+
+    Returns
+    ---------
+        produced : dict
+            path of the nifti images created, keyed by their name (b1map, t1q, t1uni, t1uni_den)
 
     Outputs
     ---------
@@ -37,84 +143,33 @@ def apply_processInput(deviceSeptT_directory, steps, acquisition_output_director
 
 
 
-    #------------------ SET UP IDENTIFIERS------------------------------------------------------------------------
-    acquisition_dicom_identifiers = ['(.*)b1-map-xfl-sag-B1(.*)',
-                                     '(.*)t1-mp2rage-sag-iso0.75mm-T1-Images(.*)',
-                                     '(.*)t1-mp2rage-sag-iso0.75mm-UNI-Images(.*)',
-                                     '(.*)t1-mp2rage-sag-iso0.75mm-UNI-DEN(.*)']
-
-    acquisition_nifti_identifiers = ['b1', 't1_image', 'uni_images', 'uni-den']
-    output_files_names = ['b1map', 't1q', 't1uni', 't1uni_den']
-
-
-
     #-----------------PROCESS--------------------------------------------------------------------------------------
     print("INFO : Get DICOM data and convert to NIFTI in folder {}".format(steps[0]))
 
-    # Locate the acquisition data folder and dive into the corresponding nip
-    subject_acquisition_date_directory = os.path.join(deviceSeptT_directory, date)
-    # List the corresponding folders
-    acquisition_date_folder_list = os.listdir(subject_acquisition_date_directory)
-    # Find the subject folder based on NIP
-    nip_pattern = re.compile('{}(.*)'.format(NIP))
-    matching_nip_folders = \
-        [nip_pattern.search(f).group() for f in acquisition_date_folder_list
-         if nip_pattern.search(f) is not None]
-    if len(matching_nip_folders) == 1:
-        # Dive into the subject directory
-        subject_dicom = os.path.join(deviceSeptT_directory, date, matching_nip_folders[0])
-        subject_dicom_list = os.listdir(subject_dicom)
-        # Loop over the different acquisition we want to fetch
-        for acq in range(len(acquisition_dicom_identifiers)):
-            # Find the folder corresponding to the current identifiers
-            acq_pattern = re.compile('{}'.format(acquisition_dicom_identifiers[acq]))
-            matching_acquisition_folders = \
-                [acq_pattern.search(f).group() for f in subject_dicom_list
-                 if acq_pattern.search(f) is not None]
-            # If two or more matching pattern are found, take the first one
-            # by defaults and raise a warning
-            if len(matching_acquisition_folders) >= 2 :
-                print('WARNING : Find {} acquisition folders matching your request: {}.'.format(len(matching_acquisition_folders), matching_acquisition_folders))
-                try:
-                    num = int(input("Please enter the acquisition number you would like (1= first, 2=second, ...) = "))
-                except ValueError:
-                    print("Oops!  That was no valid number.  Try again...")
-
-                if num <= len(matching_acquisition_folders) :
-                    matching_acquisition_folder = matching_acquisition_folders[num-1]
-                else :
-                    raise ValueError("Number out of range!")
-            elif len(matching_acquisition_folders) == 0 :
-                raise FileNotFoundError("Could not find an acquisition matching '{}' in the subject's acquisition folder {}".format(acquisition_dicom_identifiers[acq], subject_dicom))
-            else:
-                matching_acquisition_folder = matching_acquisition_folders[0]
-
-            # Dive into the right dicom folder for the right folder
-            subject_dicom_images = os.path.join(subject_dicom, matching_acquisition_folder)
-
-            # # Copy all dicom image in the chosen root directory with the chosen
-            #     # subtree architecture
-            subprocess.call('dicom2nifti {} {}'.format(subject_dicom_images, acquisition_output_directory),
-                                shell=True)
-            #
-            # # List the files in the output folder
-            filename_list = os.listdir(acquisition_output_directory)
-            contrast_pattern = re.compile('(.*){}(.*)'.format(acquisition_nifti_identifiers[acq]))
-            filename = [contrast_pattern.search(f).group() for f in filename_list if contrast_pattern.search(f) is not None]
-            # New file name
-            filename_output = os.path.join(acquisition_output_directory, acquisition_nifti_identifiers[acq] + '.nii.gz')
-            # rename the file
-            os.rename(os.path.join(acquisition_output_directory, filename[0]), filename_output)
-
-            # Copy one dcm image
-            dcm_list = os.listdir(subject_dicom_images)
-            file = os.path.join(subject_dicom_images,dcm_list[1])
-            copy_file = os.path.join(acquisition_output_directory,'info_'+ acquisition_nifti_identifiers[acq])
-            shutil.copyfile(file,copy_file)
-
-            # Set new files name
-            os.rename(os.path.join(acquisition_output_directory, acquisition_nifti_identifiers[acq] + '.nii.gz'),
-                      os.path.join(acquisition_output_directory, output_files_names[acq] + '.nii.gz'))
-
-    else :
-        raise OSError('Could not find folder matching the subject {} in the acquisition folder {}'.format(NIP, deviceSeptT_directory))
\ No newline at end of file
+    # Locate the subject and series folders using the index of the acquisition database
+    if series_directories is None:
+        acquisition_index = AcquisitionIndex(deviceSeptT_directory) if index is None else index
+        try:
+            with stage('series lookup'):
+                series_directories = find_series_directories(acquisition_index, ACQUISITION_DICOM_IDENTIFIERS, NIP,
+                                                             date, selection)
+        finally:
+            if index is None:
+                acquisition_index.close()
+
+    # Convert the series to nifti in parallel and copy one dicom image of each series
+    if n_jobs is None:
+        n_jobs = len(series_directories)
+    tasks = []
+    for acq in range(len(series_directories)):
+        tasks.append((series_directories[acq],
+                      os.path.join(acquisition_output_directory, OUTPUT_FILES_NAMES[acq] + '.nii.gz'),
+                      os.path.join(acquisition_output_directory, 'info_' + ACQUISITION_NIFTI_IDENTIFIERS[acq])))
+    with stage('dicom conversion', series=len(tasks), n_jobs=n_jobs):
+        if n_jobs == 1:
+            produced = [convert_series(*task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers=max(1, n_jobs)) as pool:
+                produced = list(pool.map(convert_series, *zip(*tasks)))
+
+    return dict(zip(OUTPUT_FILES_NAMES, produced))
@@ -0,0 +1,210 @@
+# Module
+import os
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from scipy import ndimage
+
+
+def trilinear_sample(volume, coords, cval=0.0, dtype=np.float64):
+    """
+    Sample a 3D volume at continuous voxel coordinates with a trilinear interpolation
+
+    Points outside of [0, n - 1] on any axis are not extrapolated and get the value cval.
+
+    Parameters
+    ----------
+        volume : array (nx, ny, nz)
+            volume to sample
+        coords : array (3, ...)
+            voxel coordinates (i, j, k) of the points to sample
+        cval : float
+            value given to the points outside of the volume
+        dtype : numpy dtype
+            floating point type of the volume values and of the interpolation, np.float32 or np.float64. The
+            coordinates stay in float64 so that the points on the border of the volume are found in both cases
+
+    Returns
+    ---------
+        values : array (...)
+            interpolated values at each point, in dtype
+
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    return ndimage.map_coordinates(np.asarray(volume, dtype=dtype), coords, output=dtype, order=1, mode='constant',
+                                   cval=cval, prefilter=False)
+
+
+def voxel_grid(shape, z_range=None):
+    """return the voxel coordinates (3, nx, ny, nz) of a 3D grid, restricted to the slices of z_range"""
+    z_start, z_stop = (0, shape[2]) if z_range is None else z_range
+    return np.array(np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), np.arange(z_start, z_stop),
+                                indexing='ij'), dtype=float)
+
+
+def resample_to_reference(data, affine, ref_shape, ref_affine, z_range=None, cval=0.0, n_jobs=1, dtype=np.float64):
+    """
+    Resample a 3D volume on the grid of a reference image with a trilinear interpolation
+
+    The voxels of both images are matched through their voxel to world affines (sform or qform), as done by
+    "flirt -usesqform -applyxfm" of FSL.
+
+    Parameters
+    ----------
+        data : array (nx, ny, nz)
+            volume to resample
+        affine : array (4, 4)
+            voxel to world affine of data
+        ref_shape : tuple
+            shape of the reference grid
+        ref_affine : array (4, 4)
+            voxel to world affine of the reference grid
+        z_range : tuple
+            (z_start, z_stop) to only compute the slices z_start to z_stop - 1 of the reference grid
+        cval : float
+            value given to the voxels outside of data
+        n_jobs : int
+            number of threads, each one resampling a slab of the output. None uses all the cores
+        dtype : numpy dtype
+            floating point type of the interpolated values, np.float32 or np.float64 (see trilinear_sample)
+
+    Returns
+    ---------
+        resampled : array (ref_shape[0], ref_shape[1], z_stop - z_start) in dtype
+
+    """
+    z_start, z_stop = (0, ref_shape[2]) if z_range is None else z_range
+    vox2vox = np.linalg.inv(affine).dot(ref_affine)
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+
+    def resample_slab(bounds):
+        grid = voxel_grid(ref_shape, bounds)
+        coords = np.tensordot(vox2vox[:3, :3], grid, axes=1) + vox2vox[:3, 3].reshape(3, 1, 1, 1)
+        del grid
+        return trilinear_sample(data, coords, cval, dtype)
+
+    n_slabs = max(1, min(n_jobs, z_stop - z_start))
+    bounds = np.linspace(z_start, z_stop, n_slabs + 1).astype(int)
+    slabs = list(zip(bounds[:-1], bounds[1:]))
+    if n_slabs == 1:
+        return resample_slab(slabs[0])
+    with ThreadPoolExecutor(max_workers=n_slabs) as pool:
+        return np.concatenate(list(pool.map(resample_slab, slabs)), axis=2)
+
+
+
+def resample_voxels(data, affine, ref_affine, voxels, cval=0.0, dtype=np.float64):
+    """
+    Resample a 3D volume at some voxels of the grid of a reference image with a trilinear interpolation, like
+    resample_to_reference for a list of voxels (e.g. the voxels of a mask)
+
+    Parameters
+    ----------
+        data : array (nx, ny, nz)
+            volume to resample
+        affine : array (4, 4)
+            voxel to world affine of data
+        ref_affine : array (4, 4)
+            voxel to world affine of the reference grid
+        voxels : array of int (3, n)
+            indices (i, j, k) of the voxels of the reference grid, e.g. np.nonzero(mask)
+        cval, dtype :
+            see resample_to_reference
+
+    Returns
+    ---------
+        values : array (n,) in dtype
+
+    """
+    vox2vox = np.linalg.inv(affine).dot(ref_affine)
+    coords = vox2vox[:3, :3].dot(np.asarray(voxels, dtype=np.float64)) + vox2vox[:3, 3].reshape(3, 1)
+    return trilinear_sample(data, coords, cval, dtype)
+
+
+# nearest neighbour mappings already computed, keyed by the geometries of the source and reference grids
+_MAPPING_CACHE = OrderedDict()
+MAPPING_CACHE_SIZE = 4
+
+
+def _geometry_key(shape, affine, ref_shape, ref_affine):
+    return (tuple(shape), np.asarray(affine, dtype=np.float64).tobytes(),
+            tuple(ref_shape), np.asarray(ref_affine, dtype=np.float64).tobytes())
+
+
+def nearest_neighbour_mapping(shape, affine, ref_shape, ref_affine, slab_size=16):
+    """
+    Compute, for each voxel of a reference grid, the index of the nearest voxel of a source grid
+
+    The voxels of both grids are matched through their voxel to world affines. The continuous source coordinates
+    are rounded half away from zero like freesurfer mri_convert -rt nearest.
+    The mapping is cached : the next calls with the same geometries return the same array without computing it.
+
+    Parameters
+    ----------
+        shape : tuple
+            shape of the source grid
+        affine : array (4, 4)
+            voxel to world affine of the source grid
+        ref_shape : tuple
+            shape of the reference grid
+        ref_affine : array (4, 4)
+            voxel to world affine of the reference grid
+        slab_size : int
+            number of slices of the reference grid whose coordinates are computed at a time
+
+    Returns
+    ---------
+        mapping : array of int (ref_shape)
+            flat index (Fortran order) of the source voxel of each reference voxel, -1 outside of the source grid
+
+    """
+    shape, ref_shape = tuple(shape[:3]), tuple(ref_shape[:3])
+    key = _geometry_key(shape, affine, ref_shape, ref_affine)
+    if key in _MAPPING_CACHE:
+        _MAPPING_CACHE.move_to_end(key)
+        return _MAPPING_CACHE[key]
+
+    vox2vox = np.linalg.inv(affine).dot(ref_affine)
+    index_dtype = np.int32 if np.prod(shape) < 2 ** 31 else np.int64
+    mapping = np.empty(ref_shape, dtype=index_dtype)
+    i = np.arange(ref_shape[0], dtype=np.float64).reshape(-1, 1, 1)
+    j = np.arange(ref_shape[1], dtype=np.float64).reshape(1, -1, 1)
+    for z_start in range(0, ref_shape[2], slab_size):
+        k = np.arange(z_start, min(z_start + slab_size, ref_shape[2]), dtype=np.float64).reshape(1, 1, -1)
+        index = np.zeros(np.broadcast(i, j, k).shape, dtype=index_dtype)
+        inside = np.ones(index.shape, dtype=bool)
+        stride = 1
+        for axis in range(3):
+            coord = vox2vox[axis, 0] * i + vox2vox[axis, 1] * j + vox2vox[axis, 2] * k + vox2vox[axis, 3]
+            coord = np.floor(np.abs(coord) + 0.5) * np.sign(coord)
+            inside &= (coord >= 0) & (coord <= shape[axis] - 1)
+            index += (np.clip(coord, 0, shape[axis] - 1).astype(index_dtype) * stride).astype(index_dtype)
+            stride *= shape[axis]
+        index[~inside] = -1
+        mapping[:, :, z_start:z_start + index.shape[2]] = index
+
+    _MAPPING_CACHE[key] = mapping
+    while len(_MAPPING_CACHE) > MAPPING_CACHE_SIZE:
+        _MAPPING_CACHE.popitem(last=False)
+    return mapping
+
+
+def resample_nearest(data, affine, ref_shape, ref_affine, cval=0):
+    """
+    Resample a 3D volume (e.g. labels or a mask) on the grid of a reference image with a nearest neighbour
+    interpolation, as done by "mri_convert -rt nearest -rl" of freesurfer
+
+    The voxel mapping is computed once per pair of geometries (see nearest_neighbour_mapping), so the volumes
+    sharing the same grid (e.g. all the outputs of freesurfer for a subject) only cost one lookup each.
+
+    Returns
+    ---------
+        resampled : array (ref_shape) of the data type of data
+
+    """
+    data = np.asarray(data)
+    mapping = nearest_neighbour_mapping(data.shape, affine, ref_shape, ref_affine)
+    resampled = data.ravel(order='F').take(np.maximum(mapping, 0))
+    resampled[mapping < 0] = cval
+    return resampled
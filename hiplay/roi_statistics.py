@@ -0,0 +1,248 @@
+# Module
+import csv
+import time
+import numpy as np
+
+# percentiles computed for each region, in addition to the median
+PERCENTILES = (5, 25, 75, 95)
+
+# columns of the statistics tables
+TABLE_COLUMNS = ['atlas', 'label', 'name', 'count', 'volume_mm3', 'mean', 'std', 'min', 'max', 'median'] + \
+                ['p{:g}'.format(q) for q in PERCENTILES]
+
+# formats of the statistics tables : tab separated text or parquet (requires pyarrow)
+TABLE_FORMATS = ['tsv', 'parquet']
+
+
+def read_color_lut(file_path):
+    """
+    Read the names of the labels from a freesurfer color table (FreeSurferColorLUT.txt)
+
+    Returns
+    ---------
+        names : dict
+            name of each label, keyed by the label value (int)
+
+    """
+    names = {}
+    with open(file_path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 2 and not fields[0].startswith('#') and fields[0].isdigit():
+                names[int(fields[0])] = fields[1]
+    return names
+
+
+def label_statistics(values, labels, percentiles=PERCENTILES, exclude_labels=(), ddof=1):
+    """
+    Compute statistics of values in each region of a label volume
+
+    The voxels are grouped with one sort by (label, value) : counts, sums and sums of squares are reduced per group
+    and the median and percentiles are read in the sorted values, without a loop over the labels.
+    Voxels where values is NaN or infinite are ignored.
+
+    Parameters
+    ----------
+        values : array
+            image of the values (e.g. R1 map)
+        labels : array of int
+            label volume of the same shape as values
+        percentiles : list of floats
+            percentiles (0 to 100) computed in each region, with a linear interpolation like numpy.percentile
+        exclude_labels : list of int
+            labels which are not reported. Default reports all the labels, including the background 0, like
+            mri_segstats without --excludeid
+        ddof : int
+            delta degrees of freedom of the standard deviation
+
+    Returns
+    ---------
+        statistics : dict
+            arrays (one value per label) with keys 'label', 'count', 'mean', 'std', 'min', 'max', 'median' and
+            'p<q>' for each percentile q
+
+    """
+    values = np.asarray(values).ravel()
+    labels = np.asarray(labels).ravel()
+    if values.shape != labels.shape:
+        raise ValueError('values and labels must have the same number of voxels, got {} and {}'
+                         .format(values.size, labels.size))
+    if not np.issubdtype(labels.dtype, np.integer):
+        labels = np.rint(labels).astype(np.int64)
+
+    keep = np.isfinite(values)
+    for label in exclude_labels:
+        keep &= labels != label
+    values = values[keep].astype(np.float64)
+    labels = labels[keep]
+
+    order = np.lexsort((values, labels))
+    values = values[order]
+    labels = labels[order]
+    unique, starts, counts = np.unique(labels, return_index=True, return_counts=True)
+
+    statistics = {'label': unique, 'count': counts}
+    if unique.size == 0:
+        for key in ['mean', 'std', 'min', 'max', 'median'] + ['p{:g}'.format(q) for q in percentiles]:
+            statistics[key] = np.zeros(0)
+        return statistics
+
+    mean = np.add.reduceat(values, starts) / counts
+    squares = np.add.reduceat((values - np.repeat(mean, counts)) ** 2, starts)
+    statistics['mean'] = mean
+    statistics['std'] = np.sqrt(squares / np.maximum(counts - ddof, 1))
+    statistics['min'] = values[starts]
+    statistics['max'] = values[starts + counts - 1]
+
+    def percentile(q):
+        position = (counts - 1) * q / 100.
+        below = np.floor(position).astype(np.int64)
+        above = np.minimum(below + 1, counts - 1)
+        fraction = position - below
+        return values[starts + below] * (1 - fraction) + values[starts + above] * fraction
+
+    statistics['median'] = percentile(50)
+    for q in percentiles:
+        statistics['p{:g}'.format(q)] = percentile(q)
+    return statistics
+
+
+def atlas_statistics(values, atlases, names=None, voxel_volume=1.0, percentiles=PERCENTILES, exclude_labels=()):
+    """
+    Compute the statistics of values in the regions of several atlases in a single pass
+
+    The labels of the atlases are shifted so that they do not overlap and are grouped with one call to
+    label_statistics.
+
+    Parameters
+    ----------
+        values : array
+            image of the values (e.g. R1 map), loaded once
+        atlases : dict
+            label volumes (same shape as values) keyed by the name of the atlas
+        names : dict
+            names of the labels (see read_color_lut). Labels without name are called Seg<label>
+        voxel_volume : float
+            volume of a voxel in mm3
+        percentiles, exclude_labels :
+            see label_statistics
+
+    Returns
+    ---------
+        rows : list of dict
+            one dict per region and atlas with the keys of TABLE_COLUMNS
+
+    """
+    names = names or {}
+    atlas_names = list(atlases)
+    keys = []
+    grouped_values = []
+    offsets = []
+    offset = 0
+    values = np.asarray(values)
+    mask = np.isfinite(values)
+    for atlas in atlas_names:
+        labels = np.asarray(atlases[atlas])
+        if labels.shape != values.shape:
+            raise ValueError('Atlas {} has shape {}, the values have shape {}'
+                             .format(atlas, labels.shape, values.shape))
+        if not np.issubdtype(labels.dtype, np.integer):
+            labels = np.rint(labels).astype(np.int64)
+        if labels.size and labels.min() < 0:
+            raise ValueError('Atlas {} contains negative labels'.format(atlas))
+        keep = mask.copy()
+        for label in exclude_labels:
+            keep &= labels != label
+        keys.append(labels[keep].astype(np.int64) + offset)
+        grouped_values.append(values[keep])
+        offsets.append(offset)
+        offset += int(labels.max()) + 1 if labels.size else 1
+
+    statistics = label_statistics(np.concatenate(grouped_values), np.concatenate(keys), percentiles,
+                                  exclude_labels=())
+
+    rows = []
+    atlas_index = np.searchsorted(offsets, statistics['label'], side='right') - 1
+    for i, key in enumerate(statistics['label']):
+        label = int(key - offsets[atlas_index[i]])
+        row = {'atlas': atlas_names[atlas_index[i]], 'label': label,
+               'name': names.get(label, 'Seg{:04d}'.format(label)),
+               'count': int(statistics['count'][i]), 'volume_mm3': statistics['count'][i] * voxel_volume}
+        for column in ['mean', 'std', 'min', 'max', 'median'] + ['p{:g}'.format(q) for q in percentiles]:
+            row[column] = float(statistics[column][i])
+        rows.append(row)
+    return rows
+
+
+def write_statistics_table(file_path, rows, columns=None):
+    """
+    Write statistics rows (see atlas_statistics) in a table, tab separated text (.tsv) or parquet (.parquet)
+
+    Writing parquet files requires the package pyarrow.
+    """
+    columns = columns or (list(rows[0]) if rows else TABLE_COLUMNS)
+    if file_path.endswith('.parquet'):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('Writing the statistics in parquet requires pyarrow (pip install pyarrow)')
+        table = pa.table({column: [row[column] for row in rows] for column in columns})
+        pq.write_table(table, file_path)
+    else:
+        with open(file_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns, delimiter='\t', extrasaction='ignore',
+                                    lineterminator='\n')
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def write_segstats_sum(file_path, rows, segmentation_path=None, input_path=None, color_lut_path=None,
+                       exclude_labels=()):
+    """
+    Write statistics rows of one atlas in the summary format of freesurfer mri_segstats (--sum)
+
+    The columns are Index SegId NVoxels Volume_mm3 StructName Mean StdDev Min Max Range, as in the files previously
+    written by mri_segstats. exclude_labels are the labels excluded from the rows (see label_statistics), the header
+    "Excluding Background" is only written when the background 0 is excluded.
+    """
+    with open(file_path, 'w') as f:
+        f.write('# Title Segmentation Statistics \n')
+        f.write('# \n')
+        f.write('# generating_program hiplay.roi_statistics\n')
+        f.write('# CreationTime {}\n'.format(time.strftime('%Y/%m/%d-%H:%M:%S-GMT', time.gmtime())))
+        if segmentation_path is not None:
+            f.write('# SegVolFile {} \n'.format(segmentation_path))
+        if color_lut_path is not None:
+            f.write('# ColorTable {} \n'.format(color_lut_path))
+        if input_path is not None:
+            f.write('# InVolFile  {} \n'.format(input_path))
+        if 0 in exclude_labels:
+            f.write('# Excluding Background \n')
+        f.write('# NRows {} \n'.format(len(rows)))
+        f.write('# NTableCols 10 \n')
+        f.write('# ColHeaders  Index SegId NVoxels Volume_mm3 StructName Mean StdDev Min Max Range  \n')
+        for index, row in enumerate(rows):
+            f.write('{:3d} {:4d} {:8d} {:10.1f}  {:<30s} {:10.4f} {:10.4f} {:10.4f} {:10.4f} {:10.4f} \n'
+                    .format(index + 1, row['label'], row['count'], row['volume_mm3'], row['name'], row['mean'],
+                            row['std'], row['min'], row['max'], row['max'] - row['min']))
+
+
+def read_statistics_table(file_path):
+    """read a table written by write_statistics_table and return its rows (list of dict)"""
+    if file_path.endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('Reading the statistics in parquet requires pyarrow (pip install pyarrow)')
+        return pq.read_table(file_path).to_pylist()
+    rows = []
+    with open(file_path, newline='') as f:
+        for row in csv.DictReader(f, delimiter='\t'):
+            for column, value in row.items():
+                if column in ['label', 'count']:
+                    row[column] = int(value)
+                elif column not in ['atlas', 'name']:
+                    row[column] = float(value)
+            rows.append(row)
+    return rows
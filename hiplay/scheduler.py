@@ -0,0 +1,205 @@
+# Module
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+
+def get_total_memory():
+    """return the physical memory of the machine in GB, or None if it cannot be read"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class Task(object):
+    """
+    Function run by a ResourceScheduler, with the resources it needs and the tasks it depends on
+
+    Attributes
+    ----------
+        status : string
+            'pending', 'running', 'success', 'failure' or 'skipped' (a task it depends on did not succeed)
+        error : string
+            description of the failure
+        result :
+            value returned by the function
+        seconds : float
+            duration of the task
+
+    """
+
+    def __init__(self, name, function, args=(), kwargs=None, cores=1, memory=0, depends_on=()):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.cores = cores
+        self.memory = memory
+        self.depends_on = list(depends_on)
+        self.status = 'pending'
+        self.error = ''
+        self.result = None
+        self.seconds = 0.0
+        self._start = None
+        self._isolated = False
+
+    def __repr__(self):
+        return 'Task({}, {})'.format(self.name, self.status)
+
+
+def _call(function, args, kwargs):
+    """run a task in a worker and turn exit() calls into failures"""
+    try:
+        return function(*args, **kwargs)
+    except SystemExit as error:
+        raise RuntimeError('exit() called with code {}'.format(error.code))
+
+
+class ResourceScheduler(object):
+    """
+    Run tasks in worker processes under a global budget of cores and memory
+
+    A task starts when the tasks it depends on succeeded and when its cores and memory are available. The tasks are
+    started in the order they were submitted, a smaller task may start before a larger one which does not fit yet.
+    A task fails when its function raises an exception : the tasks depending on it are skipped, the other tasks go on.
+    If a worker process dies (crash, os._exit, killed by the system when out of memory), the pool is recreated and
+    the tasks which were running are run again one at a time : the task which breaks the pool when it runs alone
+    fails, the other ones are not affected.
+
+    Parameters
+    ----------
+        n_cores : int
+            number of cores shared by the tasks. Default is all the cores of the machine
+        memory : float
+            memory in GB shared by the tasks. Default is the physical memory of the machine
+
+    Example
+    ---------
+        scheduler = ResourceScheduler(n_cores=16, memory=64)
+        recon = scheduler.submit('recon-all', apply_recon_all, args, cores=4, memory=8)
+        scheduler.submit('hippocampal subfields', apply_hippocampal_segmentation, args, depends_on=[recon])
+        tasks = scheduler.run()
+
+    """
+
+    def __init__(self, n_cores=None, memory=None):
+        self.n_cores = n_cores or os.cpu_count()
+        self.memory = memory or get_total_memory() or float('inf')
+        self.tasks = []
+
+    def submit(self, name, function, args=(), kwargs=None, cores=1, memory=0, depends_on=()):
+        """
+        Add a task to the queue. A task which needs more cores or memory than the budget is run alone
+
+        Returns
+        ---------
+            task : Task
+                to use in the depends_on of the following tasks and to read the status after run()
+
+        """
+        task = Task(name, function, args, kwargs, max(1, min(cores, self.n_cores)), min(memory, self.memory),
+                    depends_on)
+        self.tasks.append(task)
+        return task
+
+    def run(self):
+        """run all the submitted tasks and return them when they are all finished"""
+        pending = [task for task in self.tasks if task.status == 'pending']
+        running = {}
+        free_cores, free_memory = self.n_cores, self.memory
+
+        pool = ProcessPoolExecutor(max_workers=self.n_cores)
+        try:
+            while pending or running:
+                for task in list(pending):
+                    failed = [dep.name for dep in task.depends_on if dep.status in ['failure', 'skipped']]
+                    if failed:
+                        task.status = 'skipped'
+                        task.error = 'depends on {} which did not succeed'.format(', '.join(failed))
+                        print('WARNING : Skip {} : {}'.format(task.name, task.error))
+                        pending.remove(task)
+
+                pool_broken = False
+                for task in list(pending):
+                    ready = all(dep.status == 'success' for dep in task.depends_on)
+                    # tasks which were running when a worker died are run alone until the crashed one is found
+                    alone = running and (task._isolated or any(other._isolated for other in running.values()))
+                    if ready and not alone and task.cores <= free_cores and task.memory <= free_memory:
+                        try:
+                            future = pool.submit(_call, task.function, task.args, task.kwargs)
+                        except BrokenProcessPool:
+                            pool_broken = True
+                            break
+                        free_cores -= task.cores
+                        free_memory -= task.memory
+                        task.status = 'running'
+                        task._start = time.time()
+                        print('INFO : Start {} ({} cores, {} GB)'.format(task.name, task.cores, task.memory))
+                        running[future] = task
+                        pending.remove(task)
+
+                if not running and not pool_broken:
+                    break
+                if not pool_broken:
+                    done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                    pool_broken = any(isinstance(future.exception(), BrokenProcessPool) for future in done)
+                if pool_broken:
+                    # all the futures of a broken pool fail, the results computed before are kept
+                    wait(list(running))
+
+                broken = []
+                for future in [future for future in running if future.done()]:
+                    task = running.pop(future)
+                    free_cores += task.cores
+                    free_memory += task.memory
+                    if self._collect(future, task):
+                        broken.append(task)
+                if pool_broken:
+                    pool.shutdown(wait=False)
+                    pool = ProcessPoolExecutor(max_workers=self.n_cores)
+                    self._requeue(broken, pending)
+        finally:
+            pool.shutdown(wait=False)
+
+        return self.tasks
+
+    def _collect(self, future, task):
+        """set the status of a finished task from its future, return True if its worker pool is broken"""
+        task.seconds = time.time() - task._start
+        try:
+            task.result = future.result()
+            task.status = 'success'
+            task._isolated = False
+            print('INFO : End of {} ({:.0f} s)'.format(task.name, task.seconds))
+        except BrokenProcessPool:
+            return True
+        except Exception as error:
+            task.status = 'failure'
+            task.error = '{}: {}'.format(type(error).__name__, error)
+            print('WARNING : {} failed : {}'.format(task.name, task.error))
+            traceback.print_exception(type(error), error, error.__traceback__)
+        return False
+
+    def _requeue(self, broken, pending):
+        """after a worker died : fail the task if it is the only one whose worker was lost, else run them again alone"""
+        if len(broken) == 1:
+            task = broken[0]
+            task.status = 'failure'
+            task.error = 'BrokenProcessPool: the worker process of the task died'
+            print('WARNING : {} failed : {}'.format(task.name, task.error))
+            return
+        if broken:
+            print('WARNING : A worker process died while {} were running, they are run again one at a time'
+                  .format(', '.join(task.name for task in broken)))
+        for task in broken:
+            task.status = 'pending'
+            task._isolated = True
+        pending[:] = sorted(set(pending) | set(broken), key=self.tasks.index)
+
+    def report(self):
+        """print the status and the duration of each task"""
+        for task in self.tasks:
+            print('INFO : {} : {} ({:.0f} s) {}'.format(task.name, task.status, task.seconds, task.error))
@@ -0,0 +1,335 @@
+# Module
+import os
+import re
+import time
+import sqlite3
+import datetime
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from hiplay.acquisition_index import AcquisitionIndex
+from hiplay.preprocess_mp2r import ACQUISITION_DICOM_IDENTIFIERS
+from hiplay.pipeline import (prepare_output_folder, run_inputs_step, run_b1correction_step, run_segmentation_step,
+                             run_results_step)
+
+# name of the job queue in the main output folder, and of the lock file held by the watcher using it
+JOB_QUEUE_NAME = 'job_queue.sqlite'
+WATCH_LOCK_NAME = 'job_queue.lock'
+
+# kinds of jobs : the conversion of the inputs and the B1 correction of a session are run as soon as the session is
+# complete, its segmentation (recon-all, hippocampal subfields and R1 statistics) is queued separately
+JOB_KINDS = ['correction', 'segmentation']
+JOB_STATUSES = ['pending', 'running', 'success', 'failure']
+
+# beginning of the name of a subject folder of the acquisition database which is the NIP of the subject
+NIP_PATTERN = r'^[^-_]+'
+
+
+class JobQueue(object):
+    """
+    Persistent queue of the jobs of the acquisition watcher in one SQLite file
+
+    A job is a kind of processing (JOB_KINDS) of a subject (date_NIP), added once. The queue survives the restarts
+    of the watcher : the jobs which were running when it stopped are pending again when it starts. Several
+    connections can claim jobs from the same queue, each job is only given to one of them.
+
+    Parameters
+    ----------
+        output_folder : string
+            main output folder of the pipeline, where the queue is created
+        queue_path : string
+            path of the SQLite file. Default is job_queue.sqlite in output_folder
+
+    """
+
+    def __init__(self, output_folder=None, queue_path=None):
+        if queue_path is None:
+            queue_path = os.path.join(output_folder, JOB_QUEUE_NAME)
+        self.queue_path = queue_path
+        self.connection = sqlite3.connect(queue_path, timeout=60)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS jobs '
+                                    '(id INTEGER PRIMARY KEY, subject TEXT, kind TEXT, status TEXT, attempts INTEGER, '
+                                    'enqueued REAL, started REAL, finished REAL, error TEXT, UNIQUE (subject, kind))')
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def enqueue(self, subject, kind):
+        """add a pending job, return False if the job of this kind is already in the queue for the subject"""
+        if kind not in JOB_KINDS:
+            raise ValueError('Unknown job kind {}, choose one of {}'.format(kind, JOB_KINDS))
+        with self.connection:
+            cursor = self.connection.execute('INSERT OR IGNORE INTO jobs (subject, kind, status, attempts, enqueued) '
+                                             'VALUES (?, ?, ?, 0, ?)', (subject, kind, 'pending', time.time()))
+        return cursor.rowcount == 1
+
+    def claim(self, kind):
+        """
+        Take the oldest pending job of a kind and mark it as running
+
+        Returns
+        ---------
+            job : tuple
+                (id, subject) of the job, None if there is no pending job
+
+        """
+        with self.connection:
+            while True:
+                row = self.connection.execute('SELECT id, subject FROM jobs WHERE kind = ? AND status = ? '
+                                              'ORDER BY enqueued, id LIMIT 1', (kind, 'pending')).fetchone()
+                if row is None:
+                    return None
+                # the job may have been claimed by another connection since it was selected
+                cursor = self.connection.execute('UPDATE jobs SET status = ?, attempts = attempts + 1, started = ?, '
+                                                 'finished = NULL, error = NULL WHERE id = ? AND status = ?',
+                                                 ('running', time.time(), row[0], 'pending'))
+                if cursor.rowcount == 1:
+                    return row
+
+    def finish(self, job_id, error=None):
+        """mark a job as done, failed if error (description of the failure) is given"""
+        with self.connection:
+            self.connection.execute('UPDATE jobs SET status = ?, finished = ?, error = ? WHERE id = ?',
+                                    ('success' if error is None else 'failure', time.time(), error, job_id))
+
+    def requeue(self, status='running'):
+        """set the jobs of a status ('running' after a restart, 'failure' to retry them) as pending, return their count"""
+        with self.connection:
+            cursor = self.connection.execute('UPDATE jobs SET status = ? WHERE status = ?', ('pending', status))
+        return cursor.rowcount
+
+    def contains(self, subject, kind):
+        """return True if the job of this kind is in the queue for the subject (whatever its status)"""
+        return self.connection.execute('SELECT 1 FROM jobs WHERE subject = ? AND kind = ?',
+                                       (subject, kind)).fetchone() is not None
+
+    def jobs(self, status=None):
+        """
+        return the jobs as a list of (subject, kind, status, attempts, enqueued, started, finished, error), in the
+        order they were added
+        """
+        query = 'SELECT subject, kind, status, attempts, enqueued, started, finished, error FROM jobs'
+        if status is None:
+            return self.connection.execute(query + ' ORDER BY id').fetchall()
+        return self.connection.execute(query + ' WHERE status = ? ORDER BY id', (status,)).fetchall()
+
+
+def find_complete_sessions(index, dates, settle_time=600, identifiers=ACQUISITION_DICOM_IDENTIFIERS, now=None):
+    """
+    Find the sessions of the acquisition database which contain all the series of the pipeline
+
+    A session is complete when each identifier (see hiplay.preprocess_mp2r.ACQUISITION_DICOM_IDENTIFIERS) matches a
+    series folder and no series folder was modified in the last settle_time seconds (the dicom images are still
+    being copied to the database otherwise).
+
+    Parameters
+    ----------
+        index : AcquisitionIndex
+            index of the acquisition database, the folders listed are only read again when they changed
+        dates : list of strings
+            dates (yyyymmdd) to look at
+        settle_time : float
+            seconds without modification of the series folders before a session is complete
+        identifiers : list of strings
+            regular expressions of the series folders of the session
+        now : float
+            current time (time.time())
+
+    Returns
+    ---------
+        subjects : list of strings
+            subject identifiers (date_NIP) of the complete sessions
+
+    """
+    now = time.time() if now is None else now
+    subjects = []
+    for date in dates:
+        date_directory = os.path.join(index.database_directory, date)
+        if not os.path.isdir(date_directory):
+            continue
+        for subject_folder, _ in index.list_directory(date_directory):
+            match = re.match(NIP_PATTERN, subject_folder)
+            if match is None:
+                continue
+            NIP = match.group()
+            series = [index.series(date, subject_folder, identifier) for identifier in identifiers]
+            if not all(series):
+                continue
+            # the modification times of the series folders are read again by the index at each lookup
+            mtime = max(candidate['mtime'] for candidates in series for candidate in candidates)
+            if now - mtime < settle_time:
+                continue
+            if len(index.subjects(date, NIP)) != 1:
+                print('WARNING : Several folders of {} match the NIP {}, process it with myelin_content'
+                      .format(date_directory, NIP))
+                continue
+            subjects.append('{}_{}'.format(date, NIP))
+    return subjects
+
+
+def recent_dates(index, lookback_days, today=None):
+    """return the date folders (yyyymmdd) of the acquisition database of the last lookback_days days"""
+    today = today or datetime.date.today()
+    first = (today - datetime.timedelta(days=lookback_days)).strftime('%Y%m%d')
+    return [name for name, _ in index.list_directory(index.database_directory)
+            if re.match(r'^\d{8}$', name) and name >= first]
+
+
+def run_correction_job(subj_name, output_folder, settings):
+    """convert the inputs and correct the B1 of a subject (steps 1.Inputs and 2.B1correction)"""
+    b1_options = settings.get('b1_options') or {}
+    run_inputs_step(subj_name, output_folder, settings['deviceSeptT_directory'], 'highest',
+                    b1_options.get('n_jobs'))
+    run_b1correction_step(subj_name, output_folder, settings['fslHome'], b1_options)
+
+
+def run_segmentation_job(subj_name, output_folder, settings):
+    """segment a subject and compute its R1 statistics (steps 3.Segmentation and 4.Myelin_proxy)"""
+    run_segmentation_step(subj_name, output_folder, settings['freesurferHome'], settings.get('recon_threads'),
+                          settings.get('parallel', False))
+    run_results_step(subj_name, output_folder, settings['freesurferHome'], settings.get('table_format', 'tsv'),
+                     settings.get('exclude_csf', False), (settings.get('b1_options') or {}).get('slab_size'),
+                     settings.get('n_depths', 0), settings.get('depth_method', 'equivolume'))
+
+
+JOB_FUNCTIONS = {'correction': run_correction_job, 'segmentation': run_segmentation_job}
+
+
+def lock_output_folder(output_folder):
+    """
+    Take the lock of the watcher of an output folder (WATCH_LOCK_NAME), so that a single watcher uses its job queue
+
+    Returns
+    ---------
+        lock : file
+            open lock file, the lock is released when it is closed (or when the watcher process ends)
+
+    """
+    lock = open(os.path.join(output_folder, WATCH_LOCK_NAME), 'w')
+    if fcntl is not None:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            raise RuntimeError('Another watcher is already running on {}'.format(output_folder))
+    return lock
+
+
+def watch(output_folder, settings, poll_interval=60, settle_time=600, lookback_days=2, workers=None, once=False,
+          index_path=None):
+    """
+    Watch the acquisition database and process the new sessions as soon as they are complete
+
+    The date folders of the last days are polled (the acquisition index only lists again the folders which
+    changed, see hiplay.acquisition_index), each complete session (see find_complete_sessions) is added to the job
+    queue of the output folder (see JobQueue) and its correction is started at once. The segmentation job of a
+    subject is queued when its correction succeeds and runs in its own workers, so that the long freesurfer jobs do
+    not delay the B1 correction of the next sessions. The sessions already in the queue are not processed again.
+
+    Only one watcher can run on an output folder : at its start, it sets the jobs left running by the previous
+    watcher as pending again, which would restart the jobs of another running watcher. The watcher holds a lock file
+    in the output folder (see lock_output_folder) and raises a RuntimeError if another watcher holds it.
+
+    Parameters
+    ----------
+        output_folder : string
+            main output folder of the pipeline
+        settings : dict
+            deviceSeptT_directory, fslHome, freesurferHome and the optional noseg, b1_options, recon_threads,
+            parallel, table_format, exclude_csf, n_depths and depth_method (see hiplay.pipeline.process_subject)
+        poll_interval : float
+            seconds between two scans of the acquisition database
+        settle_time : float
+            seconds without modification of its series before a session is processed
+        lookback_days : int
+            number of past days whose date folders are scanned (0 : today only)
+        workers : dict
+            number of jobs of each kind run at the same time. Default is 1 correction and 1 segmentation
+        once : bool
+            scan once, run the queued jobs and return when the queue is empty (e.g. to process the backlog or test)
+        index_path : string
+            path of the acquisition index (see AcquisitionIndex)
+
+    Returns
+    ---------
+        jobs : list of tuples
+            jobs of the queue at the end (see JobQueue.jobs)
+
+    """
+    workers = dict({'correction': 1, 'segmentation': 1}, **(workers or {}))
+    kinds = ['correction'] if settings.get('noseg') else JOB_KINDS
+    prepare_output_folder(output_folder)
+    running = {}
+    next_scan = 0.
+    with lock_output_folder(output_folder), JobQueue(output_folder) as queue, \
+            AcquisitionIndex(settings['deviceSeptT_directory'], index_path) as index:
+        pools = {kind: ProcessPoolExecutor(max_workers=workers[kind]) for kind in kinds}
+        restarted = queue.requeue('running')
+        if restarted:
+            print('INFO : {} jobs interrupted by the last stop are pending again'.format(restarted))
+        print('INFO : Watch {} (every {} s) and save the results in {}'
+              .format(index.database_directory, poll_interval, output_folder))
+        try:
+            while True:
+                # Add the new complete sessions to the queue
+                if time.time() >= next_scan:
+                    for subject in find_complete_sessions(index, recent_dates(index, lookback_days), settle_time):
+                        if queue.enqueue(subject, 'correction'):
+                            print('INFO : New session {}, queued for correction'.format(subject))
+                    next_scan = float('inf') if once else time.time() + poll_interval
+
+                # Start the pending jobs on the free workers
+                for kind in kinds:
+                    while sum(job_kind == kind for _, _, job_kind in running.values()) < workers[kind]:
+                        job = queue.claim(kind)
+                        if job is None:
+                            break
+                        print('INFO : Start {} of {}'.format(kind, job[1]))
+                        future = pools[kind].submit(JOB_FUNCTIONS[kind], job[1], output_folder, settings)
+                        running[future] = (job[0], job[1], kind)
+
+                if once and not running:
+                    break
+
+                # Wait for the end of a job or for the next scan
+                timeout = None if once else max(0., next_scan - time.time())
+                done = set()
+                if running:
+                    done, _ = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+                else:
+                    time.sleep(timeout)
+                for future in done:
+                    job_id, subject, kind = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as error:
+                        queue.finish(job_id, '{}: {}'.format(type(error).__name__, error))
+                        print('WARNING : {} of {} failed : {}: {}'.format(kind, subject, type(error).__name__, error))
+                        traceback.print_exception(type(error), error, error.__traceback__)
+                        if isinstance(error, BrokenProcessPool):
+                            pools[kind] = ProcessPoolExecutor(max_workers=workers[kind])
+                        continue
+                    queue.finish(job_id)
+                    print('INFO : End of {} of {}'.format(kind, subject))
+                    if kind == 'correction' and 'segmentation' in kinds and queue.enqueue(subject, 'segmentation'):
+                        print('INFO : {} queued for segmentation'.format(subject))
+        except KeyboardInterrupt:
+            print('WARNING : Watcher stopped, the {} running jobs will be run again at the next start'
+                  .format(len(running)))
+        finally:
+            for pool in pools.values():
+                pool.shutdown(wait=False)
+        return queue.jobs()
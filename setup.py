@@ -19,13 +19,16 @@ setuptools.setup(
     url="https://github.com/mathrip/HIPLAY7",
     packages=setuptools.find_packages(),
     package_data=pkgdata,
-    scripts=["hiplay/scripts/myelin_content"],
+    scripts=["hiplay/scripts/myelin_content", "hiplay/scripts/myelin_cohort", "hiplay/scripts/myelin_benchmark",
+             "hiplay/scripts/myelin_watch"],
     install_requires=[
-        "matplotlib",
         "numpy",
         "scipy",
         "nibabel",
         "dicom2nifti"],
+    extras_require={
+        "triangulation": ["matplotlib"],
+        "parquet": ["pyarrow"]},
     classifiers=[
         "Programming Language :: Python :: 3.7",
         "License :: OSI Approved :: MIT License",
@@ -0,0 +1,27 @@
+import os
+
+import pytest
+
+from hiplay.benchmark import make_phantom, PROJECT_DIRECTORY
+from hiplay.lookup_table import read_system_parameters, load_lookup_table
+
+
+@pytest.fixture(scope='session')
+def param_system():
+    return read_system_parameters(os.path.join(PROJECT_DIRECTORY, 'MR_system_parameters'))
+
+
+@pytest.fixture(scope='session')
+def lookup_cache(tmp_path_factory, param_system):
+    """cache folder of the MP2RAGE lookup table, computed once for all the tests"""
+    cache_directory = str(tmp_path_factory.mktemp('lookup_cache'))
+    load_lookup_table(param_system, cache_directory=cache_directory)
+    return cache_directory
+
+
+@pytest.fixture
+def phantom(tmp_path, param_system):
+    """small synthetic subject with the inputs of apply_B1correction, returns its folder, true T1 and tissues"""
+    directory = str(tmp_path / 'subject')
+    T1, tissues = make_phantom(directory, (24, 24, 16), (3., 3., 3.), (8, 8, 6), (9., 9., 8.), param_system)
+    return directory, T1, tissues
@@ -0,0 +1,33 @@
+import os
+
+from hiplay.acquisition_index import AcquisitionIndex, select_series
+
+
+def make_database(directory):
+    subject_directory = os.path.join(directory, '20240101', 'ab123456-1234_001')
+    for folder in ['000005_mp2rage-T1', '000011_mp2rage-T1']:
+        os.makedirs(os.path.join(subject_directory, folder))
+    os.utime(os.path.join(subject_directory, '000005_mp2rage-T1'), (1000, 1000))
+    os.utime(os.path.join(subject_directory, '000011_mp2rage-T1'), (2000, 2000))
+    return subject_directory
+
+
+def test_series_mtime_is_revalidated(tmp_path):
+    subject_directory = make_database(str(tmp_path / 'database'))
+    index_path = str(tmp_path / 'index.sqlite')
+    with AcquisitionIndex(str(tmp_path / 'database'), index_path) as index:
+        series = index.series('20240101', 'ab123456-1234_001', '(.*)mp2rage-T1(.*)')
+        assert [s['mtime'] for s in series] == [1000, 2000]
+        assert select_series(series, 'latest') == '000011_mp2rage-T1'
+
+    # images copied in the first series : its folder changes, not the listing of the subject folder
+    subject_mtime = os.stat(subject_directory).st_mtime
+    os.utime(os.path.join(subject_directory, '000005_mp2rage-T1'), (3000, 3000))
+    assert os.stat(subject_directory).st_mtime == subject_mtime
+    with AcquisitionIndex(str(tmp_path / 'database'), index_path) as index:
+        series = index.series('20240101', 'ab123456-1234_001', '(.*)mp2rage-T1(.*)')
+        assert [s['mtime'] for s in series] == [3000, 2000]
+        assert select_series(series, 'latest') == '000005_mp2rage-T1'
+        assert select_series(series, 'highest') == '000011_mp2rage-T1'
+        # the index is updated
+        assert index.list_directory(subject_directory) == [('000005_mp2rage-T1', 3000), ('000011_mp2rage-T1', 2000)]
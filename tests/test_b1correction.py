@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+import nibabel as nib
+
+from hiplay.benchmark import PROJECT_DIRECTORY, STEPS
+from hiplay.b1correction import apply_B1correction, output_scalings
+
+
+def read_map(directory, name):
+    return np.asanyarray(nib.load(os.path.join(directory, STEPS[1], name + '.nii.gz')).dataobj)
+
+
+def test_uncompressed_scratch_folder(phantom, lookup_cache, tmp_path):
+    directory = phantom[0]
+    apply_B1correction(directory, STEPS, PROJECT_DIRECTORY, '/no/fsl', cache_directory=lookup_cache)
+    reference = read_map(directory, 'R1q_cor')
+
+    # the scratch folder is shared by the subjects of a batch : nothing is left in it after the correction
+    scratch = tmp_path / 'scratch'
+    scratch.mkdir()
+    for _ in range(2):
+        apply_B1correction(directory, STEPS, PROJECT_DIRECTORY, '/no/fsl', cache_directory=lookup_cache,
+                           io_policy='uncompressed', scratch_directory=str(scratch))
+        assert os.listdir(str(scratch)) == []
+        np.testing.assert_array_equal(read_map(directory, 'R1q_cor'), reference)
+
+    # without scratch folder, the uncompressed intermediate image is kept in the output folder
+    apply_B1correction(directory, STEPS, PROJECT_DIRECTORY, '/no/fsl', cache_directory=lookup_cache,
+                       io_policy='uncompressed')
+    assert os.path.isfile(os.path.join(directory, STEPS[1], 'b1_to_mp2r.nii'))
+
+
+def test_int16_maps(phantom, lookup_cache):
+    directory = phantom[0]
+    apply_B1correction(directory, STEPS, PROJECT_DIRECTORY, '/no/fsl', cache_directory=lookup_cache)
+    reference = {name: read_map(directory, name) for name in ['t1q_cor', 'R1q_cor']}
+    apply_B1correction(directory, STEPS, PROJECT_DIRECTORY, '/no/fsl', cache_directory=lookup_cache,
+                       output_dtype=np.int16)
+    for name, scaling in [('t1q_cor', output_scalings(np.int16)['t1']), ('R1q_cor', output_scalings(np.int16)['r1'])]:
+        img = nib.load(os.path.join(directory, STEPS[1], name + '.nii.gz'))
+        assert img.get_data_dtype() == np.int16
+        np.testing.assert_allclose(np.asanyarray(img.dataobj), reference[name], rtol=0, atol=scaling[0] / 2 * 1.001)
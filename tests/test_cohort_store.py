@@ -0,0 +1,97 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+import hiplay
+from hiplay.cohort_store import (CohortStore, find_result_tables, results_version, write_group_table,
+                                 UNKNOWN_VERSION, RESULTS_STEP)
+from hiplay.manifest import write_manifest
+from hiplay.roi_statistics import write_statistics_table
+
+
+def make_rows(atlas, means):
+    return [{'atlas': atlas, 'label': label, 'name': 'Region{}'.format(label), 'count': 10, 'volume_mm3': 5.,
+             'mean': mean, 'std': 0.1, 'min': 0., 'max': 1., 'median': mean, 'p5': 0., 'p25': 0., 'p75': 1.,
+             'p95': 1.} for label, mean in means.items()]
+
+
+def write_subject(output_folder, subject, rows, version=None, table_format='tsv'):
+    """write the table of a subject, with the manifest of its step when version is given"""
+    step_directory = os.path.join(output_folder, subject, RESULTS_STEP)
+    os.makedirs(step_directory, exist_ok=True)
+    table_path = os.path.join(step_directory, 'R1_per_regions.' + table_format)
+    if table_format == 'tsv':
+        write_statistics_table(table_path, rows)
+    else:
+        open(table_path, 'wb').close()
+    if version is not None:
+        write_manifest(step_directory, {'inputs': {}, 'parameters': {}, 'tool_versions': {'hiplay': version}},
+                       {'R1_per_regions': table_path})
+    return table_path
+
+
+def test_results_version(tmp_path):
+    old = write_subject(str(tmp_path), '20190101_a', make_rows('dkt', {0: 0.5}), version='1.0.0')
+    legacy = write_subject(str(tmp_path), '20190101_b', make_rows('dkt', {0: 0.5}))
+    assert results_version(old) == '1.0.0'
+    assert results_version(legacy) == UNKNOWN_VERSION
+
+
+def test_find_result_tables_all_formats(tmp_path):
+    write_subject(str(tmp_path), '20190101_a', make_rows('dkt', {0: 0.5}))
+    parquet = write_subject(str(tmp_path), '20190101_b', [], table_format='parquet')
+    tsv = write_subject(str(tmp_path), '20190101_c', make_rows('dkt', {0: 0.5}))
+    newer = write_subject(str(tmp_path), '20190101_c', [], table_format='parquet')
+    os.utime(tsv, (time.time() - 100, time.time() - 100))
+    tables = find_result_tables(str(tmp_path))
+    assert list(tables) == ['20190101_a', '20190101_b', '20190101_c']
+    assert tables['20190101_b'] == parquet
+    assert tables['20190101_c'] == newer
+
+
+def test_import_keeps_versions_and_group_table(tmp_path):
+    output_folder = str(tmp_path)
+    write_subject(output_folder, '20190101_a', make_rows('dkt', {1: 0.5, 2: 0.6}), version='1.0.0')
+    write_subject(output_folder, '20190101_b', make_rows('dkt', {1: 0.7, 3: 0.8}) + make_rows('hippo_lh', {0: 0.4}))
+    with CohortStore(output_folder) as store:
+        for subject, table_path in find_result_tables(output_folder).items():
+            store.add_table(subject, table_path)
+        assert [row[:2] for row in store.subjects()] == [('20190101_a', '1.0.0'), ('20190101_b', UNKNOWN_VERSION)]
+        assert store.atlases() == ['dkt', 'hippo_lh']
+
+        regions, subjects, table = store.group_table('dkt', 'mean')
+        assert regions == [(1, 'Region1'), (2, 'Region2'), (3, 'Region3')]
+        assert subjects == ['20190101_a', '20190101_b']
+        np.testing.assert_array_equal(table, [[0.5, 0.7], [0.6, np.nan], [np.nan, 0.8]])
+
+        # a new version of a subject is used by default, the older one can still be selected
+        store.add_subject('20190101_a', make_rows('dkt', {1: 0.55, 2: 0.65}))
+        _, _, table = store.group_table('dkt', 'mean', subjects=['20190101_a'])
+        np.testing.assert_array_equal(table, [[0.55], [0.65]])
+        _, subjects, table = store.group_table('dkt', 'mean', version='1.0.0')
+        assert subjects == ['20190101_a']
+        np.testing.assert_array_equal(table, [[0.5], [0.6]])
+        assert ('20190101_a', hiplay.__version__) in [row[:2] for row in store.subjects()]
+
+        with pytest.raises(ValueError):
+            store.group_table('dkt', 'unknown_statistic')
+        store.remove_subject('20190101_b')
+        assert [row[0] for row in store.subjects()] == ['20190101_a', '20190101_a']
+
+    regions, subjects, table = [(1, 'Region1')], ['s1', 's2'], np.array([[0.5, np.nan]])
+    write_group_table(str(tmp_path / 'group.tsv'), regions, subjects, table)
+    assert (tmp_path / 'group.tsv').read_text() == 'label\tname\ts1\ts2\n1\tRegion1\t0.5\t\n'
+
+
+def test_import_parquet_table(tmp_path):
+    pytest.importorskip('pyarrow')
+    rows = make_rows('dkt', {1: 0.5})
+    step_directory = tmp_path / '20190101_a' / RESULTS_STEP
+    step_directory.mkdir(parents=True)
+    write_statistics_table(str(step_directory / 'R1_per_regions.parquet'), rows)
+    with CohortStore(str(tmp_path)) as store:
+        for subject, table_path in find_result_tables(str(tmp_path)).items():
+            store.add_table(subject, table_path)
+        assert store.subjects()[0][:2] == ('20190101_a', UNKNOWN_VERSION)
@@ -0,0 +1,51 @@
+import asyncio
+import subprocess as sub
+import time
+
+import pytest
+
+from hiplay.commands import run_tool, run_commands, run_async, subject_log
+
+
+def test_run_tool_status_and_log(tmp_path):
+    log_path = subject_log(str(tmp_path), 'echo')
+    assert run_tool(['sh', '-c', 'echo hello'], log_path=log_path) == 0
+    with open(log_path) as f:
+        log = f.read()
+    assert 'hello' in log and 'ended with status 0' in log
+
+    assert run_tool(['false'], check=False) == 1
+    with pytest.raises(sub.CalledProcessError):
+        run_tool(['false'])
+
+
+def test_run_tool_timeout():
+    start = time.perf_counter()
+    with pytest.raises(sub.TimeoutExpired):
+        run_tool(['sleep', '30'], timeout=0.2)
+    assert time.perf_counter() - start < 5
+
+
+def test_run_commands():
+    assert run_commands([{'command': ['true']}, {'command': ['sh', '-c', 'exit 3'], 'check': False}],
+                        max_concurrent=2) == [0, 3]
+
+
+def test_run_commands_cancels_the_other_commands(tmp_path):
+    marker = tmp_path / 'finished'
+    commands = [{'command': ['sh', '-c', 'sleep 0.2; false']},
+                {'command': ['sh', '-c', 'sleep 30; touch {}'.format(marker)]}]
+    start = time.perf_counter()
+    with pytest.raises(sub.CalledProcessError):
+        run_commands(commands, max_concurrent=2)
+    assert time.perf_counter() - start < 5
+    assert not marker.exists()
+
+
+def test_run_tool_in_running_loop():
+    async def main():
+        with pytest.raises(RuntimeError):
+            run_tool(['true'])
+        return await run_async(['true'])
+
+    assert asyncio.run(main()) == 0
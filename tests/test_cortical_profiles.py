@@ -0,0 +1,93 @@
+import numpy as np
+
+from hiplay.cortical_profiles import (vertex_areas, equivolume_distances, depth_coordinates, sample_volume,
+                                      profile_statistics)
+
+
+def grid_mesh(n=9):
+    """flat triangulated square of n x n vertices"""
+    i, j = np.meshgrid(np.arange(n), np.arange(n), indexing='ij')
+    vertices = np.stack([i.ravel(), j.ravel(), np.zeros(n * n)], axis=1).astype(float)
+    faces = []
+    for a in range(n - 1):
+        for b in range(n - 1):
+            v = a * n + b
+            faces += [[v, v + n, v + 1], [v + 1, v + n, v + n + 1]]
+    return vertices, np.array(faces)
+
+
+def make_surfaces():
+    """white surface on z = 0 and a larger, curved pial surface above it"""
+    white, faces = grid_mesh()
+    pial = white.copy()
+    pial[:, :2] = (pial[:, :2] - 4) * 1.5 + 4
+    pial[:, 2] = 3 + 0.05 * (pial[:, 0] - 4) ** 2
+    return pial, white, faces
+
+
+def test_equivolume_distances_loop():
+    pial, white, faces = make_surfaces()
+    pial_areas, white_areas = vertex_areas(pial, faces), vertex_areas(white, faces)
+    fractions = np.array([0.1, 0.5, 0.9])
+    distances = equivolume_distances(fractions, pial_areas, white_areas)
+
+    for vertex in range(len(pial)):
+        a_pial, a_white = pial_areas[vertex], white_areas[vertex]
+        for depth, alpha in enumerate(fractions):
+            # alpha = (2 d A_pial + d^2 (A_white - A_pial)) / (A_pial + A_white), root in [0, 1]
+            roots = np.roots([a_white - a_pial, 2 * a_pial, -alpha * (a_pial + a_white)])
+            root = [r.real for r in roots if abs(r.imag) < 1e-12 and -1e-9 <= r.real <= 1 + 1e-9]
+            assert len(root) == 1
+            assert abs(distances[vertex, depth] - root[0]) < 1e-9
+
+    # the layers of larger pial areas are thinner on the pial side
+    assert np.all(distances[:, 0] < 0.1)
+    coordinates, depths = depth_coordinates(pial, white, faces, 3, 'equivolume')
+    np.testing.assert_allclose(depths, [1 / 6., 0.5, 5 / 6.])
+    expected = equivolume_distances(depths, pial_areas, white_areas)
+    np.testing.assert_allclose(coordinates, pial[:, None, :] + expected[:, :, None] * (white - pial)[:, None, :])
+
+
+def test_sample_linear_volume():
+    pial, white, faces = make_surfaces()
+    coordinates, _ = depth_coordinates(pial, white, faces, 4, 'equivolume')
+    # voxels of 0.5 mm, the surfaces are in the middle of the volume
+    surface_to_vox = np.diag([2., 2., 2., 1.])
+    surface_to_vox[:3, 3] = [10., 10., 6.]
+    i, j, k = np.indices((40, 40, 24), dtype=float)
+    volume = (2 * i + 3 * j + 5 * k + 10).astype(np.float32)
+
+    voxels = coordinates.dot(surface_to_vox[:3, :3].T) + surface_to_vox[:3, 3]
+    expected = 2 * voxels[..., 0] + 3 * voxels[..., 1] + 5 * voxels[..., 2] + 10
+    np.testing.assert_allclose(sample_volume(volume, coordinates, surface_to_vox), expected, rtol=1e-5)
+
+    # the voxels outside of the brain mask (0) are not averaged with the cortex
+    masked = volume.copy()
+    masked[:, :, :10] = 0
+    values = sample_volume(masked, coordinates, surface_to_vox)
+    low = voxels[..., 2] < 9
+    assert np.isnan(values[low]).all()
+    assert np.isfinite(values[~low]).any()
+
+
+def test_profile_statistics_loop():
+    rng = np.random.default_rng(0)
+    profiles = rng.normal(0.6, 0.1, size=(200, 3))
+    profiles[rng.random(profiles.shape) < 0.05] = np.nan
+    labels = rng.integers(-1, 3, size=200)
+    names = ['unknown', 'caudalmiddlefrontal', 'cuneus']
+    rows = profile_statistics(profiles, labels, names, np.array([0.2, 0.5, 0.8]), 'rh')
+
+    expected = {}
+    for structure in range(len(names)):
+        for depth in range(3):
+            values = profiles[labels == structure, depth]
+            values = values[np.isfinite(values)]
+            if values.size:
+                expected[(2000 + structure, depth)] = (values.size, values.mean(), np.median(values))
+    assert {(row['label'], row['depth_index']) for row in rows} == set(expected)
+    for row in rows:
+        count, mean, median = expected[(row['label'], row['depth_index'])]
+        assert row['count'] == count
+        assert row['name'] == 'ctx-rh-' + names[row['label'] - 2000]
+        np.testing.assert_allclose([row['mean'], row['median']], [mean, median])
@@ -0,0 +1,19 @@
+import os
+
+import numpy as np
+import nibabel as nib
+
+from hiplay.filtering import foreground_mask
+
+
+def test_foreground_mask_by_slabs(phantom):
+    img = nib.load(os.path.join(phantom[0], '1.Inputs', 't1uni.nii.gz'))
+    uni = np.asanyarray(img.dataobj)
+    reference = foreground_mask(uni)
+    assert reference.any() and not reference.all()
+
+    # the slabs are read with a halo, the mask does not depend on their size nor on reading the image from disk
+    for slab_size in (1, 2, 5):
+        np.testing.assert_array_equal(foreground_mask(uni, slab_size=slab_size), reference)
+        np.testing.assert_array_equal(foreground_mask(img.dataobj, slab_size=slab_size), reference)
+    np.testing.assert_array_equal(foreground_mask(uni, window=5, slab_size=3), foreground_mask(uni, window=5))
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from hiplay.inversion import increasing_samples, build_inverse_table, invert_signal, invert_signal_triangulation
+
+
+def synthetic_lookup():
+    """smooth lookup table, strictly decreasing along T1 in every B1 column"""
+    T1 = np.arange(200, 5000, 10)
+    B1 = np.int32(np.arange(20, 121))
+    signal = 0.45 - 0.85 * np.sqrt((T1[:, np.newaxis] - 200) / 4800.) * (0.7 + 0.3 * B1[np.newaxis, :] / 120.)
+    return T1, B1, signal
+
+
+def test_invert_signal_matches_triangulation():
+    pytest.importorskip('matplotlib')
+    T1, B1, signal = synthetic_lookup()
+    rng = np.random.default_rng(0)
+    B1map_rel = rng.uniform(21, 119, size=(30, 20))
+    T1_true = rng.uniform(600, 4500, size=B1map_rel.shape)
+    uni = 0.45 - 0.85 * np.sqrt((T1_true - 200) / 4800.) * (0.7 + 0.3 * B1map_rel / 120.)
+
+    table = invert_signal(build_inverse_table(T1, B1, signal), B1, B1map_rel, uni)
+    triangulation = invert_signal_triangulation(T1, B1, signal, B1map_rel, uni)
+
+    assert np.all(np.isfinite(table)) and np.all(np.isfinite(triangulation))
+    np.testing.assert_allclose(table, triangulation, rtol=2e-3)
+    np.testing.assert_allclose(table, T1_true, rtol=2e-3)
+
+
+def test_increasing_samples_drops_plateau_and_glitches():
+    column = np.array([-0.5, -0.5, -0.5, -0.3, -0.35, -0.1, np.nan, 0.2, 0.2, 0.4])
+    keep = increasing_samples(column)
+    # last sample of each flat part, no sample above a following one, no NaN
+    np.testing.assert_array_equal(keep, [False, False, True, False, True, True, False, False, True, True])
+    assert np.all(np.diff(column[keep]) > 0)
+
+
+def test_build_inverse_table_ignores_non_monotonic_samples():
+    T1, B1, signal = synthetic_lookup()
+    reference = build_inverse_table(T1, B1, signal)
+    # CSF plateau at long T1 and a glitch in the middle of one column
+    broken = signal.copy()
+    broken[-50:, 3] = broken[-50, 3]
+    broken[200, 7] = broken[190, 7]
+    inverse_table = build_inverse_table(T1, B1, broken)
+
+    assert np.all(np.diff(inverse_table[:, 7][np.isfinite(inverse_table[:, 7])]) <= 0)
+    levels = np.arange(inverse_table.shape[0]) / inverse_table.shape[0] - 0.5
+    # away from the modified samples, the inverse is unchanged
+    valid = levels > broken[-50, 3]
+    np.testing.assert_allclose(inverse_table[valid, 3], reference[valid, 3])
+    valid = (levels > broken[180, 7]) | (levels < broken[210, 7])
+    np.testing.assert_allclose(inverse_table[valid, 7], reference[valid, 7])
+    np.testing.assert_array_equal(inverse_table[:, 8], reference[:, 8])
+
+
+def test_invert_signal_without_b1_is_nan():
+    T1, B1, signal = synthetic_lookup()
+    inverse_table = build_inverse_table(T1, B1, signal)
+    B1map_rel = np.array([np.nan, np.inf, 80., 80.])
+    uni = np.array([0., 0., 0., np.nan])
+    T1map = invert_signal(inverse_table, B1, B1map_rel, uni)
+    assert np.isnan(T1map[[0, 1, 3]]).all()
+    assert np.isfinite(T1map[2])
@@ -0,0 +1,61 @@
+import math
+
+import numpy as np
+
+from hiplay.lookup_table import build_lookup_table, load_lookup_table
+
+
+def baseline_lookup_table(param_system):
+    """lookup table computed B1 column by B1 column, like the previous implementation of b1correction"""
+    T1 = np.arange(200, 5000, 10)
+    B1 = np.int32(range(20, 121))
+    nbefore, nafter = param_system['nbefore'], param_system['nafter']
+    n = nbefore + nafter
+    TR, BTR, eff = param_system['TR'], param_system['BTR'], param_system['eff']
+    TA = param_system['TI1'] - nbefore * TR
+    TB = param_system['TI2'] - param_system['TI1'] - n * TR
+    TC = BTR - param_system['TI2'] - nafter * TR
+    E1, EA, EB, EC = (np.exp(-(np.divide(t, T1))) for t in (TR, TA, TB, TC))
+
+    signal = np.zeros((T1.shape[0], B1.shape[0]))
+    for k in range(B1.shape[0]):
+        B1rel = B1[k].astype(float) / 100
+        CA1 = math.cos(param_system['alpha1deg'] / 180 * math.pi * B1rel)
+        CA2 = math.cos(param_system['alpha2deg'] / 180 * math.pi * B1rel)
+        SA1 = math.sin(param_system['alpha1deg'] / 180 * math.pi * B1rel)
+        SA2 = math.sin(param_system['alpha2deg'] / 180 * math.pi * B1rel)
+        tmp1 = np.divide((1 - (CA1 * E1) ** n), (1 - (CA1 * E1)))
+        tmp2 = np.divide((1 - (CA2 * E1) ** n), (1 - (CA2 * E1)))
+        num = ((((1 - EA) * (CA1 * E1) ** n + (1 - E1) * tmp1) * EB + (1 - EB)) * (CA2 * E1) ** n
+               + (1 - E1) * tmp2) * EC + (1 - EC)
+        mzss = np.divide(num, 1 + eff * (CA1 * CA2) ** n * np.exp(-(np.divide(BTR, T1))))
+        MZtemp = ((-eff * mzss * EA + (1 - EA)) * (CA1 * E1) ** nbefore
+                  + (1 - E1) * np.divide((1 - (CA1 * E1) ** nbefore), (1 - (CA1 * E1))))
+        GRETI1 = SA1 * MZtemp
+        MZtemp = MZtemp * (CA1 * E1) ** nafter + (1 - E1) * np.divide((1 - (CA1 * E1) ** nafter), (1 - (CA1 * E1)))
+        MZtemp = ((MZtemp * EB + (1 - EB)) * (CA2 * E1) ** nbefore
+                  + (1 - E1) * np.divide((1 - (CA2 * E1) ** nbefore), (1 - CA2 * E1)))
+        GRETI2 = SA2 * MZtemp
+        SMP2R = np.divide((GRETI1 * GRETI2), (GRETI1 ** 2 + GRETI2 ** 2))
+
+        # little trick for correct CSF
+        near_value = SMP2R.flat[np.abs(SMP2R + 0.5).argmin()]
+        SMP2R[int(np.where(SMP2R == near_value)[0][0]):] = near_value
+        signal[:, k] = SMP2R
+    return T1, B1, signal
+
+
+def test_lookup_table_matches_baseline(param_system):
+    T1, B1, signal = build_lookup_table(param_system)
+    T1_ref, B1_ref, signal_ref = baseline_lookup_table(param_system)
+    np.testing.assert_array_equal(T1, T1_ref)
+    np.testing.assert_array_equal(B1, B1_ref)
+    np.testing.assert_allclose(signal, signal_ref, rtol=1e-12, atol=1e-15)
+
+
+def test_cached_lookup_table(param_system, lookup_cache):
+    T1, B1, signal = load_lookup_table(param_system, cache_directory=lookup_cache)
+    T1_ref, B1_ref, signal_ref = build_lookup_table(param_system)
+    np.testing.assert_array_equal(T1, T1_ref)
+    np.testing.assert_array_equal(B1, B1_ref)
+    np.testing.assert_array_equal(signal, signal_ref)
@@ -0,0 +1,30 @@
+import numpy as np
+import nibabel as nib
+import pytest
+
+from hiplay.nifti_io import NiftiSlabWriter, iter_slabs, integer_scaling
+
+
+@pytest.mark.parametrize('dtype', [np.int16, np.uint16])
+@pytest.mark.parametrize('suffix', ['.nii', '.nii.gz'])
+def test_integer_scaling_round_trip(tmp_path, dtype, suffix):
+    rng = np.random.default_rng(0)
+    volume = rng.uniform(0, 4096, size=(10, 8, 7)).astype(np.float32)
+    volume[:, :, 0] = 0
+    volume[0, 0, 1] = 4096
+    slope, inter = integer_scaling(dtype, 4096)
+    path = str(tmp_path / ('map' + suffix))
+    with NiftiSlabWriter(path, volume.shape, np.eye(4), dtype=dtype, slope=slope, inter=inter) as writer:
+        for z_start in range(0, volume.shape[2], 3):
+            writer.write(volume[:, :, z_start:z_start + 3])
+
+    img = nib.load(path)
+    assert img.get_data_dtype() == dtype
+    data = np.asanyarray(img.dataobj)
+    # quantization error of at most half a step, 0 and the maximum are exact
+    assert np.abs(data - volume).max() <= slope / 2 * (1 + 1e-6)
+    assert np.all(data[:, :, 0] == 0)
+    assert data[0, 0, 1] == pytest.approx(4096)
+    # the slab reader applies the same scaling as nibabel
+    slabs = np.concatenate([slab for _, _, slab in iter_slabs(path, 2, np.float64)], axis=2)
+    np.testing.assert_allclose(slabs, data)
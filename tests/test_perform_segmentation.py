@@ -0,0 +1,57 @@
+import os
+
+import hiplay.perform_segmentation as segmentation
+from hiplay.pipeline import STEPS
+
+
+def prepare_subject(tmp_path, subj_name):
+    subject_directory = tmp_path / subj_name
+    (subject_directory / STEPS[0]).mkdir(parents=True)
+    (subject_directory / STEPS[0] / 't1uni_den.nii.gz').write_bytes(b'')
+    freesurf_output_dir = tmp_path / 'freesurfer_outputs'
+    freesurf_output_dir.mkdir()
+    (freesurf_output_dir / 'expert.opts').write_text('mris_inflate -n 15\n')
+    return str(subject_directory), str(freesurf_output_dir)
+
+
+def run_recon_all(monkeypatch, subject_directory, freesurf_output_dir, subj_name):
+    commands = []
+
+    def fake_run_freesurfer(command, freesurferHome, description, log_path=None, timeout=None):
+        # recon-all refuses -i when the subject folder already exists
+        assert not os.path.exists(os.path.join(freesurf_output_dir, subj_name))
+        commands.append(command)
+        os.makedirs(os.path.join(freesurf_output_dir, subj_name, 'mri'))
+
+    monkeypatch.setattr(segmentation, 'run_freesurfer', fake_run_freesurfer)
+    segmentation.apply_recon_all(subject_directory, STEPS, freesurf_output_dir, '/freesurfer', subj_name)
+    return commands[0]
+
+
+def test_recon_all_first_run(tmp_path, monkeypatch):
+    subj_name = '20190719_mr331057'
+    subject_directory, freesurf_output_dir = prepare_subject(tmp_path, subj_name)
+    command = run_recon_all(monkeypatch, subject_directory, freesurf_output_dir, subj_name)
+    assert command[:5] == ['/freesurfer/bin/recon-all', '-sd', freesurf_output_dir, '-s', subj_name]
+    assert command[command.index('-i') + 1] == os.path.join(subject_directory, STEPS[0], 't1uni_den.nii.gz')
+    assert '-all' in command
+    assert not os.path.exists(os.path.join(freesurf_output_dir, subj_name + segmentation.PREVIOUS_RUN_SUFFIX))
+
+
+def test_recon_all_run_again(tmp_path, monkeypatch):
+    subj_name = '20190719_mr331057'
+    subject_directory, freesurf_output_dir = prepare_subject(tmp_path, subj_name)
+    # outputs of an interrupted run and of an older run
+    stale = os.path.join(freesurf_output_dir, subj_name, 'scripts')
+    os.makedirs(stale)
+    open(os.path.join(stale, 'IsRunning.lh+rh'), 'w').close()
+    previous = os.path.join(freesurf_output_dir, subj_name + segmentation.PREVIOUS_RUN_SUFFIX)
+    os.makedirs(os.path.join(previous, 'old'))
+
+    command = run_recon_all(monkeypatch, subject_directory, freesurf_output_dir, subj_name)
+    assert command == segmentation.recon_all_command(os.path.join(subject_directory, STEPS[0], 't1uni_den.nii.gz'),
+                                                     freesurf_output_dir, '/freesurfer', subj_name)
+    assert ['-i', os.path.join(subject_directory, STEPS[0], 't1uni_den.nii.gz')] == \
+        command[command.index('-i'):command.index('-i') + 2]
+    assert os.path.isfile(os.path.join(previous, 'scripts', 'IsRunning.lh+rh'))
+    assert not os.path.exists(os.path.join(previous, 'old'))
@@ -0,0 +1,63 @@
+import numpy as np
+
+from hiplay.resampling import resample_to_reference, resample_voxels
+
+
+def rotation(angles):
+    """rotation matrix of the angles (radians) around x, y and z"""
+    matrix = np.eye(3)
+    for axis, angle in enumerate(angles):
+        c, s = np.cos(angle), np.sin(angle)
+        plane = [a for a in range(3) if a != axis]
+        step = np.eye(3)
+        step[plane[0], plane[0]], step[plane[0], plane[1]] = c, -s
+        step[plane[1], plane[0]], step[plane[1], plane[1]] = s, c
+        matrix = step.dot(matrix)
+    return matrix
+
+
+def make_affine(zooms, angles, origin):
+    affine = np.eye(4)
+    affine[:3, :3] = rotation(angles).dot(np.diag(zooms))
+    affine[:3, 3] = origin
+    return affine
+
+
+def trilinear_loop(data, affine, ref_shape, ref_affine):
+    """trilinear interpolation voxel by voxel from the world coordinates, 0 outside of data"""
+    resampled = np.zeros(ref_shape)
+    for index in np.ndindex(*ref_shape):
+        world = ref_affine.dot(list(index) + [1.])
+        point = np.linalg.solve(affine, world)[:3]
+        if np.any(point < 0) or np.any(point > np.array(data.shape) - 1):
+            continue
+        low = np.minimum(np.floor(point).astype(int), np.array(data.shape) - 2)
+        weights = point - low
+        value = 0.
+        for corner in np.ndindex(2, 2, 2):
+            weight = np.prod([w if c else 1 - w for c, w in zip(corner, weights)])
+            value += weight * data[tuple(low + corner)]
+        resampled[index] = value
+    return resampled
+
+
+def test_resample_to_reference_oblique_anisotropic():
+    rng = np.random.default_rng(0)
+    data = rng.uniform(100, 700, size=(11, 9, 7))
+    affine = make_affine((4., 3.5, 5.), (0.1, -0.05, 0.3), (-20., -15., -12.))
+    # finer, differently oriented reference grid which extends outside of data
+    ref_shape = (14, 13, 10)
+    ref_affine = make_affine((2.5, 2., 3.), (-0.2, 0.15, -0.1), (-24., -20., -16.))
+
+    expected = trilinear_loop(data, affine, ref_shape, ref_affine)
+    assert (expected == 0).any() and (expected != 0).mean() > 0.3
+
+    for n_jobs, dtype in [(1, np.float64), (3, np.float64), (2, np.float32)]:
+        resampled = resample_to_reference(data, affine, ref_shape, ref_affine, n_jobs=n_jobs, dtype=dtype)
+        assert resampled.dtype == dtype
+        # zero padding outside of the field of view of data
+        np.testing.assert_array_equal(resampled == 0, expected == 0)
+        np.testing.assert_allclose(resampled, expected, rtol=1e-5 if dtype == np.float32 else 1e-10)
+
+    voxels = np.nonzero(expected)
+    np.testing.assert_allclose(resample_voxels(data, affine, ref_affine, voxels), expected[voxels], rtol=1e-10)
@@ -0,0 +1,71 @@
+import numpy as np
+
+from hiplay.roi_statistics import (label_statistics, atlas_statistics, write_segstats_sum, write_statistics_table,
+                                   read_statistics_table, PERCENTILES)
+
+
+def groupby_statistics(values, labels, percentiles=PERCENTILES):
+    """statistics of each label with a loop over the labels, like the previous mri_segstats based computation"""
+    values, labels = values.ravel(), labels.ravel()
+    keep = np.isfinite(values)
+    statistics = {}
+    for label in np.unique(labels[keep]):
+        region = values[keep & (labels == label)].astype(np.float64)
+        statistics[int(label)] = dict(count=region.size, mean=region.mean(), std=region.std(ddof=1),
+                                      min=region.min(), max=region.max(), median=np.median(region),
+                                      **{'p{:g}'.format(q): np.percentile(region, q) for q in percentiles})
+    return statistics
+
+
+def make_volume(seed=0):
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, 6, size=(20, 18, 12))
+    labels[labels == 3] = 17
+    values = rng.normal(0.6, 0.1, size=labels.shape).astype(np.float32)
+    values[rng.random(labels.shape) < 0.05] = np.nan
+    return values, labels
+
+
+def test_label_statistics_matches_groupby():
+    values, labels = make_volume()
+    statistics = label_statistics(values, labels)
+    expected = groupby_statistics(values, labels)
+    assert list(statistics['label']) == sorted(expected)
+    assert 0 in statistics['label']
+    for i, label in enumerate(statistics['label']):
+        for key, value in expected[int(label)].items():
+            np.testing.assert_allclose(statistics[key][i], value, rtol=1e-10, err_msg='{} {}'.format(label, key))
+
+
+def test_label_statistics_exclude_labels():
+    values, labels = make_volume(1)
+    statistics = label_statistics(values, labels, exclude_labels=(0, 17))
+    assert list(statistics['label']) == [1, 2, 4, 5]
+
+
+def test_atlas_statistics_reports_background(tmp_path):
+    values, labels = make_volume(2)
+    hippo = np.where(labels > 2, labels + 200, 0)
+    rows = atlas_statistics(values, {'dkt': labels, 'hippo': hippo}, names={0: 'Unknown'}, voxel_volume=0.5)
+    expected = {'dkt': groupby_statistics(values, labels), 'hippo': groupby_statistics(values, hippo)}
+    assert [(row['atlas'], row['label']) for row in rows] == \
+        [(atlas, label) for atlas in ['dkt', 'hippo'] for label in sorted(expected[atlas])]
+    for row in rows:
+        reference = expected[row['atlas']][row['label']]
+        assert row['count'] == reference['count']
+        assert row['volume_mm3'] == 0.5 * reference['count']
+        np.testing.assert_allclose([row['mean'], row['std'], row['median']],
+                                   [reference['mean'], reference['std'], reference['median']], rtol=1e-10)
+    assert rows[0]['name'] == 'Unknown'
+
+    # the header of the summary only says that the background is excluded when it is
+    dkt_rows = [row for row in rows if row['atlas'] == 'dkt']
+    write_segstats_sum(str(tmp_path / 'all.txt'), dkt_rows)
+    assert 'Excluding Background' not in (tmp_path / 'all.txt').read_text()
+    write_segstats_sum(str(tmp_path / 'no_background.txt'), dkt_rows[1:], exclude_labels=(0,))
+    assert 'Excluding Background' in (tmp_path / 'no_background.txt').read_text()
+
+    write_statistics_table(str(tmp_path / 'table.tsv'), rows)
+    table = read_statistics_table(str(tmp_path / 'table.tsv'))
+    assert [(row['atlas'], row['label'], row['count']) for row in table] == \
+        [(row['atlas'], row['label'], row['count']) for row in rows]
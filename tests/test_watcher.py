@@ -0,0 +1,98 @@
+import os
+import datetime
+
+import pytest
+
+from hiplay.acquisition_index import AcquisitionIndex
+from hiplay.watcher import JobQueue, lock_output_folder, watch, find_complete_sessions, recent_dates
+
+
+def test_claim_gives_each_job_once(tmp_path):
+    with JobQueue(str(tmp_path)) as first, JobQueue(str(tmp_path)) as second:
+        for subject in ['20240101_ab123456', '20240102_cd123456', '20240103_ef123456']:
+            assert first.enqueue(subject, 'correction')
+        assert not second.enqueue('20240101_ab123456', 'correction')
+
+        claimed = [first.claim('correction'), second.claim('correction'), first.claim('correction')]
+        assert [subject for _, subject in claimed] == ['20240101_ab123456', '20240102_cd123456',
+                                                       '20240103_ef123456']
+        assert second.claim('correction') is None
+        assert first.claim('segmentation') is None
+        assert [status for _, _, status, *_ in second.jobs()] == ['running'] * 3
+
+
+def test_claim_skips_a_job_claimed_by_another_connection(tmp_path):
+    with JobQueue(str(tmp_path)) as queue:
+        queue.enqueue('20240101_ab123456', 'correction')
+        queue.enqueue('20240102_cd123456', 'correction')
+
+        class RacingConnection(object):
+            """connection on which another watcher claims the first job between its selection and its update"""
+
+            def __init__(self, connection):
+                self.connection = connection
+                self.raced = False
+
+            def execute(self, query, parameters=()):
+                if query.startswith('UPDATE') and not self.raced:
+                    self.raced = True
+                    with JobQueue(str(tmp_path)) as other:
+                        with other.connection:
+                            other.connection.execute("UPDATE jobs SET status = 'running' WHERE subject = ?",
+                                                     ('20240101_ab123456',))
+                return self.connection.execute(query, parameters)
+
+            def __enter__(self):
+                return self.connection.__enter__()
+
+            def __exit__(self, *args):
+                return self.connection.__exit__(*args)
+
+        connection = queue.connection
+        queue.connection = RacingConnection(connection)
+        try:
+            assert queue.claim('correction')[1] == '20240102_cd123456'
+        finally:
+            queue.connection = connection
+        assert [row[3] for row in queue.jobs()] == [0, 1]
+
+
+def test_single_watcher_per_output_folder(tmp_path):
+    output_folder = str(tmp_path)
+    with lock_output_folder(output_folder):
+        with pytest.raises(RuntimeError):
+            lock_output_folder(output_folder)
+        with pytest.raises(RuntimeError):
+            watch(output_folder, {'deviceSeptT_directory': str(tmp_path / 'database')}, once=True)
+    # the lock is released with the first watcher
+    lock_output_folder(output_folder).close()
+    assert os.path.isfile(os.path.join(output_folder, 'job_queue.lock'))
+
+
+SERIES = ['05_b1-map-xfl-sag-B1', '07_t1-mp2rage-sag-iso0.75mm-T1-Images', '08_t1-mp2rage-sag-iso0.75mm-UNI-Images',
+          '09_t1-mp2rage-sag-iso0.75mm-UNI-DEN']
+
+
+def make_session(database, date, folder, series, mtime):
+    for name in series:
+        path = os.path.join(database, date, folder, name)
+        os.makedirs(path)
+        os.utime(path, (mtime, mtime))
+
+
+def test_find_complete_sessions(tmp_path):
+    database = str(tmp_path / 'database')
+    make_session(database, '20240101', 'ab123456-1111_001', SERIES, 1000)        # complete
+    make_session(database, '20240101', 'cd123456-2222_001', SERIES[:3], 1000)    # no UNI-DEN series
+    make_session(database, '20240101', 'ef123456-3333_001', SERIES, 1000)        # still copied
+    make_session(database, '20240101', 'gh123456-4444_001', SERIES, 1000)        # two folders of the same NIP
+    make_session(database, '20240101', 'gh123456-4444_002', SERIES, 1000)
+    make_session(database, '20240102', 'ij123456-5555_001', SERIES, 1000)        # date not scanned
+    os.utime(os.path.join(database, '20240101', 'ef123456-3333_001', SERIES[2]), (1950, 1950))
+
+    with AcquisitionIndex(database, str(tmp_path / 'index.sqlite')) as index:
+        assert recent_dates(index, 1, today=datetime.date(2024, 1, 2)) == ['20240101', '20240102']
+        assert find_complete_sessions(index, ['20240101'], settle_time=100, now=2000) == ['20240101_ab123456']
+        # the series of a session are looked at again at each scan
+        assert find_complete_sessions(index, ['20240101'], settle_time=100, now=2100) == ['20240101_ab123456',
+                                                                                         '20240101_ef123456']